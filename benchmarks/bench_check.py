@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+"""
+Benchmarks the collectors of localChecks/check.py at fleet scale.
+
+psutil is replaced by a synthetic module, so the numbers only depend on the
+code of check.py: 50,000 processes, 256 cores, 1,000 mounts, 500 block
+devices and 2,000 network interfaces. Every case runs in its own
+interpreter, so the peak RSS of one case is not inflated by another.
+
+usage:
+    bench_check.py                      run all cases, write results
+    bench_check.py -k disk -r 3         run matching cases only
+    bench_check.py --compare a.json b.json
+
+Results are written to benchmarks/results/<commit>.json and can be compared
+between commits with --compare.
+
+This file is under Apache 2.0 License
+
+Copyright C-Store 2016
+Author Mattis Haase
+"""
+
+from collections import namedtuple
+import argparse
+import builtins
+import inspect
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+S_ROOT        = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+S_RESULTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results')
+
+# case: (description, default cardinality)
+D_CASES = {
+    'memory_top_pid'  : ('memory WARNING, top 5 of n processes', 50000),
+    'memory_top_user' : ('memory WARNING, top 5 users of n processes', 50000),
+    'cpu_top_cgroup'  : ('cpu WARNING, top 5 cgroups of n processes', 50000),
+    'cpu_cores'       : ('cpu OK on n cores from a snapshot', 256),
+    'disk_mounts'     : ('disk on n mounts, half as many block devices', 1000),
+    'network_nics'    : ('network on n interfaces from a snapshot', 2000),
+}
+
+def build_fake_psutil(i_processes=50000, i_cores=256, i_mounts=1000, i_disks=500, i_nics=2000):
+    """
+    Builds a module that stands in for psutil with synthetic data. Every
+    call advances the counters a little, like on a real system.
+
+    Returns:
+        module
+    """
+    psutil = types.ModuleType('psutil')
+
+    class NoSuchProcess(Exception):
+        pass
+
+    class AccessDenied(Exception):
+        pass
+
+    nt_memory  = namedtuple('svmem', 'total available percent used free active inactive buffers cached shared slab')
+    nt_cpu     = namedtuple('scputimes', 'user nice system idle iowait irq softirq steal guest guest_nice')
+    nt_part    = namedtuple('sdiskpart', 'device mountpoint fstype opts maxfile maxpath')
+    nt_usage   = namedtuple('sdiskusage', 'total used free percent')
+    nt_disk_io = namedtuple('sdiskio', 'read_count write_count read_bytes write_bytes read_time write_time read_merged_count write_merged_count busy_time')
+    nt_net_io  = namedtuple('snetio', 'bytes_sent bytes_recv packets_sent packets_recv errin errout dropin dropout')
+    l_calls    = [0]
+
+    class Process:
+        __slots__ = ['info']
+
+        def cpu_percent(self, interval=None):
+            return self.info['cpu_percent']
+
+        def as_dict(self, attrs=None, ad_value=None):
+            return {s_key: self.info[s_key] for s_key in attrs or self.info}
+
+    def virtual_memory():
+        return nt_memory(2**36, 2**33, 87.5, 2**35, 2**32, 2**34, 2**33, 2**30, 2**33, 2**29, 2**30)
+
+    def cpu_times(percpu=False):
+        l_calls[0] += 1
+        i = l_calls[0]
+        l_times = [
+            nt_cpu(100.0 * i + n, 1.0 * i, 50.0 * i, 800.0 * i + n, 5.0 * i, 0.5 * i, 0.5 * i, 0.0, 0.0, 0.0)
+            for n in range(i_cores)
+        ]
+        if percpu:
+            return l_times
+        return nt_cpu(*[sum(values) for values in zip(*l_times)])
+
+    def boot_time():
+        return 1500000000.0
+
+    def process_iter(attrs=None, ad_value=None):
+        for i_pid in range(1, i_processes + 1):
+            proc = Process()
+            proc.info = {
+                'pid'           : i_pid,
+                'name'          : 'proc{}'.format(i_pid % 997),
+                'username'      : 'user{}'.format(i_pid % 113),
+                'cpu_percent'   : float(i_pid % 1009) / 10,
+                'memory_percent': float(i_pid % 1013) / 1000
+            }
+            yield proc
+
+    def disk_partitions(all=False):
+        return [
+            nt_part('/dev/vd{}'.format(i), '/srv/volume{}'.format(i), 'ext4', 'rw,relatime', 255, 4096)
+            for i in range(i_mounts)
+        ]
+
+    def disk_usage(s_path):
+        return nt_usage(2**40, 2**39, 2**39, 50.0)
+
+    def disk_io_counters(perdisk=False):
+        i = l_calls[0]
+        return {
+            'vd{}'.format(n): nt_disk_io(i * 10, i * 20, i * 4096, i * 8192, i, i, i, i, i)
+            for n in range(i_disks)
+        }
+
+    def net_io_counters(pernic=False):
+        l_calls[0] += 1
+        i = l_calls[0]
+        return {
+            'veth{:04x}'.format(n): nt_net_io(i * 1500000, i * 1500000, i * 1000, i * 1000, 0, 0, i, 0)
+            for n in range(i_nics)
+        }
+
+    for function in [
+        virtual_memory, cpu_times, boot_time, process_iter, disk_partitions,
+        disk_usage, disk_io_counters, net_io_counters
+    ]:
+        setattr(psutil, function.__name__, function)
+    psutil.NoSuchProcess = NoSuchProcess
+    psutil.AccessDenied  = AccessDenied
+    return psutil
+
+def build_fake_open(i_cgroups=61):
+    """
+    Builds an open that serves /proc/<pid>/cgroup from synthetic data and
+    opens every other path as usual.
+
+    Returns:
+        function
+    """
+    def fake_open(s_path, *args, **kwargs):
+        l_path = str(s_path).split('/')
+        if len(l_path) == 4 and l_path[1] == 'proc' and l_path[3] == 'cgroup':
+            return io.StringIO('0::/system.slice/service{}.service\n'.format(int(l_path[2]) % i_cgroups))
+        return builtins.open(s_path, *args, **kwargs)
+
+    return fake_open
+
+def run_case(s_case, i_size, i_repeat):
+    """
+    Runs one case in this interpreter. Only called in the child process.
+
+    Returns:
+        dict with wall times, peak rss and output size, or with the reason
+        the checked out check.py can not run the case
+    """
+    d_sizes = {
+        'memory_top_pid' : {'i_processes': i_size},
+        'memory_top_user': {'i_processes': i_size},
+        'cpu_top_cgroup' : {'i_processes': i_size},
+        'cpu_cores'      : {'i_cores': i_size},
+        'disk_mounts'    : {'i_mounts': i_size, 'i_disks': i_size // 2},
+        'network_nics'   : {'i_nics': i_size},
+    }
+    sys.modules['psutil'] = build_fake_psutil(**d_sizes[s_case])
+    os.environ['ICINGA2CHECKS_STATE_DIR'] = tempfile.mkdtemp(prefix='bench_check')
+    sys.path.insert(0, os.path.join(S_ROOT, 'localChecks'))
+    import check
+    # the synthetic processes report their cpu usage without sampling
+    check.F_TOP_INTERVAL = 0
+    # cgroups of the synthetic processes, the names check.py looks up in
+    # its module before the builtins
+    check.open = build_fake_open()
+
+    # older commits can not group the top consumers
+    if s_case in ('memory_top_user', 'cpu_top_cgroup') and 's_group' not in inspect.signature(check.check_load_or_memory).parameters:
+        return {'size': i_size, 'skipped': 'check_load_or_memory has no s_group'}
+
+    d_runs = {
+        'memory_top_pid' : lambda: check.check_load_or_memory(10, 20, 'memory'),
+        'memory_top_user': lambda: check.check_load_or_memory(10, 20, 'memory', s_group='user'),
+        'cpu_top_cgroup' : lambda: check.check_load_or_memory(1, 2, 'cpu', s_group='cgroup'),
+        'cpu_cores'      : lambda: check.check_load_or_memory(85, 95, 'cpu'),
+        'disk_mounts'    : lambda: check.check_disk(85, 95, '/srv/volume0'),
+        'network_nics'   : lambda: check.check_network(85, 95),
+    }
+    run = d_runs[s_case]
+
+    # first run writes the cpu/network snapshots the timed runs start from
+    run()
+    i_rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    l_times = []
+    for i in range(i_repeat):
+        f_start = time.perf_counter()
+        s_output = run()
+        l_times.append(time.perf_counter() - f_start)
+
+    return {
+        'size'             : i_size,
+        'wall_min_s'       : round(min(l_times), 6),
+        'wall_median_s'    : round(statistics.median(l_times), 6),
+        'peak_rss_kb'      : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_rss_before_kb': i_rss_before,
+        'output_bytes'     : len(s_output.encode('utf-8'))
+    }
+
+def get_commit():
+    """Returns: short hash of the checked out commit, with -dirty if changed"""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=S_ROOT, stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(s_old, s_new):
+    """Prints a comparison of two result files"""
+    with open(s_old) as f:
+        d_old = json.load(f)
+    with open(s_new) as f:
+        d_new = json.load(f)
+    print('{:<18} {:>12} {:>12} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'case', 'old wall s', 'new wall s', 'speedup', 'old rss', 'new rss', 'old out', 'new out'
+    ))
+    for s_case in sorted(set(d_old['cases']) | set(d_new['cases'])):
+        d_o = d_old['cases'].get(s_case)
+        d_n = d_new['cases'].get(s_case)
+        if not d_o or not d_n:
+            print('{:<18} only in {}'.format(s_case, d_old['commit'] if d_o else d_new['commit']))
+            continue
+        print('{:<18} {:>12.4f} {:>12.4f} {:>7.2f}x {:>10} {:>10} {:>10} {:>10}'.format(
+            s_case,
+            d_o['wall_median_s'],
+            d_n['wall_median_s'],
+            d_o['wall_median_s'] / d_n['wall_median_s'] if d_n['wall_median_s'] else float('inf'),
+            d_o['peak_rss_kb'],
+            d_n['peak_rss_kb'],
+            d_o['output_bytes'],
+            d_n['output_bytes']
+        ))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the collectors of check.py with synthetic psutil data.')
+    parser.add_argument('-k', '--keyword', type=str, default='', help='only run cases containing this string')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='timed runs per case, default 5')
+    parser.add_argument('-s', '--scale', type=float, default=1.0, help='multiply all cardinalities, default 1.0')
+    parser.add_argument('-o', '--output', type=str, help='result file, default benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('--case', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.size, args.repeat)))
+        return
+
+    d_results = {
+        'commit' : get_commit(),
+        'python' : sys.version.split()[0],
+        'time'   : int(time.time()),
+        'repeat' : args.repeat,
+        'cases'  : {}
+    }
+    for s_case, (s_description, i_size) in sorted(D_CASES.items()):
+        if args.keyword not in s_case:
+            continue
+        i_size = max(1, int(i_size * args.scale))
+        s_result = subprocess.check_output([
+            sys.executable, os.path.realpath(__file__),
+            '--case', s_case, '--size', str(i_size), '--repeat', str(args.repeat)
+        ]).decode('utf-8')
+        d_result = json.loads(s_result)
+        if 'skipped' in d_result:
+            print('{:<18} skipped, {}'.format(s_case, d_result['skipped']))
+            continue
+        d_result['description'] = s_description.replace(' n ', ' {} '.format(i_size))
+        d_results['cases'][s_case] = d_result
+        print('{:<18} {:>10.4f}s {:>8} KB rss {:>10} B output  {}'.format(
+            s_case, d_result['wall_median_s'], d_result['peak_rss_kb'], d_result['output_bytes'], d_result['description']
+        ))
+
+    s_output = args.output or os.path.join(S_RESULTS_DIR, d_results['commit'] + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(s_output)), exist_ok=True)
+    with open(s_output, 'w') as f:
+        json.dump(d_results, f, indent=2, sort_keys=True)
+    print('results written to {}'.format(s_output))
+
+if __name__ == '__main__':
+    main()
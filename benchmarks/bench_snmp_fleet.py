@@ -0,0 +1,419 @@
+#!/usr/bin/python3
+"""
+Benchmarks snmpChecks/check_snmp_fleet.py against a simulated fleet.
+
+A simulated SNMPv3 agent answers on one UDP port per device, with the OIDs
+of check_imm2.py and check_synology_snmp.py and a fixed latency per answer.
+It runs in its own process but on the same machine, so at high concurrency
+it competes with the poller for CPU. The fleet is polled with several
+concurrency caps and, for comparison, the way it was done before: one
+check process per device and command.
+
+Reported per case are devices per second and the peak RSS of the poller
+per device, measured against a fleet of one device.
+
+usage:
+    bench_snmp_fleet.py                      run all cases, write results
+    bench_snmp_fleet.py -k fleet -r 3        run matching cases only
+    bench_snmp_fleet.py --compare a.json b.json
+
+Results are written to benchmarks/results/snmp_fleet_<commit>.json and can
+be compared between commits with --compare.
+
+This file is under Apache 2.0 License
+
+Copyright C-Store 2016
+Author Mattis Haase
+"""
+
+import argparse
+import asyncio
+import bisect
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+S_ROOT        = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+S_SNMP_CHECKS = os.path.join(S_ROOT, 'snmpChecks')
+S_RESULTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results')
+
+# credentials of the simulated agents
+D_USER = {
+    'user'      : 'monitor',
+    'level'     : 'authPriv',
+    'authAlgo'  : 'SHA',
+    'authPasswd': 'benchauth123',
+    'privAlgo'  : 'AES',
+    'privPasswd': 'benchpriv123'
+}
+S_ENGINE_ID = bytes.fromhex('80001f8804') + b'benchmark'
+
+# case: (description, concurrency, devices polled by the case as share of
+# the fleet)
+D_CASES = {
+    'fleet_c1'    : ('check_snmp_fleet.py, 1 device at a time', 1, 1.0),
+    'fleet_c16'   : ('check_snmp_fleet.py, 16 devices at a time', 16, 1.0),
+    'fleet_c64'   : ('check_snmp_fleet.py, 64 devices at a time', 64, 1.0),
+    'fleet_c256'  : ('check_snmp_fleet.py, 256 devices at a time', 256, 1.0),
+    'processes_16': ('one check process per device and command, 16 at a time', 16, 0.1),
+}
+
+# values the checks understand, everything else gets a number
+D_VALUES = {
+    'systemStatus'    : 1,
+    'powerStatus'     : 1,
+    'systemFanStatus' : 1,
+    'cpuFanStatus'    : 1,
+    'upgradeAvailable': 2,
+    'diskStatus'      : 1,
+    'raidStatus'      : 1,
+    'totalSize'       : 1000000,
+    'sizeUsed'        : 400000,
+    'fanPercent'      : b'41% of maximum',
+    'fanStatus'       : b'Normal',
+    'status'          : b'Normal',
+    'hwStatus'        : 255,
+    'disk_Status'     : b'Online',
+    'disk_Temperature': b'35C',
+    'volumeStatus'    : b'Optimal'
+}
+
+def get_device_type(i_device, i_devices):
+    """
+    Returns:
+        type of the i_device-th device of a fleet, the first tenth are
+        Synology NAS, the others IMM2
+    """
+    return 'synology' if i_device < i_devices // 10 else 'imm2'
+
+def get_check_modules():
+    """
+    Returns:
+        dict of device type: check module, imported from snmpChecks
+    """
+    sys.path.insert(0, S_SNMP_CHECKS)
+    sys.path.insert(1, S_ROOT)
+    import check_imm2
+    import check_synology_snmp
+    return {'imm2': (check_imm2, 'ibm'), 'synology': (check_synology_snmp, 'synology')}
+
+def build_tree(module, s_vendor, i_rows):
+    """
+    Builds the MIB of one simulated device from the tree of a check.
+
+    Returns:
+        sorted list of (OID tuple, typed value)
+    """
+    import lib.snmpv3
+    l_varbinds = []
+    for s_module, s_base in module.tree[s_vendor].items():
+        for s_key, s_leaf in module.tree[s_module].items():
+            t_oid = lib.snmpv3.parseOid(s_base + '.' + s_leaf)
+            l_rows = [()] if s_module in module.instanceModules else [(i,) for i in range(1, i_rows + 1)]
+            for t_row in l_rows:
+                i_row = t_row[0] if t_row else 0
+                if 'name' in s_key.lower() or s_key == 'diskID':
+                    # storage volumes are found by name, temperature sensors
+                    # lose their last four characters
+                    value = ('/volume{}' if s_module == 'storage' else s_key + '{}Temp').format(i_row).encode('utf-8')
+                else:
+                    value = D_VALUES.get(s_key, 30 + i_row)
+                l_varbinds.append((t_oid + t_row, value))
+    return sorted(l_varbinds, key=lambda t_varbind: t_varbind[0])
+
+def run_agents(i_devices, i_base_port, f_latency):
+    """
+    Serves i_devices simulated agents on consecutive UDP ports until killed.
+    The first tenth of the ports are Synology NAS, the others IMM2.
+    """
+    d_modules = get_check_modules()
+    import lib.snmpv3
+    d_trees = {
+        s_type: build_tree(module, s_vendor, 8) for s_type, (module, s_vendor) in d_modules.items()
+    }
+    d_oids = {s_type: [t_oid for t_oid, value in l_tree] for s_type, l_tree in d_trees.items()}
+
+    # the messages of the agent are encoded by a session with the keys of
+    # the user, check_synology_snmp.py always uses authNoPriv with MD5
+    d_codecs = {
+        'imm2'    : lib.snmpv3.Session(
+            'agent', D_USER['user'], D_USER['level'], D_USER['authAlgo'], D_USER['authPasswd'],
+            D_USER['privAlgo'], D_USER['privPasswd'], bCache=False
+        ),
+        'synology': lib.snmpv3.Session('agent', D_USER['user'], 'authNoPriv', 'MD5', D_USER['authPasswd'], bCache=False)
+    }
+    for codec in d_codecs.values():
+        codec.setEngine(S_ENGINE_ID, 1, 1000)
+        codec.prepareKeys()
+
+    def successor(s_type, t_oid):
+        i = bisect.bisect_right(d_oids[s_type], t_oid)
+        if i >= len(d_oids[s_type]):
+            return t_oid, lib.snmpv3.EndOfMibView
+        return d_trees[s_type][i]
+
+    def answer(s_type, b_message):
+        codec = d_codecs[s_type]
+        i_message_id, i_flags, t_engine, b_pdu = codec.decodeMessage(b_message)
+        i_tag, i_request_id, i_non_repeaters, i_max_repetitions, l_request = lib.snmpv3.decodePdu(b_pdu)
+        if not i_flags & lib.snmpv3.iFlagAuth:
+            # discovery, the engine is reported unauthenticated
+            l_answer = [(lib.snmpv3.tUnknownEngineId, lib.snmpv3.Counter32(1))]
+            return codec.encodeMessage(
+                i_message_id, lib.snmpv3.encodePdu(lib.snmpv3.iTagReport, i_request_id, l_answer), False, False, False
+            )
+        if i_tag == lib.snmpv3.iTagGet:
+            d_tree = dict(d_trees[s_type])
+            l_answer = [(t_oid, d_tree.get(t_oid, lib.snmpv3.NoSuchInstance)) for t_oid, value in l_request]
+        elif i_tag == lib.snmpv3.iTagGetNext:
+            l_answer = [successor(s_type, t_oid) for t_oid, value in l_request]
+        else:
+            l_answer = [successor(s_type, t_oid) for t_oid, value in l_request[:i_non_repeaters]]
+            l_next = [t_oid for t_oid, value in l_request[i_non_repeaters:]]
+            for i in range(i_max_repetitions if l_next else 0):
+                l_row = [successor(s_type, t_oid) for t_oid in l_next]
+                l_answer += l_row
+                l_next = [t_oid for t_oid, value in l_row]
+                if all(value is lib.snmpv3.EndOfMibView for t_oid, value in l_row):
+                    break
+        return codec.encodeMessage(
+            i_message_id, lib.snmpv3.encodePdu(lib.snmpv3.iTagResponse, i_request_id, l_answer),
+            True, bool(i_flags & lib.snmpv3.iFlagPriv), False
+        )
+
+    class Agent(asyncio.DatagramProtocol):
+        def __init__(self, s_type):
+            self.s_type = s_type
+
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, b_message, address):
+            try:
+                b_answer = answer(self.s_type, b_message)
+            except (lib.snmpv3.SNMPError, ValueError):
+                return
+            asyncio.get_running_loop().call_later(f_latency, self.transport.sendto, b_answer, address)
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        for i in range(i_devices):
+            await loop.create_datagram_endpoint(
+                lambda i=i: Agent(get_device_type(i, i_devices)),
+                local_addr=('127.0.0.1', i_base_port + i)
+            )
+        print('ready', flush=True)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+def write_inventory(s_path, i_devices, i_base_port, l_devices=None):
+    """Writes the inventory of the simulated fleet, or of the devices in
+    l_devices only"""
+    d_inventory = {
+        'defaults': {
+            'imm2'    : dict(D_USER),
+            'synology': {'user': D_USER['user'], 'passwd': D_USER['authPasswd']}
+        },
+        'hosts': [
+            {
+                'type'    : get_device_type(i, i_devices),
+                'host'    : '127.0.0.1',
+                'port'    : i_base_port + i,
+                'hostname': 'device{}'.format(i)
+            }
+            for i in (range(i_devices) if l_devices is None else l_devices)
+        ]
+    }
+    with open(s_path, 'w') as f:
+        json.dump(d_inventory, f)
+
+def run_fleet(s_inventory, i_concurrency, d_env):
+    """
+    Returns:
+        (wall time in s, peak rss of the poller in KB)
+    """
+    f_start = time.perf_counter()
+    s_output = subprocess.check_output([
+        sys.executable, os.path.join(S_SNMP_CHECKS, 'check_snmp_fleet.py'),
+        '-i', s_inventory, '-n', str(i_concurrency), '--dry-run'
+    ], env=d_env).decode('utf-8')
+    f_wall = time.perf_counter() - f_start
+    i_rss = int(re.search(r'max_rss=(\d+)B', s_output).group(1)) // 1024
+    if ' 0 did not answer' not in s_output:
+        raise RuntimeError('devices did not answer: ' + s_output.splitlines()[-1])
+    return f_wall, i_rss
+
+def get_sample(i_devices, i_fleet):
+    """
+    Returns:
+        i_devices devices spread over a fleet of i_fleet, so the sample has
+        the same mix of types
+    """
+    return sorted(set(i * i_fleet // i_devices for i in range(i_devices)))
+
+def run_processes(l_devices, i_fleet, i_base_port, i_concurrency, d_env):
+    """
+    Runs one check process per device and command, like separate icinga
+    services did.
+
+    Returns:
+        wall time in s
+    """
+    d_modules = get_check_modules()
+    l_commands = []
+    for i in l_devices:
+        i_port = i_base_port + i
+        if get_device_type(i, i_fleet) == 'synology':
+            for s_command in d_modules['synology'][0].checks:
+                l_commands.append([
+                    'check_synology_snmp.py', '-u', D_USER['user'], '-p', D_USER['authPasswd'],
+                    '-C', s_command, '-H', '127.0.0.1', '-P', str(i_port)
+                ])
+        else:
+            for s_command in d_modules['imm2'][0].checks:
+                l_commands.append([
+                    'check_imm2.py', '-u', D_USER['user'], '-l', D_USER['level'], '-a', D_USER['authAlgo'],
+                    '-A', D_USER['authPasswd'], '-x', D_USER['privAlgo'], '-X', D_USER['privPasswd'],
+                    '-C', s_command, '-H', '127.0.0.1', '-P', str(i_port)
+                ])
+    f_start = time.perf_counter()
+    l_running = []
+    for l_command in l_commands:
+        while len(l_running) >= i_concurrency:
+            l_running.pop(0).wait()
+        l_running.append(subprocess.Popen(
+            [sys.executable, os.path.join(S_SNMP_CHECKS, l_command[0])] + l_command[1:],
+            env=d_env, stdout=subprocess.DEVNULL
+        ))
+    for process in l_running:
+        process.wait()
+    return time.perf_counter() - f_start
+
+def get_commit():
+    """Returns: short hash of the checked out commit, with -dirty if changed"""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=S_ROOT, stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(s_old, s_new):
+    """Prints a comparison of two result files"""
+    with open(s_old) as f:
+        d_old = json.load(f)
+    with open(s_new) as f:
+        d_new = json.load(f)
+    print('{:<14} {:>12} {:>12} {:>8} {:>14} {:>14}'.format(
+        'case', 'old dev/s', 'new dev/s', 'speedup', 'old KB/device', 'new KB/device'
+    ))
+    for s_case in sorted(set(d_old['cases']) | set(d_new['cases'])):
+        d_o = d_old['cases'].get(s_case)
+        d_n = d_new['cases'].get(s_case)
+        if not d_o or not d_n:
+            print('{:<14} only in {}'.format(s_case, d_old['commit'] if d_o else d_new['commit']))
+            continue
+        print('{:<14} {:>12.1f} {:>12.1f} {:>7.2f}x {:>14} {:>14}'.format(
+            s_case,
+            d_o['devices_per_s'],
+            d_n['devices_per_s'],
+            d_n['devices_per_s'] / d_o['devices_per_s'] if d_o['devices_per_s'] else float('inf'),
+            d_o.get('rss_per_device_kb', '-'),
+            d_n.get('rss_per_device_kb', '-')
+        ))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks check_snmp_fleet.py against simulated IMM2 and Synology agents.')
+    parser.add_argument('-k', '--keyword', type=str, default='', help='only run cases containing this string')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='timed runs per case, default 3')
+    parser.add_argument('-d', '--devices', type=int, default=640, help='devices in the fleet, a tenth of them Synology, default 640')
+    parser.add_argument('-l', '--latency', type=float, default=0.005, help='seconds an agent takes per answer, default 0.005')
+    parser.add_argument('-p', '--base-port', type=int, default=17000, help='UDP port of the first agent, default 17000')
+    parser.add_argument('-o', '--output', type=str, help='result file, default benchmarks/results/snmp_fleet_<commit>.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('--agent', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    if args.agent:
+        run_agents(args.devices, args.base_port, args.latency)
+        return
+
+    s_work = tempfile.mkdtemp(prefix='bench_snmp_fleet')
+    d_env = dict(os.environ, ICINGA2CHECKS_STATE_DIR=os.path.join(s_work, 'state'))
+    agent = subprocess.Popen([
+        sys.executable, os.path.realpath(__file__), '--agent', '--devices', str(args.devices),
+        '--base-port', str(args.base_port), '--latency', str(args.latency)
+    ], stdout=subprocess.PIPE)
+    d_results = {
+        'commit'   : get_commit(),
+        'python'   : sys.version.split()[0],
+        'time'     : int(time.time()),
+        'repeat'   : args.repeat,
+        'devices'  : args.devices,
+        'latency_s': args.latency,
+        'cases'    : {}
+    }
+    try:
+        if agent.stdout.readline().strip() != b'ready':
+            raise RuntimeError('simulated agents did not start')
+        s_inventory = os.path.join(s_work, 'inventory.json')
+        s_single = os.path.join(s_work, 'single.json')
+        write_inventory(s_inventory, args.devices, args.base_port)
+        write_inventory(s_single, args.devices, args.base_port, [args.devices - 1])
+        # discovers every engine and localizes the keys once, like the
+        # first interval of a real fleet
+        run_fleet(s_inventory, 256, d_env)
+        f_wall, i_rss_single = run_fleet(s_single, 1, d_env)
+
+        for s_case, (s_description, i_concurrency, f_share) in sorted(D_CASES.items()):
+            if args.keyword not in s_case:
+                continue
+            i_devices = max(1, int(args.devices * f_share))
+            l_times = []
+            l_rss = []
+            for i in range(args.repeat):
+                if s_case.startswith('fleet'):
+                    f_wall, i_rss = run_fleet(s_inventory, i_concurrency, d_env)
+                    l_rss.append(i_rss)
+                else:
+                    f_wall = run_processes(
+                        get_sample(i_devices, args.devices), args.devices, args.base_port, i_concurrency, d_env
+                    )
+                l_times.append(f_wall)
+            d_result = {
+                'description'  : s_description,
+                'devices'      : i_devices,
+                'wall_median_s': round(statistics.median(l_times), 3),
+                'devices_per_s': round(i_devices / statistics.median(l_times), 1)
+            }
+            if l_rss:
+                d_result['peak_rss_kb'] = max(l_rss)
+                d_result['rss_per_device_kb'] = round((max(l_rss) - i_rss_single) / max(1, i_devices - 1), 2)
+            d_results['cases'][s_case] = d_result
+            print('{:<14} {:>8.1f} devices/s {:>10} KB/device  {}'.format(
+                s_case, d_result['devices_per_s'], d_result.get('rss_per_device_kb', '-'), s_description
+            ))
+    finally:
+        agent.kill()
+        agent.wait()
+        shutil.rmtree(s_work, ignore_errors=True)
+
+    s_output = args.output or os.path.join(S_RESULTS_DIR, 'snmp_fleet_' + d_results['commit'] + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(s_output)), exist_ok=True)
+    with open(s_output, 'w') as f:
+        json.dump(d_results, f, indent=2, sort_keys=True)
+    print('results written to {}'.format(s_output))
+
+if __name__ == '__main__':
+    main()
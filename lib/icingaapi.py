@@ -0,0 +1,173 @@
+"""
+Minimal client for the Icinga 2 REST API, used by checks that submit
+passive check results.
+
+All results are sent over one keep-alive connection. The requests are
+pipelined: every request is written before the first response is read, so
+submitting a batch costs a single round trip. If the API closes the
+connection in between, the results that were not answered are sent again
+on a new connection.
+
+    api = IcingaAPI('https://icinga.example.com:5665', 'user', 'secret')
+    lErrors = api.processCheckResults([
+        {'host': 'web1', 'service': 'disk', 'exitStatus': 0,
+         'output': 'OK', 'perfdata': '/=12%'}
+    ])
+"""
+
+import base64
+import http.client
+import json
+import socket
+import ssl
+from urllib.parse import urlsplit
+
+sProcessCheckResult = '/v1/actions/process-check-result'
+
+class _NonClosingReader:
+    """Hands the shared buffered reader of the connection to one response
+    after the other. http.client closes the reader of a response once its
+    body was read, which must not close the connection."""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def __getattr__(self, sName):
+        return getattr(self.fp, sName)
+
+    def close(self):
+        pass
+
+class _PipelinedSocket:
+    """stands in for the socket when http.client parses a response"""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def makefile(self, *args, **kwargs):
+        return _NonClosingReader(self.fp)
+
+def formatResult(dResult):
+    """Takes: dResult = {host, service (None for a host check), exitStatus,
+                         output, perfdata, checkSource (optional)}
+    Returns: request body for process-check-result"""
+    dBody = {
+        'type': 'Service' if dResult.get('service') else 'Host',
+        'filter': 'host.name==h',
+        'filter_vars': {'h': dResult['host']},
+        'exit_status': dResult['exitStatus'],
+        'plugin_output': dResult['output'],
+        'performance_data': dResult.get('perfdata', ''),
+        'check_source': dResult.get('checkSource') or socket.getfqdn()
+    }
+    if dResult.get('service'):
+        dBody['filter'] += ' && service.name==s'
+        dBody['filter_vars']['s'] = dResult['service']
+    return dBody
+
+class IcingaAPI:
+    """submits passive check results to the Icinga 2 API"""
+
+    def __init__(self, sUrl, sUser, sPassword, sCaFile=None, bVerify=True, fTimeout=30.0):
+        """Takes: sUrl      = base url of the API, e.g. https://icinga:5665
+                  sUser     = API user
+                  sPassword = password of the API user
+                  sCaFile   = CA certificate of the Icinga cluster, None for
+                              the system CAs
+                  bVerify   = False to not verify the certificate at all
+                  fTimeout  = seconds to wait for the API"""
+        dUrl = urlsplit(sUrl)
+        self.bTls     = dUrl.scheme == 'https'
+        self.sHost    = dUrl.hostname
+        self.iPort    = dUrl.port or (5665 if self.bTls else 80)
+        self.sPrefix  = dUrl.path.rstrip('/')
+        self.fTimeout = fTimeout
+        self.sAuth    = base64.b64encode('{}:{}'.format(sUser, sPassword).encode('utf-8')).decode('ascii')
+        self.context  = None
+        if self.bTls:
+            self.context = ssl.create_default_context(cafile=sCaFile)
+            if not bVerify:
+                self.context.check_hostname = False
+                self.context.verify_mode = ssl.CERT_NONE
+
+    def connect(self):
+        """Returns: connected socket"""
+        sock = socket.create_connection((self.sHost, self.iPort), self.fTimeout)
+        if self.bTls:
+            sock = self.context.wrap_socket(sock, server_hostname=self.sHost)
+        return sock
+
+    def formatRequest(self, sPath, dBody):
+        """Returns: a complete HTTP request as bytes"""
+        bBody = json.dumps(dBody).encode('utf-8')
+        lHeaders = [
+            'POST {}{} HTTP/1.1'.format(self.sPrefix, sPath),
+            'Host: {}:{}'.format(self.sHost, self.iPort),
+            'Authorization: Basic ' + self.sAuth,
+            'Accept: application/json',
+            'Content-Type: application/json',
+            'Content-Length: {}'.format(len(bBody)),
+            'Connection: keep-alive'
+        ]
+        return ('\r\n'.join(lHeaders) + '\r\n\r\n').encode('utf-8') + bBody
+
+    def post(self, sPath, lBodies):
+        """Sends all requests pipelined over as few connections as possible.
+        Takes: sPath   = API endpoint
+               lBodies = list of request bodies
+        Returns: list with (status, parsed response body) for every request,
+        (None, error message) if a request could not be sent"""
+        lRequests  = [self.formatRequest(sPath, dBody) for dBody in lBodies]
+        lResponses = []
+
+        while len(lResponses) < len(lRequests):
+            iDone = len(lResponses)
+            try:
+                sock = self.connect()
+            except OSError:
+                break
+            try:
+                sock.sendall(b''.join(lRequests[iDone:]))
+                fp = sock.makefile('rb')
+                for i in range(iDone, len(lRequests)):
+                    response = http.client.HTTPResponse(_PipelinedSocket(fp))
+                    response.begin()
+                    bBody = response.read()
+                    try:
+                        body = json.loads(bBody.decode('utf-8'))
+                    except ValueError:
+                        body = bBody.decode('utf-8', 'replace')
+                    lResponses.append((response.status, body))
+                    if response.will_close:
+                        break
+            except (OSError, http.client.HTTPException):
+                pass
+            finally:
+                sock.close()
+            # a connection that did not answer anything will not do better
+            # on the next try
+            if len(lResponses) == iDone:
+                break
+
+        for i in range(len(lResponses), len(lRequests)):
+            lResponses.append((None, 'could not reach the Icinga API at {}:{}'.format(self.sHost, self.iPort)))
+        return lResponses
+
+    def processCheckResults(self, lResults):
+        """Submits passive check results.
+        Takes: lResults = list of dicts, see formatResult
+        Returns: list of error messages, None for every result that was
+        accepted"""
+        lErrors = []
+        for iStatus, body in self.post(sProcessCheckResult, [formatResult(d) for d in lResults]):
+            if iStatus == 200 and isinstance(body, dict) and all(
+                int(dResult.get('code', 0)) == 200 for dResult in body.get('results', [])
+            ) and body.get('results'):
+                lErrors.append(None)
+            elif iStatus is None:
+                lErrors.append(body)
+            elif isinstance(body, dict):
+                lErrors.append('{} {}'.format(iStatus, body.get('status') or body.get('results')))
+            else:
+                lErrors.append('{} {}'.format(iStatus, body))
+        return lErrors
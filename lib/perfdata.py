@@ -0,0 +1,110 @@
+"""
+Performance data writer shared by all checks.
+
+Values are formatted once when they are added and kept in a list, which is
+joined a single time when the output is built. Labels are quoted as the
+monitoring plugins guidelines require, and the whole performance data is
+capped at a maximum length, so a host with thousands of devices can not
+produce an output that Icinga chokes on.
+
+    perfdata = PerfdataWriter()
+    perfdata.add('/ used', 1234, 'B', warn=80, crit=90, minimum=0)
+    print(perfdata.formatOutput('OK - everything fine'))
+"""
+
+import math
+
+# Icinga does not limit the output, but huge outputs slow down the API,
+# the IDO and every graphing backend
+iDefaultMaxLength = 65536
+
+def formatLabel(sLabel):
+    """Takes: sLabel = label of a value, any string
+    Returns: label as it can be put into performance data. Equal signs are
+    not allowed at all, single quotes are doubled and labels with spaces or
+    quotes are quoted."""
+    sLabel = str(sLabel).replace('=', '_')
+    if ' ' in sLabel or "'" in sLabel or '"' in sLabel or not sLabel:
+        sLabel = "'{}'".format(sLabel.replace("'", "''"))
+    return sLabel
+
+def formatValue(value):
+    """Takes: value = int, float, bool or a string containing a number
+    Returns: value as string, None if value is not a finite number"""
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, str):
+        sValue = value.strip()
+        try:
+            fValue = float(sValue)
+        except ValueError:
+            return None
+        return sValue if math.isfinite(fValue) else None
+    try:
+        fValue = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(fValue):
+        return None
+    if fValue.is_integer():
+        return str(int(fValue))
+    return '{:.6f}'.format(fValue).rstrip('0').rstrip('.')
+
+class PerfdataWriter:
+    """collects performance data and builds the performance data string"""
+
+    def __init__(self, iMaxLength=iDefaultMaxLength):
+        """Takes: iMaxLength = maximum length of the performance data"""
+        self.lItems     = []
+        self.iLength    = 0
+        self.iMaxLength = iMaxLength
+        self.iDropped   = 0
+        self.iSkipped   = 0
+
+    def __len__(self):
+        return len(self.lItems)
+
+    def __str__(self):
+        return ' '.join(self.lItems)
+
+    def add(self, sLabel, value, sUnit='', warn=None, crit=None, minimum=None, maximum=None):
+        """Adds a single value.
+        Takes: sLabel  = label of the value
+               value   = the value, see formatValue
+               sUnit   = unit of measurement, e.g. %, s, B or c
+               warn, crit, minimum, maximum = optional thresholds and range
+        Returns: True if the value was added. Values that are not numbers
+        are skipped, values that do not fit into the maximum length are
+        dropped."""
+        sValue = formatValue(value)
+        if sValue is None:
+            self.iSkipped += 1
+            return False
+
+        lFields = [sValue + sUnit]
+        for extra in (warn, crit, minimum, maximum):
+            sExtra = '' if extra is None else formatValue(extra)
+            lFields.append(sExtra or '')
+        sItem = '{}={}'.format(formatLabel(sLabel), ';'.join(lFields).rstrip(';'))
+
+        iLength = self.iLength + len(sItem) + (1 if self.lItems else 0)
+        if iLength > self.iMaxLength:
+            self.iDropped += 1
+            return False
+        self.lItems.append(sItem)
+        self.iLength = iLength
+        return True
+
+    def formatOutput(self, sOutput, sSeparator=' | '):
+        """Takes: sOutput    = check output without performance data
+                  sSeparator = separator between output and performance data
+        Returns: complete check output. If values had to be dropped, a note
+        is added to the output."""
+        if self.iDropped:
+            sOutput += '\n{} performance values dropped, performance data exceeds {} characters'.format(
+                self.iDropped,
+                self.iMaxLength
+            )
+        return sOutput + sSeparator + str(self)
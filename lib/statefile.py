@@ -0,0 +1,95 @@
+"""
+State that checks keep between two runs.
+
+All state lives in one directory, /var/tmp/icinga2checks by default, which
+can be changed with the environment variable ICINGA2CHECKS_STATE_DIR.
+State is only ever an optimization or a baseline for rates, so failing to
+read or write it is never an error: readState returns None and writeState
+returns False.
+
+Checks that share an expensive refresh serialise it with lockState, so only
+one of them does the work while the others wait for its result.
+"""
+
+import contextlib
+import fcntl
+import os
+import tempfile
+import time
+
+sDefaultStateDir = '/var/tmp/icinga2checks'
+
+def getStateDir():
+    """Returns: directory all state files are kept in"""
+    return os.environ.get('ICINGA2CHECKS_STATE_DIR', sDefaultStateDir)
+
+def getStatePath(sName):
+    """Takes: sName = name of the state, for example check_network
+    Returns: absolute path of the state file"""
+    return os.path.join(getStateDir(), sName + '.state')
+
+def readState(sName):
+    """Takes: sName = name of the state
+    Returns: content of the state file as bytes, None if there is none"""
+    try:
+        with open(getStatePath(sName), 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def writeState(sName, bData):
+    """Atomically replaces the state file, so a check running concurrently
+    never reads a half written state.
+    Takes: sName = name of the state
+           bData = new content as bytes
+    Returns: True if the state was written"""
+    sPath = getStatePath(sName)
+    try:
+        os.makedirs(os.path.dirname(sPath), exist_ok=True)
+        iFd, sTmpPath = tempfile.mkstemp(dir=os.path.dirname(sPath), prefix='.' + sName)
+        try:
+            with os.fdopen(iFd, 'wb') as f:
+                f.write(bData)
+            os.replace(sTmpPath, sPath)
+        except OSError:
+            os.unlink(sTmpPath)
+            raise
+    except OSError:
+        return False
+    return True
+
+@contextlib.contextmanager
+def lockState(sName, fTimeout=None):
+    """Holds an exclusive lock on a state while the with block runs. The
+    lock is released by the kernel if the process dies.
+    Takes: sName    = name of the state
+           fTimeout = seconds to wait for the lock, None to wait forever
+    Yields: True if the lock is held, False if it could not be taken in
+    time. If the lock file can not be created at all, True is yielded, as
+    state is only an optimization."""
+    sPath = os.path.join(getStateDir(), sName + '.lock')
+    try:
+        os.makedirs(os.path.dirname(sPath), exist_ok=True)
+        iFd = os.open(sPath, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        yield True
+        return
+    try:
+        if fTimeout is None:
+            fcntl.flock(iFd, fcntl.LOCK_EX)
+            bLocked = True
+        else:
+            fDeadline = time.monotonic() + fTimeout
+            while True:
+                try:
+                    fcntl.flock(iFd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    bLocked = True
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= fDeadline:
+                        bLocked = False
+                        break
+                    time.sleep(0.05)
+        yield bLocked
+    finally:
+        os.close(iFd)
@@ -2,17 +2,92 @@
 """
 This check combines memory, load, disk and network checks.
 
+Can also run as a resident collector daemon (--daemon) that keeps the latest
+results in memory, see check_client.py, or collect all checks at once and
+submit them as passive check results to the Icinga 2 API (--batch).
+
 This file is under Apache 2.0 License
 
 Copyright C-Store 2016
 Author Mattis Haase
 """
 
+from collections import OrderedDict
 from operator import itemgetter
 import argparse
+import fnmatch
+import heapq
+import json
+import os
+import queue
+import re
+import socket
+import socketserver
+import stat
+import struct
+import sys
+import threading
+import time
 
 import psutil
 
+# shared modules live in lib/ at the top of the repository
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import lib.icingaapi
+import lib.perfdata
+import lib.statefile
+
+# default UNIX socket of the collector daemon, see check_client.py
+S_DEFAULT_SOCKET = '/var/tmp/icinga2checks/check.sock'
+# seconds between two collections of the same check in daemon mode
+D_DAEMON_INTERVALS = {'cpu': 30, 'memory': 30, 'disk': 60, 'network': 30}
+# daemon drops checks that were not requested for this many intervals
+I_DAEMON_EXPIRY = 10
+# daemon refuses results older than this many intervals
+I_DAEMON_STALE = 3
+# arguments that only configure the daemon and are not part of a check
+L_DAEMON_ARGUMENTS = ['daemon', 'socket', 'interval']
+# arguments that only configure the batch mode
+L_BATCH_ARGUMENTS = [
+    'batch', 'hostname', 'service', 'threshold',
+    'api_url', 'api_user', 'api_password', 'api_ca', 'api_insecure'
+]
+# counters of psutil.net_io_counters in the order they are stored in the
+# network state file
+L_NET_FIELDS = [
+    'bytes_sent', 'bytes_recv', 'packets_sent', 'packets_recv',
+    'errin', 'errout', 'dropin', 'dropout'
+]
+# network state file: header with time of the snapshot, boot time and number
+# of interfaces, then per interface the length of its name, the name and the
+# counters
+S_NET_HEADER = '<ddI'
+S_NET_RECORD = '<{}Q'.format(len(L_NET_FIELDS))
+# cpu state file: header with time of the snapshot, boot time, number of
+# cores, number of fields and length of the field names, then the comma
+# separated field names and all cpu times of all cores as one array
+S_CPU_HEADER = '<ddIII'
+# cpu snapshots older than this many seconds are not used
+I_CPU_SNAPSHOT_MAX_AGE = 600
+# guest times are already contained in user and nice on linux
+L_CPU_GUEST_FIELDS = ['guest', 'guest_nice']
+# how top consumers are called in the check output, by grouping
+D_TOP_GROUP_NAMES = {'pid': 'processes', 'user': 'users', 'name': 'programs', 'cgroup': 'cgroups'}
+# parallel statvfs calls of the disk check
+I_DISK_WORKERS = 16
+# seconds the cpu usage of the processes is measured over for --top
+F_TOP_INTERVAL = 0.5
+# mountpoints whose statvfs is still blocked from an earlier check, only
+# matters in daemon mode
+S_HUNG_MOUNTS    = set()
+LOCK_HUNG_MOUNTS = threading.Lock()
+# commands of a batch run, in the order they are collected
+L_BATCH_COMMANDS = ['cpu', 'memory', 'disk', 'network']
+# plugin exit codes
+D_EXITCODES = {'OK': 0, 'WARNING': 1, 'CRITICAL': 2, 'UNKNOWN': 3}
+# status sorted from best to worst
+L_STATUS_ORDER = ['OK', 'UNKNOWN', 'WARNING', 'CRITICAL']
+
 def test_int(*args):
     for arg in args:
         assert type(arg) is int, 'should be Type Int'
@@ -29,19 +104,6 @@ def test_string(*args):
     for arg in args:
         assert type(arg) is str, 'should be Type String'
         
-def add_perfdata(s_perfdata, s_prefix, s_key, value):
-    test_string(s_perfdata, s_prefix, s_key)
-    test_int_or_float(value)
-    
-    if s_perfdata: s_perfdata += ' '
-    s_perfdata += '{}.{}={}'.format(
-        s_prefix,
-        s_key,
-        value
-    )
-    
-    return s_perfdata
-
 def check_status(i_warning, i_critical, value):
     """
     Checks if status is OK, WARNING or CRITICAL
@@ -67,6 +129,16 @@ def check_status(i_warning, i_critical, value):
     else:
         return 'UNKNOWN'
 
+def worst_status(*args):
+    """
+    Gets:
+        args: any number of 'OK'|'WARNING'|'CRITICAL'|'UNKNOWN'
+    
+    Returns:
+        the worst of the given status
+    """
+    return max(args, key=L_STATUS_ORDER.index)
+
 def calculate_percent(d_values):
     """
     Calculates percentages of all values in a dict.
@@ -88,15 +160,291 @@ def calculate_percent(d_values):
         d_percentages[key] = round(100*value/summed, 2)
     return(d_percentages)
 
-def check_load_or_memory(i_warning, i_critical, s_command):
+def pack_cpu_times(f_time, f_boot_time, l_fields, l_cpu_times):
+    """
+    Packs per core cpu times into the binary cpu state format
+    
+    Gets:
+        f_time: time of the snapshot
+        f_boot_time: boot time of the system
+        l_fields: names of the cpu time fields
+        l_cpu_times: result of psutil.cpu_times(percpu=True)
+    
+    Returns:
+        bytes
+    """
+    b_fields = ','.join(l_fields).encode('utf-8')
+    l_values = [value for nt_times in l_cpu_times for value in nt_times]
+    return (
+        struct.pack(S_CPU_HEADER, f_time, f_boot_time, len(l_cpu_times), len(l_fields), len(b_fields))
+        + b_fields
+        + struct.pack('<{}d'.format(len(l_values)), *l_values)
+    )
+
+def unpack_cpu_times(b_data):
+    """
+    Unpacks the binary cpu state format
+    
+    Gets:
+        b_data: bytes written by pack_cpu_times
+    
+    Returns:
+        (time of the snapshot, boot time, field names, list of per core
+        tuples) or None if b_data is empty or damaged
+    """
+    if not b_data:
+        return None
+    try:
+        f_time, f_boot_time, i_cores, i_fields, i_length = struct.unpack_from(S_CPU_HEADER, b_data)
+        i_offset = struct.calcsize(S_CPU_HEADER)
+        l_fields = b_data[i_offset:i_offset + i_length].decode('utf-8').split(',')
+        t_values = struct.unpack_from('<{}d'.format(i_cores * i_fields), b_data, i_offset + i_length)
+    except (struct.error, UnicodeDecodeError):
+        return None
+    l_cpu_times = [t_values[i:i + i_fields] for i in range(0, len(t_values), i_fields)]
+    return f_time, f_boot_time, l_fields, l_cpu_times
+
+def calculate_cpu_usage(l_fields, l_previous, l_current):
+    """
+    Calculates cpu usage between two cpu_times(percpu=True) readings in a
+    single pass over all cores
+    
+    Gets:
+        l_fields: names of the cpu time fields
+        l_previous: earlier per core reading
+        l_current: later per core reading
+    
+    Returns:
+        (dict of field: percent over all cores, list of busy percent per
+        core) or None if a core did not advance, then the readings are
+        unusable
+    """
+    l_counted = [key not in L_CPU_GUEST_FIELDS for key in l_fields]
+    i_idle    = l_fields.index('idle')
+    l_sums    = [0.0] * len(l_fields)
+    l_busy    = []
+    
+    for t_previous, t_current in zip(l_previous, l_current):
+        l_delta = [max(current - previous, 0.0) for previous, current in zip(t_previous, t_current)]
+        f_total = sum(delta for delta, b_counted in zip(l_delta, l_counted) if b_counted)
+        if f_total <= 0:
+            return None
+        l_busy.append(round(100 - 100 * l_delta[i_idle] / f_total, 2))
+        l_sums = [summed + delta for summed, delta in zip(l_sums, l_delta)]
+    
+    d_percentages = calculate_percent({
+        key: value for key, value, b_counted in zip(l_fields, l_sums, l_counted) if b_counted
+    })
+    return d_percentages, l_busy
+
+def get_cpu_usage(f_sample):
+    """
+    Gets cpu usage since the last run from the cpu state file. If there is
+    no usable snapshot, cpu usage is sampled for f_sample seconds instead.
+    
+    Gets:
+        f_sample: seconds to sample when there is no usable snapshot
+    
+    Returns:
+        (dict of field: percent over all cores, list of busy percent per core)
+    """
+    f_now       = time.time()
+    f_boot_time = psutil.boot_time()
+    l_current   = psutil.cpu_times(percpu=True)
+    l_fields    = list(l_current[0]._fields)
+    
+    t_previous = unpack_cpu_times(lib.statefile.readState('check_cpu'))
+    lib.statefile.writeState('check_cpu', pack_cpu_times(f_now, f_boot_time, l_fields, l_current))
+    
+    t_usage = None
+    if (
+        t_previous is not None
+        and t_previous[2] == l_fields
+        and len(t_previous[3]) == len(l_current)
+        and abs(t_previous[1] - f_boot_time) <= 2
+        and 0 < f_now - t_previous[0] <= I_CPU_SNAPSHOT_MAX_AGE
+    ):
+        t_usage = calculate_cpu_usage(l_fields, t_previous[3], l_current)
+    
+    while t_usage is None:
+        l_previous = l_current
+        time.sleep(f_sample)
+        l_current  = psutil.cpu_times(percpu=True)
+        lib.statefile.writeState('check_cpu', pack_cpu_times(time.time(), f_boot_time, l_fields, l_current))
+        t_usage    = calculate_cpu_usage(l_fields, l_previous, l_current)
+    
+    return t_usage
+
+def get_cgroup(i_pid):
     """
-    This checks for CPU or memory %. If WARNING or CRITICAL, also outputs top
-    five processes which are using most CPU/memory
+    Gets:
+        i_pid: process id
+    
+    Returns:
+        cgroup of the process, the unified hierarchy if there is one,
+        '?' if the cgroup can not be read
+    """
+    s_cgroup = '?'
+    try:
+        with open('/proc/{}/cgroup'.format(i_pid)) as f:
+            for s_line in f:
+                # format hierarchy-ID:controller-list:cgroup-path
+                l_line = s_line.rstrip('\n').split(':', 2)
+                if len(l_line) != 3:
+                    continue
+                if l_line[0] == '0' and not l_line[1]:
+                    return l_line[2]
+                if s_cgroup == '?':
+                    s_cgroup = l_line[2]
+    except OSError:
+        pass
+    return s_cgroup
+
+def prime_cpu_percent():
+    """
+    Starts the cpu measurement of every process. The first cpu_percent()
+    of a process always returns 0.0, the next one returns the usage since
+    this call. process_iter keeps the Process objects, so the next scan
+    gets the usage since now.
+    """
+    for proc in psutil.process_iter():
+        try:
+            proc.cpu_percent(None)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+
+def get_top_processes(l_keys, i_top=5, s_group='pid', f_interval=None):
+    """
+    Finds the top consuming processes for one or more keys in a single scan
+    over all processes. Every process is read once with only the attributes
+    that are needed. Processes that vanish or deny access are skipped.
+    For s_group pid only a heap of i_top processes per key is kept, so memory
+    does not grow with the number of processes.
+    
+    Gets:
+        l_keys: process attributes to rank by, e.g. ['memory_percent']
+        i_top: number of processes or groups to return per key
+        s_group: pid | user | name | cgroup, what consumers are grouped by
+        f_interval: seconds the cpu usage of the processes is measured over,
+            only if cpu_percent is one of the keys. Default F_TOP_INTERVAL
+    
+    Returns:
+        dict of key: list of dicts, highest consumer first. For pid the
+        dicts contain username, pid, name and the keys, for groups they
+        contain group, processes and the keys
+    """
+    test_int(i_top)
+    test_string(s_group)
+    
+    d_heaps  = {key: [] for key in l_keys}
+    d_groups = {}
+    i_seen   = 0
+    
+    if 'cpu_percent' in l_keys:
+        prime_cpu_percent()
+        time.sleep(F_TOP_INTERVAL if f_interval is None else f_interval)
+    
+    for proc in psutil.process_iter(['pid', 'name', 'username'] + l_keys, ad_value=None):
+        try:
+            d_proc = proc.info
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+        i_seen += 1
+        
+        if s_group == 'pid':
+            for key in l_keys:
+                if d_proc[key] is None:
+                    continue
+                # i_seen breaks ties, so dicts never get compared
+                t_item = (d_proc[key], i_seen, d_proc)
+                if len(d_heaps[key]) < i_top:
+                    heapq.heappush(d_heaps[key], t_item)
+                elif t_item > d_heaps[key][0]:
+                    heapq.heapreplace(d_heaps[key], t_item)
+            continue
+        
+        if s_group == 'user':
+            s_name = d_proc['username']
+        elif s_group == 'name':
+            s_name = d_proc['name']
+        else:
+            s_name = get_cgroup(d_proc['pid'])
+        d_group = d_groups.setdefault(s_name, dict({key: 0.0 for key in l_keys}, group=s_name, processes=0))
+        d_group['processes'] += 1
+        for key in l_keys:
+            if d_proc[key] is not None:
+                d_group[key] += d_proc[key]
+    
+    if s_group == 'pid':
+        return {key: [t_item[2] for t_item in sorted(d_heaps[key], reverse=True)] for key in l_keys}
+    
+    d_top = {}
+    for key in l_keys:
+        d_top[key] = heapq.nlargest(i_top, d_groups.values(), key=itemgetter(key))
+        for d_group in d_top[key]:
+            d_group[key] = round(d_group[key], 2)
+    return d_top
+
+class TopProcesses:
+    """
+    Scans the processes at most once for several keys, and only when the
+    first key is asked for. Lets the cpu and memory checks of a batch run
+    share one process scan.
+    """
+    
+    def __init__(self, l_keys, i_top=5, s_group='pid', f_interval=None):
+        self.l_keys     = l_keys
+        self.i_top      = i_top
+        self.s_group    = s_group
+        self.f_interval = f_interval
+        self.d_top      = None
+    
+    def get(self, s_key):
+        if self.d_top is None:
+            self.d_top = get_top_processes(self.l_keys, self.i_top, self.s_group, self.f_interval)
+        return self.d_top[s_key]
+
+def format_top_processes(l_top, s_key, s_group):
+    """
+    Formats the result of get_top_processes for the check output
+    
+    Gets:
+        l_top: list of dicts for one key from get_top_processes
+        s_key: key the list is ranked by
+        s_group: pid | user | name | cgroup
+    
+    Returns:
+        header line and one line per process or group
+    """
+    s_label = s_key.split('_')[0] + '_Percent'
+    if s_group == 'pid':
+        l_lines = ['Username, PID, Program, {}'.format(s_label)]
+        for d_proc in l_top:
+            l_lines.append('{}, {}, {}, {}'.format(d_proc['username'], d_proc['pid'], d_proc['name'], d_proc[s_key]))
+    else:
+        l_lines = ['{}, Processes, {}'.format(s_group.capitalize(), s_label)]
+        for d_group in l_top:
+            l_lines.append('{}, {}, {}'.format(d_group['group'], d_group['processes'], d_group[s_key]))
+    return '\n'.join(l_lines) + '\n'
+
+def check_load_or_memory(i_warning, i_critical, s_command, i_core_warning=None, i_core_critical=None, f_sample=0.5, i_top=5, s_group='pid', top_processes=None):
+    """
+    This checks for CPU or memory %. If WARNING or CRITICAL, also outputs the
+    top i_top processes or groups of processes which are using most CPU/memory
     
     Gets:
         i_warning: Warning Threshold
         i_critical: Critical Threshold
         s_command: cpu | memory
+        i_core_warning: cpu only. Warning Threshold for the busiest core,
+            None to not check single cores
+        i_core_critical: cpu only. Critical Threshold for the busiest core
+        f_sample: cpu only. Seconds to sample if there is no cpu snapshot
+            from a previous run
+        i_top: number of top consumers to list
+        s_group: pid | user | name | cgroup, what top consumers are grouped by
+        top_processes: TopProcesses to share with other checks, None to
+            scan the processes for this check only
     
     Returns:
         check output including perfdata
@@ -106,7 +454,8 @@ def check_load_or_memory(i_warning, i_critical, s_command):
     test_string(s_command)
     
     s_output   = ''
-    s_perfdata = ''
+    perfdata   = lib.perfdata.PerfdataWriter()
+    s_reason   = ' over {} percent used.'.format(i_warning)
     
     if s_command.lower() == 'memory':
         od_values = psutil.virtual_memory()._asdict()
@@ -115,52 +464,207 @@ def check_load_or_memory(i_warning, i_critical, s_command):
     if s_command.lower() == 'cpu':
         # psutil.cpu_times_percent() returns 0.0 for all percentages on some
         # systems. cpu_times() seems to work everywhere. So we calculate 
-        # percentages ourselves
-        od_values = psutil.cpu_times()._asdict()
-        od_values = calculate_percent(od_values)
-        s_output = check_status(i_warning, i_critical, 100 - od_values['idle'])
+        # percentages ourselves, between the last and this run
+        od_values, l_busy = get_cpu_usage(f_sample)
+        s_output  = check_status(i_warning, i_critical, round(100 - od_values['idle'], 2))
+        i_busiest = l_busy.index(max(l_busy))
+        if i_core_warning is not None:
+            if i_core_critical is None:
+                i_core_critical = 100
+            s_core_output = check_status(i_core_warning, i_core_critical, l_busy[i_busiest])
+            if s_core_output != 'OK' and s_core_output == worst_status(s_output, s_core_output):
+                s_output = s_core_output
+                s_reason = ' core {} is {} percent busy.'.format(i_busiest, l_busy[i_busiest])
+        od_values['busiest_core'] = l_busy[i_busiest]
+        for i, f_busy in enumerate(l_busy):
+            od_values['core{}'.format(i)] = f_busy
     
     for key, value in od_values.items():
-        if s_perfdata: s_perfdata += ' '
-        s_perfdata += '{}={}'.format(key, value)
+        # cpu values are all percentages, memory values are bytes
+        if s_command.lower() == 'cpu' or key == 'percent':
+            perfdata.add(key, value, '%')
+        else:
+            perfdata.add(key, value, 'B')
     
     # If WARNING or CRITICAL, we add the top memory consuming processes to output
     if s_output != 'OK':
-        l_procs = []
-        
-        # this iterates over all procs, which is very fast
-        for proc in psutil.process_iter():
-            # adds memory_percent for command memory or cpu_percent for command
-            # cpu
-            l_procs.append(proc.as_dict(attrs=['username', 'pid', 'name', s_command.lower() + '_percent']))
-        
-        # sorting by either memory_percent or cpu_percent
-        l_procs = sorted(l_procs, key = itemgetter(s_command.lower() + '_percent'))
-        
-        # first line is header
-        s_procs = 'Username, PID, Program, {}_Percent\n'.format(s_command)
+        s_key = s_command.lower() + '_percent'
+        if top_processes is None:
+            top_processes = TopProcesses([s_key], i_top, s_group)
+        l_top = top_processes.get(s_key)
+        s_output += '{} Top {} consuming {}:\n\n {}'.format(
+            s_reason,
+            top_processes.i_top,
+            D_TOP_GROUP_NAMES[top_processes.s_group],
+            format_top_processes(l_top, s_key, top_processes.s_group)
+        )
         
-        # highest five processes get added to output
-        for d_proc in l_procs[0:5]:
-            test_string(d_proc['name'])
-            test_int(d_proc['pid'])
-            test_int_or_float(d_proc[s_command.lower() + '_percent'])
-            
-            s_procs += '{}, {}, {}, {}\n'.format(
-              d_proc['username'],
-              d_proc['pid'],
-              d_proc['name'],
-              d_proc[s_command.lower() + '_percent']
-            )
+    # adding performance data and done
+    return perfdata.formatOutput(s_output)
+
+def get_mount_ids():
+    """
+    Reads the device id of every mountpoint from /proc/self/mountinfo, so
+    bind mounts of the same filesystem can be recognized.
+    
+    Returns:
+        dict of mountpoint: 'major:minor', empty if there is no mountinfo
+    """
+    d_mount_ids = {}
+    try:
+        with open('/proc/self/mountinfo') as f:
+            for s_line in f:
+                # format mount-ID parent-ID major:minor root mountpoint ...
+                l_line = s_line.split(' ')
+                if len(l_line) > 4:
+                    s_mountpoint = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), l_line[4])
+                    d_mount_ids[s_mountpoint] = l_line[2]
+    except OSError:
+        pass
+    return d_mount_ids
+
+def filter_partitions(l_partitions, d_filters, s_partition):
+    """
+    Filters partitions by fstype and mountpoint patterns and keeps only one
+    mountpoint per filesystem, so bind mounts are counted once.
+    
+    Gets:
+        l_partitions: result of psutil.disk_partitions()
+        d_filters: dict with lists of shell patterns for include_fstype,
+            exclude_fstype, include_mount and exclude_mount. An empty
+            include list includes everything
+        s_partition: partition that is preferred when it is a bind mount
+    
+    Returns:
+        list of partitions
+    """
+    def matches(s_value, l_patterns):
+        return any(fnmatch.fnmatch(s_value, s_pattern) for s_pattern in l_patterns)
+    
+    d_mount_ids  = get_mount_ids()
+    d_filesystem = OrderedDict()
+    
+    for nt_partition in l_partitions:
+        if d_filters.get('include_fstype') and not matches(nt_partition.fstype, d_filters['include_fstype']):
+            continue
+        if matches(nt_partition.fstype, d_filters.get('exclude_fstype', [])):
+            continue
+        if d_filters.get('include_mount') and not matches(nt_partition.mountpoint, d_filters['include_mount']):
+            continue
+        if matches(nt_partition.mountpoint, d_filters.get('exclude_mount', [])):
+            continue
         
-        s_output += ' over {} percent used. Top five consuming processes:\n\n {}'.format(i_warning, s_procs)
+        # without mountinfo only real devices can be told apart, tmpfs and
+        # the like all share the same device name
+        if nt_partition.mountpoint in d_mount_ids:
+            s_filesystem = d_mount_ids[nt_partition.mountpoint]
+        elif nt_partition.device.startswith('/'):
+            s_filesystem = nt_partition.device
+        else:
+            s_filesystem = nt_partition.mountpoint
         
-    # adding performance data and done
-    s_output += ' | {}'.format(s_perfdata)
+        if s_filesystem not in d_filesystem or nt_partition.mountpoint == s_partition:
+            d_filesystem[s_filesystem] = nt_partition
+    
+    return list(d_filesystem.values())
+
+def get_disk_usages(l_mountpoints, f_timeout):
+    """
+    Gets disk usage of all mountpoints in parallel. statvfs on a stale
+    network mount blocks in the kernel and can not be interrupted, so every
+    mountpoint gets f_timeout seconds, after which it is given up and a new
+    worker takes its place. Mountpoints that are still blocked from an
+    earlier call are given up right away.
+    
+    Gets:
+        l_mountpoints: list of mountpoints
+        f_timeout: seconds to wait for a single mountpoint
+    
+    Returns:
+        (dict of mountpoint: disk usage dict or error message, list of
+        mountpoints that did not answer in time)
+    """
+    q_todo    = queue.Queue()
+    d_started = {}
+    d_results = {}
+    l_hung    = []
+    condition = threading.Condition()
+    
+    with LOCK_HUNG_MOUNTS:
+        for s_mountpoint in l_mountpoints:
+            if s_mountpoint in S_HUNG_MOUNTS:
+                l_hung.append(s_mountpoint)
+            else:
+                q_todo.put(s_mountpoint)
+    
+    def worker():
+        while True:
+            try:
+                s_mountpoint = q_todo.get_nowait()
+            except queue.Empty:
+                return
+            with condition:
+                d_started[s_mountpoint] = time.time()
+            try:
+                result = psutil.disk_usage(s_mountpoint)._asdict()
+            except OSError as e:
+                result = str(e)
+            with LOCK_HUNG_MOUNTS:
+                S_HUNG_MOUNTS.discard(s_mountpoint)
+            with condition:
+                d_results[s_mountpoint] = result
+                condition.notify()
+    
+    def start_worker():
+        # daemon threads, a blocked worker must not keep the plugin alive
+        threading.Thread(target=worker, daemon=True).start()
     
-    return s_output
+    i_pending = q_todo.qsize()
+    for i in range(min(I_DISK_WORKERS, i_pending)):
+        start_worker()
+    
+    with condition:
+        # a hung mountpoint may answer later and is then in both, count it once
+        while len(set(d_results) | set(l_hung)) < len(l_mountpoints):
+            f_now = time.time()
+            for s_mountpoint, f_started in list(d_started.items()):
+                if s_mountpoint not in d_results and f_now - f_started > f_timeout:
+                    del d_started[s_mountpoint]
+                    l_hung.append(s_mountpoint)
+                    with LOCK_HUNG_MOUNTS:
+                        S_HUNG_MOUNTS.add(s_mountpoint)
+                    start_worker()
+            condition.wait(0.05)
+    
+    # a hung mountpoint may have answered after all while we were waiting
+    for s_mountpoint in l_hung:
+        d_results.pop(s_mountpoint, None)
+    
+    return d_results, l_hung
 
-def check_disk(i_warning, i_critical, s_partition):
+def scan_partitions(s_partition, f_timeout=5.0, d_filters=None):
+    """
+    Lists, filters and measures all partitions
+    
+    Gets:
+        s_partition: partition that should be used to trigger WARNING/CRITICAL
+        f_timeout: seconds to wait for a single mountpoint
+        d_filters: see filter_partitions
+    
+    Returns:
+        dict with the partitions, their disk usage, the mountpoints that did
+        not answer and the disk io counters
+    """
+    l_partitions   = filter_partitions(psutil.disk_partitions(), d_filters or {}, s_partition)
+    d_usage, l_hung = get_disk_usages([nt_partition.mountpoint for nt_partition in l_partitions], f_timeout)
+    return {
+        'partitions' : l_partitions,
+        'usage'      : d_usage,
+        'hung'       : l_hung,
+        'io_counters': psutil.disk_io_counters(perdisk=True)
+    }
+
+def check_disk(i_warning, i_critical, s_partition, f_timeout=5.0, d_filters=None, d_scan=None):
     """
     Checks for disk stats
     
@@ -168,6 +672,9 @@ def check_disk(i_warning, i_critical, s_partition):
         i_warning: Warning Threshold
         i_critical: Critical Threshold
         s_partition: partition that should be used to trigger WARNING/CRITICAL
+        f_timeout: seconds to wait for a single mountpoint
+        d_filters: see filter_partitions
+        d_scan: result of scan_partitions, None to scan now
     
     Returns:
         check output including perfdata
@@ -175,27 +682,54 @@ def check_disk(i_warning, i_critical, s_partition):
     test_int(i_warning, i_critical)
     test_string(s_partition)
     
-    s_perfdata                  = ''
-    s_output                    = ''
-    l_partitions                = psutil.disk_partitions()
-    d_io_counters               = psutil.disk_io_counters(perdisk=True)
-    f_monitored_partition_usage = 0.0
+    if d_scan is None:
+        d_scan = scan_partitions(s_partition, f_timeout, d_filters)
+    
+    perfdata                    = lib.perfdata.PerfdataWriter()
+    s_output                    = 'UNKNOWN'
+    s_message                   = ' {} was not found.'.format(s_partition)
+    l_partitions                = d_scan['partitions']
+    d_io_counters               = d_scan['io_counters']
+    l_unreadable                = []
     
     for nt_partition in l_partitions:
-        # get usage for every partition
-        d_disk_usage = psutil.disk_usage(nt_partition.mountpoint)._asdict()
+        if nt_partition.mountpoint in d_scan['hung']:
+            l_unreadable.append('{} did not answer within {} seconds'.format(nt_partition.mountpoint, f_timeout))
+            if nt_partition.mountpoint == s_partition:
+                s_message = ' {} did not answer.'.format(s_partition)
+            continue
+        d_disk_usage = d_scan['usage'][nt_partition.mountpoint]
+        if not isinstance(d_disk_usage, dict):
+            l_unreadable.append('{} could not be read: {}'.format(nt_partition.mountpoint, d_disk_usage))
+            if nt_partition.mountpoint == s_partition:
+                s_message = ' {} could not be read.'.format(s_partition)
+            continue
         # add all usage data to perfdata
         for key, value in d_disk_usage.items():
-            s_perfdata = add_perfdata(s_perfdata, nt_partition.mountpoint, key, value)
+            s_label = '{}.{}'.format(nt_partition.mountpoint, key)
+            if key != 'percent':
+                perfdata.add(s_label, value, 'B')
+            elif nt_partition.mountpoint == s_partition:
+                perfdata.add(s_label, value, '%', i_warning, i_critical, 0, 100)
+            else:
+                perfdata.add(s_label, value, '%')
         
         # check monitored partition and add status to output
         if nt_partition.mountpoint == s_partition:
-            s_output = check_status(i_warning, i_critical, d_disk_usage['percent'])
-            f_monitored_partition_usage = d_disk_usage['percent']
+            s_output  = check_status(i_warning, i_critical, d_disk_usage['percent'])
+            s_message = ' {} has a usage of {} percent.'.format(s_partition, d_disk_usage['percent'])
+    
+    # partitions that can not be read make the whole check UNKNOWN, the
+    # other partitions are still reported
+    if l_unreadable:
+        s_output = worst_status(s_output, 'UNKNOWN')
     
     # add message if status is not OK
     if not 'OK' in s_output:
-        s_output += ' {} has a usage of {} percent.'.format(s_partition, f_monitored_partition_usage)
+        s_output += s_message
+    
+    for s_unreadable in l_unreadable:
+        s_output += '\n' + s_unreadable
     
     # add all the mountpoints and other info to output
     for nt_partition in l_partitions:
@@ -212,53 +746,231 @@ def check_disk(i_warning, i_critical, s_partition):
         d_partition = nt_partition._asdict()
         # add all io_counters to perfdata
         for key, value in d_partition.items():
-            s_perfdata = add_perfdata(s_perfdata, s_device, key, value)
+            perfdata.add('{}.{}'.format(s_device, key), value, 'c')
     
     # put it all together
-    s_output += ' | {}'.format(s_perfdata)
+    return perfdata.formatOutput(s_output)
+
+def pack_net_counters(f_time, f_boot_time, d_io_counters):
+    """
+    Packs network counters into the binary network state format
+    
+    Gets:
+        f_time: time of the snapshot
+        f_boot_time: boot time of the system
+        d_io_counters: result of psutil.net_io_counters(pernic=True)
+    
+    Returns:
+        bytes
+    """
+    l_data = [struct.pack(S_NET_HEADER, f_time, f_boot_time, len(d_io_counters))]
+    for s_device, nt_counters in d_io_counters.items():
+        b_device = s_device.encode('utf-8')
+        l_data.append(struct.pack('<B', len(b_device)) + b_device)
+        l_data.append(struct.pack(
+            S_NET_RECORD,
+            *[getattr(nt_counters, key) for key in L_NET_FIELDS]
+        ))
+    return b''.join(l_data)
+
+def unpack_net_counters(b_data):
+    """
+    Unpacks the binary network state format
+    
+    Gets:
+        b_data: bytes written by pack_net_counters
+    
+    Returns:
+        (time of the snapshot, boot time, {device: {counter: value}}) or
+        None if b_data is empty or damaged
+    """
+    if not b_data:
+        return None
+    try:
+        f_time, f_boot_time, i_count = struct.unpack_from(S_NET_HEADER, b_data)
+        i_offset  = struct.calcsize(S_NET_HEADER)
+        d_devices = {}
+        for i in range(i_count):
+            i_length = b_data[i_offset]
+            s_device = b_data[i_offset + 1:i_offset + 1 + i_length].decode('utf-8')
+            i_offset += 1 + i_length
+            t_values = struct.unpack_from(S_NET_RECORD, b_data, i_offset)
+            i_offset += struct.calcsize(S_NET_RECORD)
+            d_devices[s_device] = dict(zip(L_NET_FIELDS, t_values))
+    except (struct.error, IndexError, UnicodeDecodeError):
+        return None
+    return f_time, f_boot_time, d_devices
+
+def counter_delta(i_previous, i_current):
+    """
+    Difference between two readings of a counter that only counts up
+    
+    Gets:
+        i_previous: earlier reading
+        i_current: later reading
+    
+    Returns:
+        difference. A 32 bit counter that went backwards from its upper
+        half has wrapped, any other counter that went backwards was reset,
+        e.g. with a recreated interface, so it counts from 0.
+    """
+    if i_current >= i_previous:
+        return i_current - i_previous
+    if 2**31 <= i_previous < 2**32:
+        return i_current + 2**32 - i_previous
+    return i_current
+
+def calculate_net_rates(d_counters, d_previous, f_interval):
+    """
+    Calculates error and drop rates of one interface
+    
+    Gets:
+        d_counters: current counters of the interface
+        d_previous: counters at the start of the interval, None to count
+            from 0, which is the case after a reboot or for a new interface
+        f_interval: length of the interval in seconds
     
-    return s_output
+    Returns:
+        dict with errors and drops per second and per million packets
+    """
+    d_delta = {}
+    for key in L_NET_FIELDS:
+        if d_previous is None:
+            d_delta[key] = d_counters[key]
+        else:
+            d_delta[key] = counter_delta(d_previous[key], d_counters[key])
+    
+    i_errors  = d_delta['errin'] + d_delta['errout']
+    i_drops   = d_delta['dropin'] + d_delta['dropout']
+    # dropped and broken packets are not always counted as packets, so they
+    # are added to get a ratio that can not exceed one million
+    i_packets = d_delta['packets_sent'] + d_delta['packets_recv'] + i_errors + i_drops
+    f_interval = max(f_interval, 1.0)
+    
+    return {
+        'errors_persec': round(i_errors / f_interval, 3),
+        'drops_persec' : round(i_drops / f_interval, 3),
+        'errors_ppm'   : round(1000000.0 * i_errors / i_packets, 3) if i_packets else 0.0,
+        'drops_ppm'    : round(1000000.0 * i_drops / i_packets, 3) if i_packets else 0.0
+    }
 
-def check_network(i_warning, i_critical):
+def check_network(i_warning, i_critical, s_metric='ppm'):
+    """
+    Checks for network errors and drops. The counters are saved in a state
+    file, so errors and drops are rated over the time since the last run.
+    Without a usable state, for example on the first run or after a reboot,
+    the rates are calculated since boot.
+    
+    Gets:
+        i_warning: Warning Threshold
+        i_critical: Critical Threshold
+        s_metric: ppm to check errors/drops per million packets, persec to
+            check errors/drops per second
+    
+    Returns:
+        check output including perfdata
+    """
     test_int(i_warning, i_critical)
+    test_string(s_metric)
     
-    s_perfdata    = ''
+    perfdata      = lib.perfdata.PerfdataWriter()
     s_output      = ''
-    i_max         = 0
+    f_max         = 0.0
     s_maxdesc     = ''
+    f_now         = time.time()
+    f_boot_time   = psutil.boot_time()
     d_io_counters = psutil.net_io_counters(pernic=True)
     
+    t_previous = unpack_net_counters(lib.statefile.readState('check_network'))
+    lib.statefile.writeState('check_network', pack_net_counters(f_now, f_boot_time, d_io_counters))
+    
+    # psutil.boot_time() may move by a second when the clock is adjusted
+    if t_previous is None or abs(t_previous[1] - f_boot_time) > 2 or t_previous[0] >= f_now:
+        t_previous = (f_boot_time, f_boot_time, {})
+    f_previous_time, d_previous_devices = t_previous[0], t_previous[2]
+    
     for s_device, nt_counters in d_io_counters.items():
         d_counters = nt_counters._asdict()
         # add all io_counters to perfdata
         for key, value in d_counters.items():
-            if 'err' in key or 'drop' in key:
-                if value > i_max: 
-                    i_max = value
-                    s_maxdesc = '{} has {} {} packets.'.format(s_device, value, key)
-            s_perfdata = add_perfdata(s_perfdata, s_device, key, value)
+            perfdata.add('{}.{}'.format(s_device, key), value, 'c')
+        
+        if s_device in d_previous_devices:
+            d_rates = calculate_net_rates(d_counters, d_previous_devices[s_device], f_now - f_previous_time)
+        else:
+            d_rates = calculate_net_rates(d_counters, None, f_now - f_boot_time)
+        
+        for key, value in d_rates.items():
+            if key.endswith('_' + s_metric):
+                perfdata.add('{}.{}'.format(s_device, key), value, '', i_warning, i_critical, 0)
+                if value > f_max:
+                    f_max = value
+                    s_maxdesc = ' {} has {} {}.'.format(s_device, value, key)
+            else:
+                perfdata.add('{}.{}'.format(s_device, key), value, '', minimum=0)
             
-    s_output = check_status(i_warning, i_critical, i_max)
+    s_output = check_status(i_warning, i_critical, f_max)
     
     if not 'OK' in s_output: s_output += s_maxdesc
     
-    s_output += ' | {}'.format(s_perfdata)
+    return perfdata.formatOutput(s_output)
+
+def get_positive_int(s_value):
+    """
+    argparse type for counts that have to be at least 1
+    
+    Gets:
+        s_value: argument as given
     
-    return s_output
+    Returns:
+        the argument as int
+    """
+    try:
+        i_value = int(s_value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not a number'.format(s_value))
+    if i_value < 1:
+        raise argparse.ArgumentTypeError('has to be at least 1, got {}'.format(i_value))
+    return i_value
 
-def main():
+def get_positive_float(s_value):
+    """
+    argparse type for durations that have to be above 0
+    
+    Gets:
+        s_value: argument as given
+    
+    Returns:
+        the argument as float
+    """
+    try:
+        f_value = float(s_value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not a number'.format(s_value))
+    if not 0 < f_value < float('inf'):
+        raise argparse.ArgumentTypeError('has to be a number above 0, got {}'.format(s_value))
+    return f_value
+
+def get_parser():
+    """
+    Builds the argument parser. Shared by the plugin, the daemon and the
+    daemon client, so all of them accept exactly the same arguments.
+    
+    Returns:
+        argparse.ArgumentParser
+    """
     parser = argparse.ArgumentParser(description='This check combines memory, load and disk checks.')
     parser.add_argument(
         '-w',
         '--warn',
-        help='For cpu|memory|disk Percentage usage. For net number of dropped/error packets. Default 85',
+        help='For cpu|memory|disk Percentage usage. For network dropped/error packets, see --network-metric. Default 85',
         default = 85,
         type = int
     )
     parser.add_argument(
         '-c',
         '--crit',
-        help='For cpu|memory|disk Percentage usage. For network number of dropped/error packets. Default 95',
+        help='For cpu|memory|disk Percentage usage. For network dropped/error packets, see --network-metric. Default 95',
         default = 95,
         type = int
     )
@@ -276,12 +988,490 @@ def main():
         default = '/',
         type = str
     )
-    arguments = parser.parse_args()
+    parser.add_argument(
+        '--core-warn',
+        help='For cpu Percentage usage of the busiest core. Default: cores are not checked',
+        default = None,
+        type = int
+    )
+    parser.add_argument(
+        '--core-crit',
+        help='For cpu Percentage usage of the busiest core. Default 100 if --core-warn is set',
+        default = None,
+        type = int
+    )
+    parser.add_argument(
+        '--cpu-sample',
+        help='For cpu seconds to sample when there is no snapshot from a previous run. Default 0.5',
+        default = 0.5,
+        type = get_positive_float
+    )
+    parser.add_argument(
+        '-t',
+        '--timeout',
+        help='For disk seconds to wait for a single mountpoint before it is reported UNKNOWN. Default 5',
+        default = 5.0,
+        type = float
+    )
+    for s_kind, s_example in [('fstype', 'nfs*'), ('mount', '/var/lib/docker/*')]:
+        for s_action in ['include', 'exclude']:
+            parser.add_argument(
+                '--{}-{}'.format(s_action, s_kind),
+                help='For disk {} partitions by {} shell pattern, e.g. {}. Can be given multiple times'.format(
+                    s_action, s_kind, s_example
+                ),
+                default = [],
+                action = 'append',
+                type = str
+            )
+    parser.add_argument(
+        '-n',
+        '--top',
+        help='For cpu|memory number of top consumers listed on WARNING or CRITICAL. Default 5',
+        default = 5,
+        type = get_positive_int
+    )
+    parser.add_argument(
+        '-g',
+        '--top-group',
+        help='For cpu|memory <pid|user|name|cgroup> group top consumers by. Default pid',
+        default = 'pid',
+        choices = sorted(D_TOP_GROUP_NAMES),
+        type = str
+    )
+    parser.add_argument(
+        '-N',
+        '--network-metric',
+        help='<ppm|persec> Rate network thresholds apply to, per million packets or per second. Default ppm',
+        default = 'ppm',
+        choices = ['ppm', 'persec'],
+        type = str
+    )
+    parser.add_argument(
+        '-D',
+        '--daemon',
+        help='Run as resident collector daemon, answering check_client.py on --socket',
+        action = 'store_true'
+    )
+    parser.add_argument(
+        '-S',
+        '--socket',
+        help='UNIX socket of the collector daemon. Default {}'.format(S_DEFAULT_SOCKET),
+        default = S_DEFAULT_SOCKET,
+        type = str
+    )
+    parser.add_argument(
+        '-i',
+        '--interval',
+        help='Daemon only. Seconds between two collections of the same check. Default depends on command: {}'.format(
+            ', '.join('{} {}'.format(key, value) for key, value in sorted(D_DAEMON_INTERVALS.items()))
+        ),
+        default = None,
+        type = int
+    )
+    parser.add_argument(
+        '-B',
+        '--batch',
+        help='Run cpu, memory, disk and network at once and submit them as passive results to the Icinga 2 API',
+        action = 'store_true'
+    )
+    parser.add_argument(
+        '--hostname',
+        help='Batch only. Icinga host object the results belong to. Default {}'.format(socket.getfqdn()),
+        default = socket.getfqdn(),
+        type = str
+    )
+    parser.add_argument(
+        '--service',
+        help='Batch only. command=service, Icinga service a command is submitted as. Default: the command name. Can be given multiple times',
+        default = [],
+        action = 'append',
+        type = str
+    )
+    parser.add_argument(
+        '--threshold',
+        help='Batch only. command=warn:crit, thresholds of a command. Default -w/-c. Can be given multiple times',
+        default = [],
+        action = 'append',
+        type = str
+    )
+    parser.add_argument(
+        '--api-url',
+        help='Batch only. Url of the Icinga 2 API. Default https://localhost:5665',
+        default = 'https://localhost:5665',
+        type = str
+    )
+    parser.add_argument(
+        '--api-user',
+        help='Batch only. Icinga 2 API user',
+        type = str
+    )
+    parser.add_argument(
+        '--api-password',
+        help='Batch only. Password of the Icinga 2 API user. Default: environment variable ICINGA2_API_PASSWORD',
+        default = os.environ.get('ICINGA2_API_PASSWORD'),
+        type = str
+    )
+    parser.add_argument(
+        '--api-ca',
+        help='Batch only. CA certificate of the Icinga 2 API. Default: system certificates',
+        type = str
+    )
+    parser.add_argument(
+        '--api-insecure',
+        help='Batch only. Do not verify the certificate of the Icinga 2 API',
+        action = 'store_true'
+    )
+    return parser
+
+def run_check(arguments):
+    """
+    Runs the check selected by arguments.command
+    
+    Gets:
+        arguments: parsed arguments from get_parser()
+    
+    Returns:
+        check output including perfdata
+    """
     if arguments.command == 'cpu' or arguments.command == 'memory':
-        print(check_load_or_memory(arguments.warn, arguments.crit, arguments.command))
+        return check_load_or_memory(
+            arguments.warn,
+            arguments.crit,
+            arguments.command,
+            arguments.core_warn,
+            arguments.core_crit,
+            arguments.cpu_sample,
+            arguments.top,
+            arguments.top_group
+        )
     if arguments.command == 'disk':
-        print(check_disk(arguments.warn, arguments.crit, arguments.partition))
+        return check_disk(
+            arguments.warn,
+            arguments.crit,
+            arguments.partition,
+            arguments.timeout,
+            get_disk_filters(arguments)
+        )
     if arguments.command == 'network':
-        print(check_network(arguments.warn, arguments.crit))
+        return check_network(arguments.warn, arguments.crit, arguments.network_metric)
+    return ''
+
+def get_exitcode(s_output):
+    """
+    Gets:
+        s_output: check output, starting with the status
+    
+    Returns:
+        exit code of the status, 3 if the output has no status
+    """
+    l_words = s_output.split(None, 1)
+    if l_words and l_words[0] in D_EXITCODES:
+        return D_EXITCODES[l_words[0]]
+    return 3
+
+def get_batch_thresholds(arguments):
+    """
+    Gets:
+        arguments: parsed arguments from get_parser()
+    
+    Returns:
+        dict of command: (warning, critical), from --threshold or -w/-c
+    """
+    d_thresholds = {s_command: (arguments.warn, arguments.crit) for s_command in L_BATCH_COMMANDS}
+    for s_threshold in arguments.threshold:
+        s_command, s_sep, s_values = s_threshold.partition('=')
+        s_warning, s_sep, s_critical = s_values.partition(':')
+        if s_command not in d_thresholds:
+            raise ValueError('unknown command in --threshold {}'.format(s_threshold))
+        d_thresholds[s_command] = (int(s_warning), int(s_critical))
+    return d_thresholds
+
+def get_batch_services(arguments):
+    """
+    Gets:
+        arguments: parsed arguments from get_parser()
+    
+    Returns:
+        dict of command: icinga service name, from --service or the command
+    """
+    d_services = {s_command: s_command for s_command in L_BATCH_COMMANDS}
+    for s_service in arguments.service:
+        s_command, s_sep, s_name = s_service.partition('=')
+        if s_command not in d_services or not s_name:
+            raise ValueError('--service has to be command=service, not {}'.format(s_service))
+        d_services[s_command] = s_name
+    return d_services
+
+def run_batch(arguments):
+    """
+    Runs cpu, memory, disk and network in one pass and submits every result
+    as passive check result to the Icinga 2 API. cpu and memory share a
+    single process scan.
+    
+    Gets:
+        arguments: parsed arguments from get_parser()
+    
+    Returns:
+        (output, exit code) of the batch run itself
+    """
+    d_thresholds  = get_batch_thresholds(arguments)
+    d_services    = get_batch_services(arguments)
+    top_processes = TopProcesses(['cpu_percent', 'memory_percent'], arguments.top, arguments.top_group)
+    d_outputs     = OrderedDict()
+    
+    for s_command in L_BATCH_COMMANDS:
+        i_warning, i_critical = d_thresholds[s_command]
+        if s_command in ('cpu', 'memory'):
+            d_outputs[s_command] = check_load_or_memory(
+                i_warning,
+                i_critical,
+                s_command,
+                arguments.core_warn,
+                arguments.core_crit,
+                arguments.cpu_sample,
+                i_top         = arguments.top,
+                s_group       = arguments.top_group,
+                top_processes = top_processes
+            )
+        elif s_command == 'disk':
+            d_outputs[s_command] = check_disk(
+                i_warning,
+                i_critical,
+                arguments.partition,
+                arguments.timeout,
+                get_disk_filters(arguments)
+            )
+        else:
+            d_outputs[s_command] = check_network(i_warning, i_critical, arguments.network_metric)
+    
+    l_results = []
+    for s_command, s_output in d_outputs.items():
+        s_text, s_sep, s_perfdata = s_output.partition(' | ')
+        l_results.append({
+            'host'      : arguments.hostname,
+            'service'   : d_services[s_command],
+            'exitStatus': get_exitcode(s_output),
+            'output'    : s_text,
+            'perfdata'  : s_perfdata
+        })
+    
+    api = lib.icingaapi.IcingaAPI(
+        arguments.api_url,
+        arguments.api_user,
+        arguments.api_password,
+        arguments.api_ca,
+        not arguments.api_insecure
+    )
+    l_errors = api.processCheckResults(l_results)
+    
+    l_failed = [
+        '{}: {}'.format(d_result['service'], s_error)
+        for d_result, s_error in zip(l_results, l_errors) if s_error
+    ]
+    if l_failed:
+        return 'CRITICAL {} of {} results could not be submitted\n{}'.format(
+            len(l_failed), len(l_results), '\n'.join(l_failed)
+        ), 2
+    return 'OK {} results submitted for {}'.format(len(l_results), arguments.hostname), 0
+
+def get_disk_filters(arguments):
+    """
+    Gets:
+        arguments: parsed arguments from get_parser()
+    
+    Returns:
+        disk filters for filter_partitions
+    """
+    return {
+        'include_fstype': arguments.include_fstype,
+        'exclude_fstype': arguments.exclude_fstype,
+        'include_mount' : arguments.include_mount,
+        'exclude_mount' : arguments.exclude_mount
+    }
+
+def get_daemon_key(arguments):
+    """
+    Builds the key under which the daemon caches a check result. Every
+    argument except the daemon options themselves is part of the key, so
+    two services with different thresholds get their own result.
+    
+    Gets:
+        arguments: parsed arguments from get_parser()
+    
+    Returns:
+        tuple of (argument, value) pairs
+    """
+    # repeatable options are lists, which can not be part of a dict key
+    return tuple(sorted(
+        (key, tuple(value) if isinstance(value, list) else value)
+        for key, value in vars(arguments).items()
+        if key not in L_DAEMON_ARGUMENTS and key not in L_BATCH_ARGUMENTS
+    ))
+
+class CollectorDaemon:
+    """
+    Keeps the latest result of every check that was requested at least once
+    and refreshes it in the background, every check on its own schedule.
+    Checks that have not been requested for I_DAEMON_EXPIRY intervals are
+    dropped again.
+    """
+    
+    def __init__(self, i_interval):
+        self.i_interval = i_interval
+        self.d_results  = {}
+        self.lock       = threading.Lock()
+    
+    def get_interval(self, arguments):
+        if self.i_interval:
+            return self.i_interval
+        return D_DAEMON_INTERVALS.get(arguments.command, 30)
+    
+    def collect(self, t_key, arguments):
+        s_output = run_check(arguments)
+        with self.lock:
+            self.d_results[t_key]['output'] = s_output
+            self.d_results[t_key]['time']   = time.time()
+    
+    def refresh(self, t_key, arguments):
+        """Refresh loop of a single check, runs in its own thread"""
+        i_interval = self.get_interval(arguments)
+        while True:
+            time.sleep(i_interval)
+            with self.lock:
+                f_idle = time.time() - self.d_results[t_key]['requested']
+                if f_idle > I_DAEMON_EXPIRY * i_interval:
+                    del self.d_results[t_key]
+                    return
+            try:
+                self.collect(t_key, arguments)
+            except Exception:
+                # keep the last result, it will run stale and the client
+                # falls back to collecting in-process
+                pass
+    
+    def get_result(self, l_argv):
+        """
+        Returns the cached output for the given plugin arguments. The first
+        request for a check collects synchronously and starts its refresh
+        thread.
+        
+        Gets:
+            l_argv: command line arguments the client was called with
+        
+        Returns:
+            check output including perfdata
+        """
+        arguments = get_parser().parse_args(l_argv)
+        t_key     = get_daemon_key(arguments)
+        
+        with self.lock:
+            b_new = t_key not in self.d_results
+            if b_new:
+                self.d_results[t_key] = {'output': None, 'time': 0.0, 'requested': time.time()}
+            else:
+                self.d_results[t_key]['requested'] = time.time()
+        
+        if b_new:
+            try:
+                self.collect(t_key, arguments)
+            except BaseException:
+                # no refresh thread exists yet, the next request has to
+                # collect again instead of finding an empty entry forever
+                with self.lock:
+                    del self.d_results[t_key]
+                raise
+            threading.Thread(target=self.refresh, args=(t_key, arguments), daemon=True).start()
+        
+        with self.lock:
+            d_result = self.d_results[t_key]
+            if d_result['output'] is None:
+                raise RuntimeError('no result collected yet')
+            if time.time() - d_result['time'] > I_DAEMON_STALE * self.get_interval(arguments):
+                raise RuntimeError('result is stale')
+            return d_result['output']
+
+def check_socket_dir(s_dir):
+    """
+    Makes sure no other user can replace the daemon socket. The directory
+    has to belong to root or the current user and must not be writable by
+    group or others.
+    
+    Gets:
+        s_dir: directory of the daemon socket
+    
+    Raises:
+        ValueError if the directory is not safe
+    """
+    st_dir = os.lstat(s_dir)
+    if not stat.S_ISDIR(st_dir.st_mode):
+        raise ValueError('{} is not a directory'.format(s_dir))
+    if st_dir.st_uid not in (0, os.getuid()):
+        raise ValueError('{} belongs to uid {}, not to this user'.format(s_dir, st_dir.st_uid))
+    if st_dir.st_mode & 0o022:
+        raise ValueError('{} is writable by group or others'.format(s_dir))
+
+def serve_daemon(s_socket, i_interval):
+    """
+    Runs the collector daemon on a UNIX socket. The protocol is one JSON
+    line per direction: the client sends its argument list, the daemon
+    answers {"output": ...} or {"error": ...}. On an error the client
+    collects in-process, so any argument error is reported exactly as the
+    plugin would report it. Only the user of the daemon can connect, so it
+    has to run as the user of the checks.
+    
+    Gets:
+        s_socket: path of the UNIX socket
+        i_interval: refresh interval in seconds, None for per command defaults
+    """
+    daemon = CollectorDaemon(i_interval)
+    
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                l_argv = json.loads(self.rfile.readline().decode('utf-8'))
+                d_answer = {'output': daemon.get_result(l_argv)}
+            except (Exception, SystemExit) as e:
+                d_answer = {'error': str(e)}
+            self.wfile.write(json.dumps(d_answer).encode('utf-8') + b'\n')
+    
+    s_dir = os.path.dirname(os.path.abspath(s_socket))
+    os.makedirs(s_dir, mode=0o755, exist_ok=True)
+    check_socket_dir(s_dir)
+    if os.path.lexists(s_socket):
+        os.unlink(s_socket)
+    
+    # the socket is created with mode 0600, so nobody else can connect
+    i_umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(s_socket, Handler)
+    finally:
+        os.umask(i_umask)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(s_socket)
+
+def main(l_argv=None):
+    parser    = get_parser()
+    arguments = parser.parse_args(l_argv)
+    if arguments.daemon:
+        try:
+            serve_daemon(arguments.socket, arguments.interval)
+        except ValueError as e:
+            parser.error(str(e))
+    elif arguments.batch:
+        if not arguments.api_user or not arguments.api_password:
+            parser.error('--batch needs --api-user and --api-password or ICINGA2_API_PASSWORD')
+        try:
+            s_output, i_exitcode = run_batch(arguments)
+        except ValueError as e:
+            parser.error(str(e))
+        print(s_output)
+        sys.exit(i_exitcode)
+    else:
+        print(run_check(arguments))
 if __name__ == '__main__':
     main()
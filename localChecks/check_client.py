@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""
+Thin client for the check.py collector daemon.
+
+Takes exactly the same arguments as check.py. The arguments are handed to
+the daemon started with `check.py --daemon`, which answers from its cached
+results. If the daemon is not running or can not answer, the check is run
+in-process instead, so the output is always the same as running check.py.
+
+This file only imports modules that are part of every interpreter startup
+anyway. psutil and argparse are only imported in the fallback.
+
+This file is under Apache 2.0 License
+
+Copyright C-Store 2016
+Author Mattis Haase
+"""
+
+import json
+import os
+import socket
+import stat
+import sys
+
+# has to match check.S_DEFAULT_SOCKET
+S_DEFAULT_SOCKET = '/var/tmp/icinga2checks/check.sock'
+# seconds to wait for the daemon before falling back
+F_TIMEOUT = 10.0
+# options of check.py that only configure the daemon, with and without a value
+L_DAEMON_FLAGS   = ['-D', '--daemon']
+L_DAEMON_OPTIONS = ['-S', '--socket', '-i', '--interval']
+
+def get_socket_path(l_argv):
+    """
+    Finds the socket path in the arguments without using argparse
+
+    Gets:
+        l_argv: command line arguments
+
+    Returns:
+        path of the daemon socket
+    """
+    for i, s_arg in enumerate(l_argv):
+        if s_arg in ('-S', '--socket') and i + 1 < len(l_argv):
+            return l_argv[i + 1]
+        if s_arg.startswith('--socket='):
+            return s_arg.split('=', 1)[1]
+    return S_DEFAULT_SOCKET
+
+def get_check_argv(l_argv):
+    """
+    Removes the daemon options, so the in-process fallback runs the check
+    instead of starting a daemon
+
+    Gets:
+        l_argv: command line arguments
+
+    Returns:
+        arguments without daemon options
+    """
+    l_check = []
+    b_skip  = False
+    for s_arg in l_argv:
+        if b_skip:
+            b_skip = False
+        elif s_arg in L_DAEMON_FLAGS:
+            pass
+        elif s_arg in L_DAEMON_OPTIONS:
+            b_skip = True
+        elif any(
+            s_arg.startswith(s_option + '=') or (len(s_option) == 2 and s_arg.startswith(s_option))
+            for s_option in L_DAEMON_OPTIONS
+        ):
+            pass
+        else:
+            l_check.append(s_arg)
+    return l_check
+
+def is_trusted(s_socket):
+    """
+    Only sockets of the current user in a directory nobody else can write to
+    are asked, anything else could be a socket planted by another user that
+    answers with fake results. The daemon makes its socket accessible to its
+    own user only, so it has to run as the user of the checks
+
+    Gets:
+        s_socket: path of the daemon socket
+
+    Returns:
+        True if the socket can be trusted
+    """
+    try:
+        st_dir    = os.lstat(os.path.dirname(os.path.abspath(s_socket)))
+        st_socket = os.lstat(s_socket)
+    except OSError:
+        return False
+    return (
+        stat.S_ISSOCK(st_socket.st_mode)
+        and st_socket.st_uid == os.getuid()
+        and st_dir.st_uid in (0, os.getuid())
+        and not st_dir.st_mode & 0o022
+    )
+
+def query_daemon(s_socket, l_argv):
+    """
+    Asks the daemon for the result of a check
+
+    Gets:
+        s_socket: path of the daemon socket
+        l_argv: command line arguments
+
+    Returns:
+        check output including perfdata, None if the daemon could not answer
+    """
+    if not is_trusted(s_socket):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(F_TIMEOUT)
+            sock.connect(s_socket)
+            sock.sendall(json.dumps(l_argv).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                d_answer = json.loads(f.readline().decode('utf-8'))
+    except (OSError, ValueError):
+        return None
+    return d_answer.get('output')
+
+def main():
+    l_argv   = sys.argv[1:]
+    s_output = query_daemon(get_socket_path(l_argv), l_argv)
+    if s_output is None:
+        import check
+        check.main(get_check_argv(l_argv))
+    else:
+        print(s_output)
+
+if __name__ == '__main__':
+    main()
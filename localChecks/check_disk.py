@@ -5,128 +5,311 @@
 # copyright C-Store 2016
 # Author Mattis Haase
 #
+# Filesystems are read from /proc/self/mountinfo and measured with statvfs,
+# nothing is forked. Every filesystem is reported once, bind mounts and
+# mounts hidden below another mount are skipped, as are pseudo filesystems
+# without any blocks (proc, sysfs, cgroup, ...). A bind mount named by -t or
+# -f is reported instead of the first mountpoint of its filesystem.
+#
 # usage:  check_disk.py -w <warn Percent> -c <crit Percent> -f <partition that should be checked>
+#         check_disk.py -t /=80:90 -t /var=85:95:80:90 -w 90 -c 95
+# -t MOUNT=WARN:CRIT[:INODEWARN:INODECRIT] sets thresholds for one mount and
+# can be repeated. -f applies -w/-c (and -W/-C for inodes) to one device or
+# mountpoint. Without -t and -f, -w/-c apply to every filesystem.
 # output: 
 # check_disk.py OK - 
-# udev mounted on: /dev
-# tmpfs mounted on: /run
-# /dev/dm-0 mounted on: /
-# /dev/sda1 mounted on: /boot
+# udev mounted on: /dev 0% used, 1% inodes used
+# tmpfs mounted on: /run 2% used, 1% inodes used
+# /dev/dm-0 mounted on: / 45% used, 12% inodes used
+# /dev/sda1 mounted on: /boot 19% used, 1% inodes used
 #
-# perfdata:
-# /boot_BlocksAvailable	187,356.00
-# /boot_BlocksUsed	41,175.00
-# /boot_BlocksTotal	240,972.00
-# /boot_PercentUsed	19.00
+# perfdata, per mountpoint:
+# /boot_BytesUsed=42163200B;;;0;246755328
+# /boot_BytesAvailable=191852544B
+# /boot_BytesTotal=246755328B
+# /boot_PercentUsed=19%;80;90
+# /boot_InodesUsed=318;;;0;62248
+# /boot_InodesTotal=62248
+# /boot_InodesPercentUsed=1%
 
 import argparse
-import re
+import os
+import sys
 from sys import exit
-from subprocess import check_output
 
-def executedf():
+# shared modules live in lib/ at the top of the repository
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import lib.perfdata
+
+def unescapeMountinfo(sField):
+    """
+    mountinfo escapes space, tab, newline and backslash as octal
+    gets:
+     sField: field of /proc/self/mountinfo
+    returns:
+     field with escapes replaced
+    """
+    if '\\' not in sField:
+        return(sField)
+    for sEscape, sChar in (('\\040', ' '), ('\\011', '\t'), ('\\012', '\n'), ('\\134', '\\')):
+        sField = sField.replace(sEscape, sChar)
+    return(sField)
+
+def parseMountinfo(sPath='/proc/self/mountinfo', lRequested=()):
+    """
+    Reads all mounts once. When a mountpoint was mounted over, only the
+    mount on top is visible and kept. When one filesystem is mounted more
+    than once (bind mounts), only its first mountpoint is kept, unless
+    others were requested, then those are kept instead.
+    gets:
+     sPath     : path of the mountinfo file
+     lRequested: mountpoints named by -t or -f
+    returns:
+     list of (sName, sMountpoint, sFstype)
+    """
+    dVisible = {}
+    with open(sPath) as f:
+        for sLine in f:
+            # format: id parent major:minor root mountpoint options [optional...] - fstype source superoptions
+            lFields = sLine.split()
+            try:
+                iSeparator = lFields.index('-', 6)
+            except ValueError:
+                continue
+            sMountpoint = unescapeMountinfo(lFields[4])
+            # a later mount on the same mountpoint hides the earlier one
+            dVisible.pop(sMountpoint, None)
+            dVisible[sMountpoint] = (
+                lFields[2],
+                unescapeMountinfo(lFields[iSeparator + 2]),
+                lFields[iSeparator + 1]
+            )
+
+    setRequestedDevices = set(dVisible[sMountpoint][0] for sMountpoint in lRequested if sMountpoint in dVisible)
+    lMounts = []
+    setDevices = set()
+    for sMountpoint, (sDevice, sName, sFstype) in dVisible.items():
+        if sDevice in setRequestedDevices:
+            if sMountpoint not in lRequested:
+                continue
+        elif sDevice in setDevices:
+            continue
+        setDevices.add(sDevice)
+        lMounts.append((sName, sMountpoint, sFstype))
+    return(lMounts)
+
+def percent(iUsed, iAvailable):
+    """
+    percentage like df calculates it, rounded up and relative to the space
+    available to unprivileged users
+    """
+    iTotal = iUsed + iAvailable
+    if not iTotal:
+        return(0)
+    return(-(-iUsed * 100 // iTotal))
+
+def getUsage(lRequested=()):
     """
-    Executes df command
+    Measures every filesystem with statvfs
+    gets:
+     lRequested: mountpoints named by -t or -f, see parseMountinfo
     Returns:
         lOutput = [
             {
                 sName           :'partition1',
-                iBlocksTotal    :1234,
-                iBlocksUsed     :1000
-                iBlocksAvailable:234
-                iPercent        :90
-                sMountpoint     :'/mnt'
+                sMountpoint     :'/mnt',
+                iBytesTotal     :1234,
+                iBytesUsed      :1000,
+                iBytesAvailable :234,
+                iPercent        :90,
+                iInodesTotal    :100,
+                iInodesUsed     :10,
+                iInodesPercent  :10
             }
         ]
     """
-    sDfOutput = check_output(['df']).decode('utf-8')
-    lDfOutput = sDfOutput.split('\n')
     lOutput = []
 
-    for i, sLine in enumerate(lDfOutput):
-        if not i == 0 and sLine:
-            lValues = sLine.split()
-
-            if not lValues[0] == 'none':
-                lOutput.append(
-                    {
-                        'sName'           : lValues[0],
-                        'iBlocksTotal'    : lValues[1],
-                        'iBlocksUsed'     : lValues[2],
-                        'iBlocksAvailable': lValues[3],
-                        'iPercent'        : int(lValues[4].replace('%', '')),
-                        'sMountpoint'     : lValues[5]
-                    }
-                )
+    for sName, sMountpoint, sFstype in parseMountinfo(lRequested=lRequested):
+        try:
+            stat = os.statvfs(sMountpoint)
+        except OSError:
+            continue
+        if not stat.f_blocks:
+            continue
+
+        iBytesUsed      = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+        iBytesAvailable = stat.f_bavail * stat.f_frsize
+        iInodesUsed     = stat.f_files - stat.f_ffree
+        lOutput.append(
+            {
+                'sName'          : sName,
+                'sMountpoint'    : sMountpoint,
+                'iBytesTotal'    : stat.f_blocks * stat.f_frsize,
+                'iBytesUsed'     : iBytesUsed,
+                'iBytesAvailable': iBytesAvailable,
+                'iPercent'       : percent(iBytesUsed, iBytesAvailable),
+                'iInodesTotal'   : stat.f_files,
+                'iInodesUsed'    : iInodesUsed,
+                'iInodesPercent' : percent(iInodesUsed, stat.f_favail) if stat.f_files else 0
+            }
+        )
     return(lOutput)
 
-def compileOutput(lOutput):
+def parseThreshold(sThreshold):
+    """
+    gets:
+     sThreshold: MOUNT=WARN:CRIT[:INODEWARN:INODECRIT]
+    returns:
+     (sMountpoint, dThresholds)
+    """
+    sMountpoint, sSeparator, sLevels = sThreshold.rpartition('=')
+    try:
+        lLevels = [int(sLevel) if sLevel else None for sLevel in sLevels.split(':')]
+    except ValueError:
+        lLevels = []
+    if not sSeparator or not sMountpoint or len(lLevels) not in (2, 4):
+        raise argparse.ArgumentTypeError(
+            'expected MOUNT=WARN:CRIT[:INODEWARN:INODECRIT], got {}'.format(sThreshold)
+        )
+    lLevels += [None] * (4 - len(lLevels))
+    return((sMountpoint, dict(zip(['iWarning', 'iCritical', 'iInodeWarning', 'iInodeCritical'], lLevels))))
+
+def getThresholds(args, dPartition):
+    """
+    gets:
+     args      : parsed arguments
+     dPartition: dict of one filesystem
+    returns:
+     dict with the thresholds of the filesystem, None if it does not alert
+    """
+    dThresholds = dict(args.threshold)
+    if dPartition['sMountpoint'] in dThresholds:
+        return(dThresholds[dPartition['sMountpoint']])
+    if args.filesystem:
+        if args.filesystem not in (dPartition['sName'], dPartition['sMountpoint']):
+            return(None)
+    elif dThresholds:
+        return(None)
+    return(
+        {
+            'iWarning'      : args.warning,
+            'iCritical'     : args.critical,
+            'iInodeWarning' : args.inode_warning,
+            'iInodeCritical': args.inode_critical
+        }
+    )
+
+def compileOutput(lOutput, args):
     """
     compiles perfdata and output
     gets:
      lOutput: list of dicts for each Disk
+     args   : parsed arguments
     returns:
      complete output without OK/WARNING/CRITICAL
     """
-    sPerfdata     = ''
-    sNonPerfdata  = ''
+    perfdata      = lib.perfdata.PerfdataWriter()
+    lNonPerfdata  = []
 
     for dPartition in lOutput:
-        sPerfdata += ' {0}_BlocksTotal={1} {0}_BlocksUsed={2} {0}_BlocksAvailable={3} {0}_PercentUsed={4}'
-        sPerfdata = sPerfdata.format(
-            dPartition['sMountpoint'],
-            dPartition['iBlocksTotal'],
-            dPartition['iBlocksUsed'],
-            dPartition['iBlocksAvailable'],
-            dPartition['iPercent']
+        dThresholds = getThresholds(args, dPartition) or {}
+        sMountpoint = dPartition['sMountpoint']
+        perfdata.add(sMountpoint + '_BytesUsed', dPartition['iBytesUsed'], 'B', minimum=0, maximum=dPartition['iBytesTotal'])
+        perfdata.add(sMountpoint + '_BytesAvailable', dPartition['iBytesAvailable'], 'B')
+        perfdata.add(sMountpoint + '_BytesTotal', dPartition['iBytesTotal'], 'B')
+        perfdata.add(
+            sMountpoint + '_PercentUsed',
+            dPartition['iPercent'],
+            '%',
+            dThresholds.get('iWarning'),
+            dThresholds.get('iCritical')
         )
-        sNonPerfdata += '\\n{0} mounted on: {1}'
-        sNonPerfdata = sNonPerfdata.format(
+        if dPartition['iInodesTotal']:
+            perfdata.add(sMountpoint + '_InodesUsed', dPartition['iInodesUsed'], minimum=0, maximum=dPartition['iInodesTotal'])
+            perfdata.add(sMountpoint + '_InodesTotal', dPartition['iInodesTotal'])
+            perfdata.add(
+                sMountpoint + '_InodesPercentUsed',
+                dPartition['iInodesPercent'],
+                '%',
+                dThresholds.get('iInodeWarning'),
+                dThresholds.get('iInodeCritical')
+            )
+        lNonPerfdata.append('\\n{0} mounted on: {1} {2}% used, {3}% inodes used'.format(
             dPartition['sName'],
-            dPartition['sMountpoint']
-        )
+            sMountpoint,
+            dPartition['iPercent'],
+            dPartition['iInodesPercent']
+        ))
     
-    sOutput = '{} | {}'.format(sNonPerfdata, sPerfdata)
+    sOutput = perfdata.formatOutput(''.join(lNonPerfdata))
     return(sOutput)
 
-def compileStatus(lOutput, iWarning, iCritical, sFilesystem):
+def compareLevels(iValue, iWarning, iCritical):
+    """
+    gets:
+     iValue   : percentage used
+     iWarning : warning threshold, None for none
+     iCritical: critical threshold, None for none
+    returns:
+     OK/WARNING/CRITICAL
+    """
+    if iCritical is not None and iValue >= iCritical:
+        return('CRITICAL')
+    elif iWarning is not None and iValue >= iWarning:
+        return('WARNING')
+    return('OK')
+
+def compileStatus(lOutput, args):
     """
     compiles OK/WARNING/CRITICAL/UNKNOWN status
     gets:
-     lOutput  : list of dicts for each Disk
-     iWarning   : warning threshold
-     iCritical  : critical threshold
-     sFilesystem: filesystem which to compare iWarning and iCritical against
+     lOutput: list of dicts for each Disk
+     args   : parsed arguments with thresholds
     returns:
-     OK/WARNING/CRITICAL/UNKNOWN
+     worst status of all filesystems that have thresholds, UNKNOWN if none
+     of the filesystems that should be checked was found
     """
+    lOrder  = ['OK', 'WARNING', 'CRITICAL']
+    sStatus = None
+
     for dPartition in lOutput:
-        if sFilesystem == dPartition['sName'] or sFilesystem == dPartition['sMountpoint']:
-            if dPartition['iPercent'] >= iCritical: 
-                return('CRITICAL')
-            elif dPartition['iPercent'] >= iWarning: 
-                return('WARNING')
-            elif dPartition['iPercent'] < iCritical and dPartition['iPercent'] < iWarning:
-                return('OK')
-            else:
-                return('UNKNOWN')
+        dThresholds = getThresholds(args, dPartition)
+        if dThresholds is None:
+            continue
+        for sLevels in (
+            compareLevels(dPartition['iPercent'], dThresholds['iWarning'], dThresholds['iCritical']),
+            compareLevels(dPartition['iInodesPercent'], dThresholds['iInodeWarning'], dThresholds['iInodeCritical'])
+        ):
+            if sStatus is None or lOrder.index(sLevels) > lOrder.index(sStatus):
+                sStatus = sLevels
+
+    return(sStatus or 'UNKNOWN')
 
 def main():
     parser = argparse.ArgumentParser(description='Check Disk Space')
-    parser.add_argument('-w', '--warning', type=int, help='WARNING Level [%]')
-    parser.add_argument('-c', '--critical', type=int, help='CRITICAL level [%]')
+    parser.add_argument('-w', '--warning', type=int, help='WARNING Level [%%]')
+    parser.add_argument('-c', '--critical', type=int, help='CRITICAL level [%%]')
+    parser.add_argument('-W', '--inode-warning', type=int, help='WARNING Level of inodes used [%%]')
+    parser.add_argument('-C', '--inode-critical', type=int, help='CRITICAL level of inodes used [%%]')
     parser.add_argument('-f', '--filesystem', type=str, help='Filesystem which should raise alerts.')
+    parser.add_argument(
+        '-t',
+        '--threshold',
+        type=parseThreshold,
+        action='append',
+        default=[],
+        help='MOUNT=WARN:CRIT[:INODEWARN:INODECRIT], thresholds of one mountpoint, can be repeated'
+    )
 
     args = parser.parse_args()
 
-    lOutput = executedf()
-    sOutput = compileOutput(lOutput)
-    sStatus = compileStatus(
-        lOutput=lOutput,
-        iWarning=args.warning,
-        iCritical=args.critical,
-        sFilesystem=args.filesystem
-    )
+    lRequested = [sMountpoint for sMountpoint, dThresholds in args.threshold]
+    if args.filesystem:
+        lRequested.append(args.filesystem)
+    lOutput = getUsage(lRequested)
+    sOutput = compileOutput(lOutput, args)
+    sStatus = compileStatus(lOutput, args)
 
     sOutput = 'check_disk.py {0} - {1}'.format(
         sStatus,
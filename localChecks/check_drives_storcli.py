@@ -6,66 +6,526 @@
 # copyright C-Store 2015
 # Author Mattis Haase
 #
-# usage:        check_drives_storcli.py warnErrors critErrors warnDown critDown
-# output: OK/WARNING/CRITICAL check_srives_storecli - d0: 1/0, d0errors:0, .... dn: 1/0, dnerrors:0 | d0:1/0,d0errors:n,... 
+# All controllers, enclosures and drives are read from the JSON output of
+# storcli, so drives of every size, interface and medium are found. Drives
+# are indexed by controller/enclosure/slot and listed below the virtual
+# drive they belong to.
+#
+# usage:        check_drives_storcli.py warnErrors critErrors warnDown critDown [-s storcli]
+# output: OK/WARNING/CRITICAL check_drives_storcli - 180 drives on 4 controllers
+#  c0/v0 RAID6 Optl 87.328 TB: c0e252s0 Onln, c0e252s1 Onln, ...
+#  c0 unconfigured: c0e252s12 UGood
+#  | c0e252s0_State=1 c0e252s0_MediaErrorCount=0c ... c0v0_State=1
+#
+# errors are media, other and BBM errors plus one for every drive with a
+# S.M.A.R.T alert, down are drives and virtual drives that are not usable
+#
+# storcli is slow and the firmware serialises concurrent calls, so the
+# parsed state is cached in /var/tmp/icinga2checks for --cache-ttl seconds
+# and shared by all services checking the same host. Only one process
+# refreshes it, the others wait for its result up to --lock-wait seconds
+# and then answer from the older data. The output shows the age of the data.
+#
+# A refresh only runs the cheap /call show, which has controller, virtual
+# drive and drive states. The slow show all with error counters, S.M.A.R.T
+# and temperature runs for all drives every --detail-interval seconds, and
+# in between for new, changed and not online drives and for drives whose
+# errors grew since the last run for all drives.
 
-from subprocess import check_output
+from collections import OrderedDict
+from subprocess import check_output, CalledProcessError
+import argparse
+import json
+import os
+import re
 import sys
+import time
+
+# shared modules live in lib/ at the top of the repository
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import lib.perfdata
+import lib.statefile
+
+sDefaultStorcli = '/opt/lsi/storcli/storcli'
+sStateName = 'check_drives_storcli'
+
+# drive states that are not counted as down. Everything else, e.g. Offln,
+# UBad, Failed or Msng, is
+lGoodDriveStates = ['Onln', 'JBOD', 'UGood', 'GHS', 'DHS', 'Rbld', 'Cpybck']
+# virtual drive states, Optl is the only healthy one
+dVirtualDriveStates = {
+    'Optl' : 'OK',
+    'OfLn' : 'CRITICAL',
+    'Offln': 'CRITICAL'
+}
+
+# counters only the expensive show all reports
+lDetailKeys = [
+    'mediaErrorCount', 'otherErrorCount', 'BBMErrorCount',
+    'predictiveFailureCount', 'driveTemperature', 'smartFlag'
+]
+# detail keys that only grow or flip when a drive has problems
+lErrorKeys = [
+    'mediaErrorCount', 'otherErrorCount', 'BBMErrorCount',
+    'predictiveFailureCount', 'smartFlag'
+]
+# above this many suspicious drives, all drives are queried in one call
+iMaxSingleDetails = 8
+
+reDrive = re.compile(r'^Drive /c(\d+)(?:/e(\d+))?/s(\d+)$')
+
+def runStorcli(sStorcli, lArguments):
+    """
+    runs storcli with JSON output
+    gets:
+     sStorcli  : path of the storcli binary
+     lArguments: arguments, e.g. ['/call', 'show']
+    returns:
+     list of controller dicts of the JSON output
+    """
+    try:
+        sOutput = check_output([sStorcli] + lArguments + ['J']).decode('utf-8', 'replace')
+    except CalledProcessError as e:
+        # storcli exits non zero when a single controller fails, the JSON
+        # still describes the others
+        sOutput = (e.output or b'').decode('utf-8', 'replace')
+    return(json.loads(sOutput)['Controllers'])
+
+def getDriveId(iController, iEnclosure, iSlot):
+    """
+    returns:
+     label of a drive, e.g. c0e252s3, c0s3 for drives without enclosure
+    """
+    if iEnclosure is None:
+        return('c{}s{}'.format(iController, iSlot))
+    return('c{}e{}s{}'.format(iController, iEnclosure, iSlot))
+
+def toInt(value):
+    """
+    gets:
+     value: number or string starting with a number, e.g. ' 30C (86.00 F)'
+    returns:
+     int, None if there is no number
+    """
+    if isinstance(value, int):
+        return(value)
+    match = re.match(r'\s*(-?\d+)', str(value))
+    return(int(match.group(1)) if match else None)
+
+def getControllerStatus(dController):
+    """
+    gets:
+     dController: one entry of the JSON Controllers list
+    returns:
+     (iController, error message or None)
+    """
+    dStatus = dController.get('Command Status', {})
+    iController = toInt(dStatus.get('Controller', -1))
+    if dStatus.get('Status') == 'Success':
+        return((iController, None))
+    return((iController, dStatus.get('Description') or dStatus.get('Status') or 'no response'))
+
+def makeDrive(iController, iEnclosure, iSlot, dSummary):
+    """
+    gets:
+     iController, iEnclosure, iSlot: position of the drive
+     dSummary                      : entry of a PD LIST, or the summary of a
+                                     drive in show all
+    returns:
+     drive dict, error counters are None until details are known
+    """
+    dDrive = {
+        'controller': iController,
+        'enclosure' : iEnclosure,
+        'slot'      : iSlot,
+        'id'        : getDriveId(iController, iEnclosure, iSlot),
+        'state'     : dSummary.get('State', '').strip(),
+        'dg'        : toInt(dSummary.get('DG')),
+        'size'      : dSummary.get('Size', ''),
+        'interface' : dSummary.get('Intf', ''),
+        'medium'    : dSummary.get('Med', ''),
+        'model'     : dSummary.get('Model', '').strip()
+    }
+    for sKey in lDetailKeys:
+        dDrive[sKey] = None
+    dDrive['smartFlag'] = 'No'
+    return(dDrive)
+
+def parseDrives(lControllers):
+    """
+    parses /call/eall/sall show all J, or show all of single drives
+    gets:
+     lControllers: JSON Controllers list
+    returns:
+     list of dicts, one per drive
+    """
+    lDrives = []
+    for dController in lControllers:
+        dResponse = dController.get('Response Data', {})
+        for sKey, value in dResponse.items():
+            match = reDrive.match(sKey)
+            if not match or not value:
+                continue
+            iController, sEnclosure, sSlot = match.groups()
+            iEnclosure = int(sEnclosure) if sEnclosure is not None else None
+            dDrive = makeDrive(int(iController), iEnclosure, int(sSlot), value[0])
+            dState = dResponse.get(sKey + ' - Detailed Information', {}).get(sKey + ' State', {})
+            dDrive.update({
+                'mediaErrorCount'       : toInt(dState.get('Media Error Count')),
+                'otherErrorCount'       : toInt(dState.get('Other Error Count')),
+                'BBMErrorCount'         : toInt(dState.get('BBM Error Count')),
+                'predictiveFailureCount': toInt(dState.get('Predictive Failure Count')),
+                'driveTemperature'      : toInt(dState.get('Drive Temperature')),
+                'smartFlag'             : dState.get('S.M.A.R.T alert flagged by drive', 'No')
+            })
+            lDrives.append(dDrive)
+    return(lDrives)
+
+def parseSummaryDrives(lControllers):
+    """
+    parses the PD LIST of /call show J
+    gets:
+     lControllers: JSON Controllers list
+    returns:
+     list of dicts, one per drive, without error counters
+    """
+    lDrives = []
+    for dController in lControllers:
+        iController, sError = getControllerStatus(dController)
+        for dSummary in dController.get('Response Data', {}).get('PD LIST', []):
+            # EID:Slt is '252:3', or ' :3' for drives without enclosure
+            sEnclosure, sSeparator, sSlot = dSummary.get('EID:Slt', '').partition(':')
+            if toInt(sSlot) is None:
+                continue
+            lDrives.append(makeDrive(iController, toInt(sEnclosure), toInt(sSlot), dSummary))
+    return(lDrives)
+
+def parseVirtualDrives(lControllers):
+    """
+    parses /call/vall show J
+    gets:
+     lControllers: JSON Controllers list
+    returns:
+     list of dicts, one per virtual drive
+    """
+    lVirtualDrives = []
+    for dController in lControllers:
+        iController, sError = getControllerStatus(dController)
+        dResponse = dController.get('Response Data', {})
+        for dVirtualDrive in dResponse.get('Virtual Drives', dResponse.get('VD LIST', [])):
+            sDg, sSeparator, sVd = dVirtualDrive.get('DG/VD', '').partition('/')
+            lVirtualDrives.append({
+                'controller': iController,
+                'dg'        : toInt(sDg),
+                'vd'        : toInt(sVd),
+                'id'        : 'c{}v{}'.format(iController, toInt(sVd)),
+                'type'      : dVirtualDrive.get('TYPE', ''),
+                'state'     : dVirtualDrive.get('State', '').strip(),
+                'size'      : dVirtualDrive.get('Size', ''),
+                'name'      : dVirtualDrive.get('Name', '')
+            })
+    return(lVirtualDrives)
+
+def getDrivePath(dDrive):
+    """
+    returns:
+     storcli path of a drive, e.g. /c0/e252/s3
+    """
+    if dDrive['enclosure'] is None:
+        return('/c{}/s{}'.format(dDrive['controller'], dDrive['slot']))
+    return('/c{}/e{}/s{}'.format(dDrive['controller'], dDrive['enclosure'], dDrive['slot']))
+
+def getErrors(dDrive):
+    """
+    returns:
+     list of the error counters and the S.M.A.R.T flag of a drive
+    """
+    return([dDrive[sKey] for sKey in lErrorKeys])
+
+def needsDetails(dDrive, dKnown):
+    """
+    Error counters count over the lifetime of a drive, so a drive is only
+    suspicious if they changed since the last time all drives were queried.
+    gets:
+     dDrive: drive from the summary
+     dKnown: the same drive from the previous collection, None if it is new
+    returns:
+     True if the drive was never queried with show all, is not healthy,
+     changed, or got errors since the last show all of every drive
+    """
+    # some drives, e.g. NVMe, never report counters, so a missing counter
+    # does not mean the drive was not queried
+    if dKnown is None or 'fullErrors' not in dKnown:
+        return(True)
+    if dDrive['state'] not in lGoodDriveStates or dDrive['state'] != dKnown['state']:
+        return(True)
+    return(getErrors(dKnown) != dKnown.get('fullErrors'))
+
+def collect(sStorcli, dPrevious=None, iDetailInterval=900):
+    """
+    Queries every controller, drive and virtual drive with the cheap
+    /call show. The expensive show all only runs for drives that look
+    suspicious, see needsDetails, and for all drives every iDetailInterval
+    seconds. Counters of the other drives are taken from dPrevious. Every
+    drive keeps its counters of the last show all of every drive as
+    fullErrors.
+    gets:
+     sStorcli       : path of the storcli binary
+     dPrevious      : state of the previous collection, None for none
+     iDetailInterval: seconds between two show all of every drive
+    returns:
+     dState = {
+         'controllers'  : [{'controller': 0, 'error': None}],
+         'drives'       : see parseDrives,
+         'virtualDrives': see parseVirtualDrives,
+         'detailTime'   : time every drive was queried in detail the last time,
+         'detailed'     : number of drives queried in detail by this collection
+     }
+    """
+    fNow = time.time()
+    lSummary = runStorcli(sStorcli, ['/call', 'show'])
+    dState = {
+        'controllers'  : [
+            {'controller': iController, 'error': sError}
+            for iController, sError in map(getControllerStatus, lSummary)
+        ],
+        'drives'       : parseSummaryDrives(lSummary),
+        'virtualDrives': parseVirtualDrives(lSummary),
+        'detailTime'   : (dPrevious or {}).get('detailTime'),
+        'detailed'     : 0
+    }
+
+    dKnown = dict((dDrive['id'], dDrive) for dDrive in (dPrevious or {}).get('drives', []))
+    lSuspects = [dDrive for dDrive in dState['drives'] if needsDetails(dDrive, dKnown.get(dDrive['id']))]
+
+    if dState['detailTime'] is None or fNow - dState['detailTime'] >= iDetailInterval or len(lSuspects) > iMaxSingleDetails:
+        lDetails = parseDrives(runStorcli(sStorcli, ['/call/eall/sall', 'show', 'all']))
+        dState['detailTime'] = fNow
+        bFull = True
+    else:
+        bFull = False
+        lDetails = []
+        for dDrive in lSuspects:
+            lDetails += parseDrives(runStorcli(sStorcli, [getDrivePath(dDrive), 'show', 'all']))
+
+    dDetails = dict((dDrive['id'], dDrive) for dDrive in lDetails)
+    dState['detailed'] = len(dDetails)
+    for dDrive in dState['drives']:
+        dSource = dDetails.get(dDrive['id']) or dKnown.get(dDrive['id'])
+        if dSource:
+            for sKey in lDetailKeys:
+                dDrive[sKey] = dSource[sKey]
+        dLast = dKnown.get(dDrive['id'], {})
+        if bFull or 'fullErrors' not in dLast:
+            # drives start from the counters of their first show all
+            dDrive['fullErrors'] = getErrors(dDrive)
+        else:
+            dDrive['fullErrors'] = dLast['fullErrors']
+    return(dState)
+
+def readCache(sStorcli):
+    """
+    gets:
+     sStorcli: path of the storcli binary the data has to come from
+    returns:
+     (dState, fTime it was collected), None if there is no usable cache
+    """
+    bData = lib.statefile.readState(sStateName)
+    if bData is None:
+        return(None)
+    try:
+        dCache = json.loads(bData.decode('utf-8'))
+        if dCache['storcli'] != sStorcli:
+            return(None)
+        return((dCache['state'], float(dCache['time'])))
+    except (ValueError, KeyError, TypeError):
+        return(None)
+
+def getState(sStorcli, iTtl, fLockWait, iDetailInterval):
+    """
+    Returns the cached state while it is younger than iTtl. Otherwise one
+    process refreshes it while holding the lock, concurrent processes wait
+    for it up to fLockWait seconds and then take the old data, if there is
+    any.
+    gets:
+     sStorcli       : path of the storcli binary
+     iTtl           : seconds cached data is used without refreshing, 0 to
+                      always query storcli
+     fLockWait      : seconds to wait for another process refreshing the data
+     iDetailInterval: see collect
+    returns:
+     (dState, fTime it was collected, note about stale data or None)
+    raises:
+     what collect raises, if there is no data to fall back to
+    """
+    cached = readCache(sStorcli)
+    if cached and time.time() - cached[1] < iTtl:
+        return((cached[0], cached[1], None))
+
+    # without any data to fall back to, waiting is the only option
+    with lib.statefile.lockState(sStateName, fLockWait if cached and iTtl > 0 else None) as bLocked:
+        if not bLocked:
+            return((cached[0], cached[1], 'storcli is busy, serving cached data'))
+
+        # another process may have refreshed while this one waited
+        fresh = readCache(sStorcli)
+        if fresh and time.time() - fresh[1] < iTtl:
+            return((fresh[0], fresh[1], None))
+        previous = fresh or cached
+
+        try:
+            dState = collect(sStorcli, previous[0] if previous else None, iDetailInterval)
+        except (OSError, ValueError, KeyError) as e:
+            if not previous or iTtl <= 0:
+                raise
+            return((previous[0], previous[1], 'could not query storcli, serving cached data: {}'.format(e)))
+        fTime = time.time()
+        lib.statefile.writeState(sStateName, json.dumps({
+            'storcli': sStorcli,
+            'time'   : fTime,
+            'state'  : dState
+        }).encode('utf-8'))
+        return((dState, fTime, None))
+
+def indexDrives(lDrives):
+    """
+    gets:
+     lDrives: list of drive dicts
+    returns:
+     OrderedDict (controller, enclosure, slot): drive, sorted
+    """
+    return(OrderedDict(
+        ((dDrive['controller'], dDrive['enclosure'], dDrive['slot']), dDrive)
+        for dDrive in sorted(lDrives, key=lambda d: (d['controller'], d['enclosure'] or -1, d['slot']))
+    ))
+
+def countErrors(dDrive):
+    """
+    returns:
+     media, other and BBM errors of a drive, plus one for a S.M.A.R.T alert
+    """
+    iErrors = sum(dDrive[sKey] or 0 for sKey in ('mediaErrorCount', 'otherErrorCount', 'BBMErrorCount'))
+    if dDrive['smartFlag'] == 'Yes':
+        iErrors += 1
+    return(iErrors)
+
+def compileOutput(dState, dIndex, perfdata):
+    """
+    compiles output and perfdata
+    gets:
+     dState  : see collect
+     dIndex  : see indexDrives
+     perfdata: lib.perfdata.PerfdataWriter
+    returns:
+     (output lines, total errors, total down)
+    """
+    lLines = []
+    iTotalErrors = 0
+    iTotalDown = 0
+
+    for dController in dState['controllers']:
+        if dController['error']:
+            lLines.append('c{} {}'.format(dController['controller'], dController['error']))
+            iTotalDown += 1
+
+    for dDrive in dIndex.values():
+        iTotalErrors += countErrors(dDrive)
+        bUp = dDrive['state'] in lGoodDriveStates
+        if not bUp:
+            iTotalDown += 1
+        perfdata.add(dDrive['id'] + '_State', bUp)
+        perfdata.add(dDrive['id'] + '_MediaErrorCount', dDrive['mediaErrorCount'], 'c')
+        perfdata.add(dDrive['id'] + '_OtherErrorCount', dDrive['otherErrorCount'], 'c')
+        perfdata.add(dDrive['id'] + '_BBMErrorCount', dDrive['BBMErrorCount'], 'c')
+        perfdata.add(dDrive['id'] + '_PredictiveFailureCount', dDrive['predictiveFailureCount'], 'c')
+        perfdata.add(dDrive['id'] + '_Temp', dDrive['driveTemperature'])
+        perfdata.add(dDrive['id'] + '_SMARTTrip', dDrive['smartFlag'] == 'Yes')
+
+    def describe(dDrive):
+        sDrive = '{} {}'.format(dDrive['id'], dDrive['state'])
+        iErrors = countErrors(dDrive)
+        if iErrors:
+            sDrive += ' {} errors'.format(iErrors)
+        return(sDrive)
+
+    setGrouped = set()
+    for dVirtualDrive in sorted(dState['virtualDrives'], key=lambda d: (d['controller'], d['vd'])):
+        sStatus = dVirtualDriveStates.get(dVirtualDrive['state'], 'WARNING')
+        if sStatus == 'CRITICAL':
+            iTotalDown += 1
+        perfdata.add(dVirtualDrive['id'] + '_State', sStatus == 'OK')
+        lMembers = [
+            dDrive for dDrive in dIndex.values()
+            if dDrive['controller'] == dVirtualDrive['controller'] and dDrive['dg'] == dVirtualDrive['dg']
+        ]
+        setGrouped.update(dDrive['id'] for dDrive in lMembers)
+        lLines.append('c{}/v{} {} {} {}: {}'.format(
+            dVirtualDrive['controller'],
+            dVirtualDrive['vd'],
+            dVirtualDrive['type'],
+            dVirtualDrive['state'],
+            dVirtualDrive['size'],
+            ', '.join(describe(dDrive) for dDrive in lMembers)
+        ))
+
+    dUngrouped = OrderedDict()
+    for dDrive in dIndex.values():
+        if dDrive['id'] not in setGrouped:
+            dUngrouped.setdefault(dDrive['controller'], []).append(describe(dDrive))
+    for iController, lDrives in dUngrouped.items():
+        lLines.append('c{} unconfigured: {}'.format(iController, ', '.join(lDrives)))
+
+    return((lLines, iTotalErrors, iTotalDown))
+
+def main():
+    parser = argparse.ArgumentParser(description='Check drives, virtual drives and controllers with storcli.')
+    parser.add_argument('warnErrors', type=int, nargs='?', default=1, help='errors that lead to warning, default 1')
+    parser.add_argument('critErrors', type=int, nargs='?', default=10, help='errors that lead to critical, default 10')
+    parser.add_argument('warnDown', type=int, nargs='?', default=1, help='down drives that lead to warning, default 1')
+    parser.add_argument('critDown', type=int, nargs='?', default=1, help='down drives that lead to critical, default 1')
+    parser.add_argument('-s', '--storcli', type=str, default=sDefaultStorcli, help='path of storcli, default ' + sDefaultStorcli)
+    parser.add_argument('-T', '--cache-ttl', type=int, default=60, help='seconds the storcli data is reused, 0 always queries storcli, default 60')
+    parser.add_argument('-D', '--detail-interval', type=int, default=900, help='seconds between two detailed queries of all drives, default 900')
+    parser.add_argument('-L', '--lock-wait', type=float, default=10.0, help='seconds to wait for another check querying storcli before cached data is used, default 10')
+    args = parser.parse_args()
+
+    try:
+        dState, fTime, sNote = getState(args.storcli, args.cache_ttl, args.lock_wait, args.detail_interval)
+    except (OSError, ValueError, KeyError) as e:
+        print('UNKNOWN check_drives_storcli - could not query storcli: {}'.format(e))
+        sys.exit(3)
+
+    dIndex = indexDrives(dState['drives'])
+    perfdata = lib.perfdata.PerfdataWriter()
+    perfdata.add('data_age', max(0, time.time() - fTime), 's')
+    perfdata.add('detail_age', max(0, time.time() - (dState.get('detailTime') or fTime)), 's')
+    perfdata.add('detailed_drives', dState.get('detailed', 0))
+    lLines, iTotalErrors, iTotalDown = compileOutput(dState, dIndex, perfdata)
+    bDegraded = any(
+        dVirtualDriveStates.get(dVirtualDrive['state'], 'WARNING') == 'WARNING'
+        for dVirtualDrive in dState['virtualDrives']
+    )
+
+    if sNote:
+        lLines.insert(0, sNote)
+    output = 'check_drives_storcli - {} drives on {} controllers, {} errors, {} down, data {}s old\n{}'.format(
+        len(dIndex),
+        len(dState['controllers']),
+        iTotalErrors,
+        iTotalDown,
+        max(0, int(time.time() - fTime)),
+        '\n'.join(lLines)
+    )
+
+    if iTotalErrors >= args.critErrors or iTotalDown >= args.critDown:
+        print(perfdata.formatOutput('CRITICAL ' + output, '|'))
+        sys.exit(2)
+    elif iTotalErrors >= args.warnErrors or iTotalDown >= args.warnDown or bDegraded:
+        print(perfdata.formatOutput('WARNING ' + output, '|'))
+        sys.exit(1)
+    else:
+        print(perfdata.formatOutput('OK ' + output, '|'))
+        sys.exit(0)
 
-storcliOutput = check_output(["/opt/lsi/storcli/storcli", "/c0", "/eall", "/sall", "show", "all"])
-drives = []
-warnErrors = sys.argv[1]
-critErrors = sys.argv[2]
-warnDown = sys.argv[3]
-critDown = sys.argv[4]
-
-i = -1
-storcliOutput = storcliOutput.split('\n')
-for line in storcliOutput:
-	if 'GB SAS' in line:
-		driveID = 's' + str(line.split(':')[1][:1])
-		drives.append({'id':driveID})
-		i += 1
-		if 'Onln' in line:
-			drives[i]['state'] = '1'
-		elif 'Offln' in line:
-			drives[i]['state'] = '0'
-	elif "Media Error Count" in line:
-		mediaErrorCount = str(line.split('=')[1][1:])
-		drives[i]['mediaErrorCount'] = mediaErrorCount
-	elif "Other Error Count" in line:
-		otherErrorCount = str(line.split('=')[1][1:])
-		drives[i]['otherErrorCount'] = otherErrorCount
-	elif "BBM Error Count" in line:
-		BBMErrorCount = str(line.split('=')[1][1:])
-		drives[i]['BBMErrorCount'] = BBMErrorCount
-	elif "Drive Temperature" in line:
-		driveTemperature = str(line.split('=')[1][2:4])
-		drives[i]['driveTemperature'] = driveTemperature
-	elif "Predictive Failure Count" in line:
-		predictiveFailureCount = str(line.split('=')[1][1:])
-		drives[i]['predictiveFailureCount'] = predictiveFailureCount
-	elif "S.M.A.R.T alert flagged by drive" in line:
-		smartFlag = str(line.split('=')[1][1:])
-		drives[i]['smartFlag'] = smartFlag
-	
-output = ''
-#perfdata = ''
-totalErrors = 0
-totalDown = 0
-for drive in drives:
-	totalErrors += int(drive['mediaErrorCount']) + int(drive['otherErrorCount']) + int(drive['BBMErrorCount'])
-	if drive['smartFlag'] == 'Yes': totalErrors += 1
-	if drive['state'] == '0':	totalDown += 1
-	output += drive['id'] + '_State=' + drive['state'] + ' ' + drive['id'] + '_MediaErrorCount=' + drive['mediaErrorCount'] + ' ' + drive['id'] + '_OtherErrorCount=' + drive['otherErrorCount'] + ' ' + drive['id'] + '_BBMErrorCount=' + drive['BBMErrorCount'] + ' ' + drive['id'] + '_PredictiveFailureCount=' + drive['predictiveFailureCount'] + ' ' +drive['id'] + '_Temp=' + drive['driveTemperature'] + ' ' + drive['id'] + '_SMARTTrip=' + drive['smartFlag'] + ' '
-	
-	#perfdata += drive['id'] + '_State=' + drive['state'] + ' ' + drive['id'] + '_MediaErrorCount=' + drive['mediaErrorCount'] + ' ' + drive['id'] + '_OtherErrorCount=' + drive['otherErrorCount'] + ' ' + drive['id'] + '_BBMErrorCount=' + drive['BBMErrorCount'] + ' ' + drive['id'] + '_PredictiveFailureCount=' + drive['predictiveFailureCount'] + ' ' +drive['id'] + '_Temp=' + drive['driveTemperature'] + ' ' + drive['id'] + '_SMARTTrip=' + drive['smartFlag'] + ' '
-
-if int(totalErrors) >= int(critErrors) or int(totalDown) >= int(critDown):
-	print('CRITICAL check_drives_storcli - ' + output + '|' + output)
-elif int(totalErrors) >= int(warnErrors) or int(totalDown) >= int(warnDown):
-	print('WARNING check_drives_storcli - ' + output + '|' + output)
-elif int(totalErrors) < int(warnErrors) and int(totalDown) < int(warnDown):
-	print('OK check_drives_storcli - ' + output + '|' + output)
-else:
-	print('UNKNOWN check_drives_storcli - ' + output + '|' + output)
+if __name__ == "__main__":
+    main()
@@ -1,60 +1,169 @@
 #!/usr/bin/python3
 # check_mem.py - Check Swap and RAM on linux systems
-# if warning or critical stage are reached, displays top processes from ps,
-# sorted by memory utilization
+# if warning or critical stage are reached, displays the processes using
+# the most resident memory
 # for nagios style monitoring systems
 #
+# all values are read from /proc/meminfo, used RAM without buffers is based
+# on MemAvailable. Nothing is forked, processes are only read from /proc when
+# the state is WARNING or CRITICAL
+#
 # copyright C-Store 2016
 # Author Mattis Haase, Leon Kühn
 #
-# usage: check_mem.py -w ramWarnPct -c ramCritPct -W swapWarnPct -C swapCritPct
+# usage: check_mem.py -w ramWarnPct -c ramCritPct -W swapWarnPct -C swapCritPct -n topProcesses
 # output: 
 #  If OK:
 #  OK - check_mem -
 
 #  If WARNING or CRITICAL:
-#  WARNING/CRITICAL - check_mem - 
-#  root    1354  0.0  3.2 124112 33244 ?   Ssl  Jun09  10:17 /usr/bin/ruby /
-#  nagios  5753  0.9  2.3 1316492 24296 ?  Ssl  Sep05  10:16 /usr/lib/x86_64
+#  WARNING/CRITICAL - check_mem - top processes by resident memory:
+#  USER PID %MEM RSS COMMAND
+#  root 1354 3.2 33MB ruby
+#  nagios 5753 2.3 24MB icinga2
 #
-# perfdata:
+# perfdata, in MB and percent:
 # installedram, usedram, freeram, sharedram, buffers\
 #    cached, ramnobuffers, ramfreewithcache, installedswap, usedswap\
 #    freeswap, usedrampct, usedramnobufferspct, usedswappct
 
-from subprocess import check_output
-import re
+import heapq
+import os
+import pwd
 import sys
 import argparse
 
-def parsePs():
-    psOutput = check_output(["ps", "aux", "--sort", "-rss"]).decode('utf-8')
-    return(psOutput.split('\n', 2)[1])
+# shared modules live in lib/ at the top of the repository
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import lib.perfdata
+
+iPageSize = os.sysconf('SC_PAGE_SIZE')
+
+def getProcessOwner(sPid):
+    """
+    gets:
+     sPid: process id
+    returns:
+     name of the user owning the process, uid if it has no name
+    """
+    try:
+        iUid = os.stat('/proc/' + sPid).st_uid
+    except OSError:
+        return '?'
+    try:
+        return pwd.getpwuid(iUid).pw_name
+    except KeyError:
+        return str(iUid)
+
+def getProcessName(sPid):
+    """
+    gets:
+     sPid: process id
+    returns:
+     command name of the process
+    """
+    try:
+        with open('/proc/{}/comm'.format(sPid)) as f:
+            return f.read().strip()
+    except OSError:
+        return '?'
+
+def parseProcesses(iTop, iMaxRamKB):
+    """
+    Finds the processes using the most resident memory. Only /proc/*/statm
+    is read for every process, name and owner are only read for the top
+    processes. Processes that vanish while they are read are skipped.
+    gets:
+     iTop: number of processes to return
+     iMaxRamKB: installed RAM in kB
+    returns:
+     header and one line per process, highest first
+    """
+    lTop = []
+    for sPid in os.listdir('/proc'):
+        if not sPid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/statm'.format(sPid)) as f:
+                # format size resident shared text lib data dt, in pages
+                iResident = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if len(lTop) < iTop:
+            heapq.heappush(lTop, (iResident, sPid))
+        elif iResident > lTop[0][0]:
+            heapq.heapreplace(lTop, (iResident, sPid))
+
+    lLines = ['USER PID %MEM RSS COMMAND']
+    for iResident, sPid in sorted(lTop, reverse=True):
+        iResidentKB = iResident * iPageSize // 1024
+        lLines.append('{} {} {} {}MB {}'.format(
+            getProcessOwner(sPid),
+            sPid,
+            round(100 * iResidentKB / iMaxRamKB, 1),
+            iResidentKB // 1024,
+            getProcessName(sPid)
+        ))
+    return('\n'.join(lLines))
+
+def parseMeminfo():
+    """
+    reads /proc/meminfo
+    returns:
+     dict with all values in MB and percentages, plus maxRamKB
+    """
+    meminfo = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            # format MemTotal:        6158152 kB
+            key, sep, value = line.partition(':')
+            value = value.split()
+            if value:
+                meminfo[key] = int(value[0])
 
-def parseFree():
-    freeOutput = check_output(["free", "m"]).decode('utf-8')
-    reg = re.compile('([0-9]+)')
-    result = reg.findall(freeOutput)
+    # MemAvailable exists since linux 3.14, before that this is what free
+    # calculated as free memory without buffers and cache
+    available = meminfo.get(
+        'MemAvailable',
+        meminfo['MemFree'] + meminfo['Buffers'] + meminfo['Cached'] + meminfo.get('SReclaimable', 0)
+    )
 
     freeValues = {
-        'maxRam':int(result[0]),
-        'usedRam':int(result[1]),
-        'freeRam':int(result[2]),
-        'shared':int(result[3]),
-        'buffers':int(result[4]),
-        'cached':int(result[5]),
-        'usedRamNoBuffers':int(result[6]),
-        'freeRamWithCache':int(result[7]),
-        'maxSwap':int(result[8]),
-        'usedSwap':int(result[9]),
-        'freeSwap':int(result[10])
+        'maxRam':meminfo['MemTotal'] // 1024,
+        'usedRam':(meminfo['MemTotal'] - meminfo['MemFree']) // 1024,
+        'freeRam':meminfo['MemFree'] // 1024,
+        'shared':meminfo.get('Shmem', 0) // 1024,
+        'buffers':meminfo['Buffers'] // 1024,
+        'cached':(meminfo['Cached'] + meminfo.get('SReclaimable', 0)) // 1024,
+        'usedRamNoBuffers':(meminfo['MemTotal'] - available) // 1024,
+        'freeRamWithCache':available // 1024,
+        'maxSwap':meminfo['SwapTotal'] // 1024,
+        'usedSwap':(meminfo['SwapTotal'] - meminfo['SwapFree']) // 1024,
+        'freeSwap':meminfo['SwapFree'] // 1024,
+        'maxRamKB':meminfo['MemTotal']
     }
-    freeValues['usedRamPct'] = int(freeValues['usedRam'] / freeValues['maxRam'] * 100)
-    freeValues['usedRamPctNoBuffers'] = int(freeValues['usedRamNoBuffers'] / freeValues['maxRam'] * 100)
-    freeValues['usedSwapPct'] = int(freeValues['usedSwap'] / freeValues['maxSwap'] * 100)
+    freeValues['usedRamPct'] = int((meminfo['MemTotal'] - meminfo['MemFree']) / meminfo['MemTotal'] * 100)
+    freeValues['usedRamPctNoBuffers'] = int((meminfo['MemTotal'] - available) / meminfo['MemTotal'] * 100)
+    if meminfo['SwapTotal']:
+        freeValues['usedSwapPct'] = int((meminfo['SwapTotal'] - meminfo['SwapFree']) / meminfo['SwapTotal'] * 100)
+    else:
+        freeValues['usedSwapPct'] = 0
 
     return(freeValues)
 
+def positiveInt(sValue):
+    """
+    argparse type of options that need at least 1
+    gets:
+     sValue: value of the option
+    returns:
+     sValue as integer
+    """
+    iValue = int(sValue)
+    if iValue < 1:
+        raise argparse.ArgumentTypeError('has to be at least 1, got {}'.format(iValue))
+    return iValue
+
 def main():
     parser = argparse.ArgumentParser(description='Check RAM and Swap.')
     parser.add_argument(
@@ -85,40 +194,47 @@ def main():
         default = 80,
         type = int
     )
+    parser.add_argument(
+        '-n',
+        '--top',
+        help='integer number of processes listed on warning or critical default 5',
+        default = 5,
+        type = positiveInt
+    )
     arguments = parser.parse_args()
 
-    values = parseFree()
-    perfdata = "installedram={} usedram={} freeram={} sharedram={}"
-    perfdata += " buffers={} cached={} ramnobuffers={} ramfreewithcache={} installedswap={}"
-    perfdata += " usedswap={} freeswap={} usedrampct={} usedramnobufferspct={} usedswappct={}"
-    perfdata = perfdata.format(
-        values['maxRam'],
-        values['usedRam'],
-        values['freeRam'],
-        values['shared'],
-        values['buffers'],
-        values['cached'],
-        values['usedRamNoBuffers'],
-        values['freeRamWithCache'],
-        values['maxSwap'],
-        values['usedSwap'],
-        values['freeSwap'],
-        values['usedRamPct'],
-        values['usedRamPctNoBuffers'],
-        values['usedSwapPct']
-    )
-    psOutput = parsePs()
+    values = parseMeminfo()
+    perfdata = lib.perfdata.PerfdataWriter()
+    for sLabel, sKey in [
+        ('installedram', 'maxRam'),
+        ('usedram', 'usedRam'),
+        ('freeram', 'freeRam'),
+        ('sharedram', 'shared'),
+        ('buffers', 'buffers'),
+        ('cached', 'cached'),
+        ('ramnobuffers', 'usedRamNoBuffers'),
+        ('ramfreewithcache', 'freeRamWithCache'),
+        ('installedswap', 'maxSwap'),
+        ('usedswap', 'usedSwap'),
+        ('freeswap', 'freeSwap')
+    ]:
+        perfdata.add(sLabel, values[sKey])
+    perfdata.add('usedrampct', values['usedRamPct'], '%')
+    perfdata.add('usedramnobufferspct', values['usedRamPctNoBuffers'], '%', arguments.ramwarn, arguments.ramcrit)
+    perfdata.add('usedswappct', values['usedSwapPct'], '%', arguments.swapwarn, arguments.swapcrit)
     if values['usedRamPctNoBuffers'] < arguments.ramwarn and values['usedSwapPct'] < arguments.swapwarn:
-        print('OK - check_mem - | ' + perfdata)
+        print(perfdata.formatOutput('OK - check_mem -'))
         sys.exit(0)
-    elif values['usedRamPctNoBuffers'] >= arguments.ramcrit or values['usedSwapPct'] >= arguments.swapcrit:
-        print('CRITICAL - ' + psOutput + ' | ' + perfdata)
+
+    psOutput = 'check_mem - top processes by resident memory:\n' + parseProcesses(arguments.top, values['maxRamKB'])
+    if values['usedRamPctNoBuffers'] >= arguments.ramcrit or values['usedSwapPct'] >= arguments.swapcrit:
+        print(perfdata.formatOutput('CRITICAL - ' + psOutput))
         sys.exit(2)
     elif values['usedRamPctNoBuffers'] >= arguments.ramwarn or values['usedSwapPct'] >= arguments.swapwarn:
-        print('WARNING - ' + psOutput)
+        print(perfdata.formatOutput('WARNING - ' + psOutput))
         sys.exit(1)
     else:
-        print('UNKNOWN - ' + psOutput + ' | ' + perfdata)
+        print(perfdata.formatOutput('UNKNOWN - ' + psOutput))
         sys.exit(3)
         
 if __name__ == "__main__":
@@ -1,120 +1,553 @@
 #!/usr/bin/python3
-# check_last_changed_ssh.py - Python script that checks last change date of 
+# check_last_changed_ssh.py - Python script that checks last change date of
 # single file, or newest / oldest last change date of all files in folder
 #
 # copyright C-Store 2016
 # Author Mattis Haase
 #
+# Several folders of one host can be checked in one run with -T, which takes
+# PATH=MODE:WARN:CRIT:SERVICE and can be given multiple times. All folders
+# are scanned by one remote command over one SSH session. The results are
+# printed one line per folder, or submitted as passive check results with
+# --passive.
+#
 
 import argparse, sys, os
+import hashlib
+import json
+import zlib
+from subprocess import CalledProcessError, TimeoutExpired
 from time import time
 from sys import exit
 
+# shared modules live in lib/ at the top of the repository, lib/ next to
+# this file holds the modules of the remote checks
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import lib.icingaapi
+import lib.perfdata
+import lib.sftpclient
 import lib.sshcommand
+import lib.statefile
+
+# order in which the states of several folders decide the state of the run
+lStatePriority = [2, 1, 3, 0]
+dStateNames = {0: 'OK', 1: 'WARNING', 2: 'CRITICAL', 3: 'UNKNOWN'}
+# incremental scans: seconds between full scans, format of the state and
+# seconds a directory mtime has to be in the past to be trusted
+iDefaultRescan = 86400
+iStateVersion = 1
+iMtimeSlack = 2
 
-def parse(lDates, sMode):
+def readSummaries(lOutput):
+    """
+    Reads the lines the remote command printed for every folder, one at a
+    time as they arrive
+    Gets:
+      lOutput: iterable of lines, e.g. ['0 3 1213125 1232153473', '1 0 0 0'],
+               index of the folder, number of files, oldest and youngest
+               change date
+    Returns:
+      {index: (number of files, oldest date, youngest date)}
     """
-    Calculates time difference for all files to today, in days
-    Gets: 
-      lDates: ['1213125', '1232153473']
-    Returns: 
-      deltaTime for oldest or youngest file date
+    dSummaries = {}
+    for sLine in lOutput:
+        lFields = sLine.split()
+        if len(lFields) == 4:
+            dSummaries[int(lFields[0])] = tuple(int(sField) for sField in lFields[1:])
+    return dSummaries
+
+def parse(tSummary, sMode):
     """
-    lDelta = []
-    
-    for i, sDate in enumerate(lDates):
-        lDelta.append(float(time()) - int(sDate))
-    
+    Calculates time difference of the oldest or youngest file to today, in days
+    Gets:
+      tSummary: (3, 1213125, 1232153473), number of files, oldest and
+                youngest change date as printed by the remote command
+      sMode:    (oldest|youngest)
+    Returns:
+      (deltaTime for oldest or youngest file date, number of files),
+      deltaTime is None if there are no files
+    """
+    iFiles, iOldest, iYoungest = tSummary
+    if iFiles == 0:
+        return None, 0
+
     if sMode == 'oldest':
-        return int(max(lDelta) / 86400)
+        return int((float(time()) - iOldest) / 86400), iFiles
     elif sMode == 'youngest':
-        return int(min(lDelta) / 86400)
-    
-def check(sUsername, sHostname, sPath, bRecursive, bBSD):
+        return int((float(time()) - iYoungest) / 86400), iFiles
+
+def getFindCommand(sPath, bRecursive, bBSD, iIndex):
     """
-    Performs check
-    Gets: 
-      sUsername: SSH username
-      sHostname: Hostname of remote machine
-      sPath:     Path to folder
+    Builds the remote command for one folder
+    Gets:
+      sPath:      Path to folder
       bRecursive: True if folder should be checked recursively
-      
+      bBSD:       True if the remote machine runs BSD
+      iIndex:     number of the folder, printed in front of its result
     Returns:
-      List of seconds since epoch since last change
+      shell command that prints 'index files oldest youngest'
     """
-    SSHCommand = lib.sshcommand.SSHCommand
-    lLogin = ['{}@{}'.format(sUsername, sHostname)]
     #displays seconds since epoch for all files
     if '"' not in sPath:
         sPath = '"' + sPath + '"'
     if bRecursive:
-        sFindCommand = 'find -type f'
+        sFindCommand = 'find {} -type f'
     elif not bRecursive:
-        sFindCommand = 'find -maxdepth 1 -type f'
-    lFindCommand = sFindCommand.split(' ')
-    lFindCommand.insert(1, sPath)
+        sFindCommand = 'find {} -maxdepth 1 -type f'
     if bBSD:
-        sExecCommand = '-exec stat -f %m "{}" +'
+        sExecCommand = '-exec stat -f %m {} +'
     elif not bBSD:
-        sExecCommand = '-exec stat -c \'%Y\' "{}" \;'
-    lExecCommand = sExecCommand.split(' ')
-    lCommand = lFindCommand + lExecCommand
-    lCommand = lLogin + lCommand
-    return SSHCommand.execute(SSHCommand, lCommand)
-    
-def printResult(iDelta, iWarn, iCrit, sMode):
+        # GNU find prints the dates itself instead of forking stat per file
+        sExecCommand = "-printf '%T@\\n'"
+    # keeps only count, oldest and youngest date. %.0f because %d of mawk
+    # overflows at 2^31
+    sReduceCommand = (
+        "awk 'NR == 1 {o = $1; y = $1} $1 < o {o = $1} $1 > y {y = $1}"
+        " END {printf \"%d %d %.0f %.0f\\n\", " + str(iIndex) + ", NR, int(o), int(y)}'"
+    )
+    return ' '.join([sFindCommand.format(sPath), sExecCommand, '|', sReduceCommand])
+
+def check(sUsername, sHostname, lPaths, bRecursive, bBSD, iPersist=lib.sshcommand.iDefaultPersist, fTimeout=None):
     """
-    Prints check results, terminates program.
+    Performs check. The dates are reduced on the remote machine, only the
+    number of files and the oldest and youngest date of every folder are
+    sent back
+    Gets:
+      sUsername: SSH username
+      sHostname: Hostname of remote machine
+      lPaths:    Paths to folders, all scanned in one SSH session
+      bRecursive: True if folder should be checked recursively
+      iPersist:  seconds the SSH connection is kept for the next check of
+                 the host, 0 to close it
+      fTimeout:  seconds the remote command may take, None for no limit
+
+    Returns:
+      {index in lPaths: (number of files, oldest and youngest seconds since
+      epoch of last change)}
+    """
+    ssh = lib.sshcommand.SSHCommand(iPersist=iPersist)
+    lLogin = ['{}@{}'.format(sUsername, sHostname)]
+    # ; instead of && so a folder that can not be read does not cost the
+    # results of the others
+    sCommand = '; '.join(
+        getFindCommand(sPath, bRecursive, bBSD, iIndex) for iIndex, sPath in enumerate(lPaths)
+    )
+    lCommand = lLogin + [sCommand]
+    return readSummaries(ssh.stream(lCommand, fTimeout))
+
+def getStateName(sUsername, sHostname, sPath):
+    """
+    Gets:
+      sUsername, sHostname, sPath: login and folder of an incremental scan
+    Returns:
+      name of the state of the folder in lib.statefile
+    """
+    sHash = hashlib.sha1('{}@{}:{}'.format(sUsername, sHostname, sPath).encode('utf-8')).hexdigest()[:16]
+    return 'check_last_changed_ssh_{}_{}'.format(''.join(c if c.isalnum() or c in '.-' else '_' for c in sHostname), sHash)
+
+def readDirState(sName):
+    """
+    Gets:
+      sName: name of the state
+    Returns:
+      {'full': time of the last full scan, 'dirs': {directory: [mtime,
+      files, oldest, youngest]}}, None if there is no usable state
+    """
+    bData = lib.statefile.readState(sName)
+    if bData is None:
+        return None
+    try:
+        dState = json.loads(zlib.decompress(bData).decode('utf-8'))
+    except (zlib.error, ValueError):
+        return None
+    if dState.get('version') != iStateVersion:
+        return None
+    return dState
+
+def writeDirState(sName, dState):
+    """
+    Gets:
+      sName:  name of the state
+      dState: see readDirState
+    """
+    dState['version'] = iStateVersion
+    lib.statefile.writeState(sName, zlib.compress(json.dumps(dState, separators=(',', ':')).encode('utf-8')))
+
+def getDirCommand(sPath, bBSD, iIndex):
+    """
+    Builds the remote command that lists the directories of one folder
+    Gets:
+      sPath:  Path to folder
+      bBSD:   True if the remote machine runs BSD
+      iIndex: number of the folder, printed in front of every directory
+    Returns:
+      shell command that prints 'index mtime directory' per directory
+    """
+    if '"' not in sPath:
+        sPath = '"' + sPath + '"'
+    if bBSD:
+        return "find {} -type d -exec stat -f '{} %m %N' {{}} +".format(sPath, iIndex)
+    # -type d does not stat the files, only the directories
+    return "find {} -type d -printf '{} %T@ %p\\n'".format(sPath, iIndex)
+
+def getFileCommand(bBSD):
+    """
+    Builds the remote command that scans the directories it reads from its
+    input, without their subdirectories
+    Gets:
+      bBSD: True if the remote machine runs BSD
+    Returns:
+      shell command that prints 'files oldest youngest directory' per
+      directory that has files
+    """
+    if bBSD:
+        sFindCommand = "find \"$@\" -maxdepth 1 -type f -exec stat -f \"%m %N\" {} +"
+    else:
+        sFindCommand = "find \"$@\" -maxdepth 1 -type f -printf \"%T@ %p\\n\""
+    sReduceCommand = (
+        "awk '{t = $1; p = substr($0, length($1) + 2); sub(/\\/[^\\/]*$/, \"\", p); if (p == \"\") p = \"/\";"
+        " if (!(p in n)) {o[p] = t; y[p] = t} n[p]++; if (t < o[p]) o[p] = t; if (t > y[p]) y[p] = t}"
+        " END {for (p in n) printf \"%d %.0f %.0f %s\\n\", n[p], int(o[p]), int(y[p]), p}'"
+    )
+    return "tr '\\n' '\\0' | xargs -0 sh -c '{}' sh | {}".format(sFindCommand, sReduceCommand)
+
+def checkIncremental(sUsername, sHostname, lPaths, bBSD, iPersist=lib.sshcommand.iDefaultPersist, fTimeout=None, iRescan=iDefaultRescan):
+    """
+    Performs check like check, but only scans the files of directories
+    whose mtime changed since the last run. A directory only changes its
+    mtime when files are added, removed or renamed, files changed in place
+    are found by the full scan every iRescan seconds
+    Gets:
+      sUsername: SSH username
+      sHostname: Hostname of remote machine
+      lPaths:    Paths to folders, always checked recursively
+      bBSD:      True if the remote machine runs BSD
+      iPersist:  seconds the SSH connection is kept for the next check of
+                 the host, 0 to close it
+      fTimeout:  seconds both remote commands may take, None for no limit
+      iRescan:   seconds between full scans
+
+    Returns:
+      {index in lPaths: (number of files, oldest and youngest seconds since
+      epoch of last change)}
+    """
+    ssh = lib.sshcommand.SSHCommand(iPersist=iPersist)
+    lLogin = ['{}@{}'.format(sUsername, sHostname)]
+    fDeadline = None if fTimeout is None else time() + fTimeout
+    fNow = time()
+    lNames = [getStateName(sUsername, sHostname, sPath) for sPath in lPaths]
+    lOld = []
+    for sName in lNames:
+        dState = readDirState(sName)
+        if dState is None or not 0 <= fNow - dState['full'] < iRescan:
+            dState = {'full': fNow, 'dirs': {}}
+        lOld.append(dState)
+
+    # pass 1: all directories with their mtime, and the clock of the remote
+    # machine to spot directories that might still change in this second.
+    # A folder that can not be read prints nothing and is reported as not
+    # scanned, its exit code must not fail the whole command
+    sCommand = '; '.join(['echo now $(date +%s)'] + [
+        '{{ {}; true; }}'.format(getDirCommand(sPath, bBSD, iIndex)) for iIndex, sPath in enumerate(lPaths)
+    ])
+    fRemoteNow = fNow
+    lNew = [{'full': dState['full'], 'dirs': {}} for dState in lOld]
+    setChanged = set()
+    for sLine in ssh.stream(lLogin + [sCommand], fTimeout):
+        lFields = sLine.split(' ', 2)
+        if len(lFields) == 2 and lFields[0] == 'now':
+            fRemoteNow = float(lFields[1])
+            continue
+        if len(lFields) != 3:
+            continue
+        iIndex, sMtime, sDir = int(lFields[0]), lFields[1], lFields[2]
+        lCached = lOld[iIndex]['dirs'].get(sDir)
+        if lCached is None or lCached[0] != sMtime:
+            setChanged.add(sDir)
+            lCached = [sMtime, 0, 0, 0]
+        if float(sMtime) >= fRemoteNow - iMtimeSlack:
+            # a file added later in the same second would not change the
+            # mtime, so the directory is scanned again next time
+            lCached[0] = ''
+        lNew[iIndex]['dirs'][sDir] = lCached
+
+    # pass 2: files of the changed directories
+    if setChanged:
+        fWait = None if fDeadline is None else max(0, fDeadline - time())
+        dScanned = {}
+        for sLine in ssh.stream(lLogin + [getFileCommand(bBSD)], fWait, sorted(setChanged)):
+            lFields = sLine.split(' ', 3)
+            if len(lFields) == 4:
+                dScanned[lFields[3]] = [int(sField) for sField in lFields[:3]]
+        for dState in lNew:
+            for sDir, lCached in dState['dirs'].items():
+                if sDir in setChanged:
+                    lCached[1:] = dScanned.get(sDir, [0, 0, 0])
+
+    dSummaries = {}
+    for iIndex, dState in enumerate(lNew):
+        if not dState['dirs']:
+            continue
+        writeDirState(lNames[iIndex], dState)
+        lFilled = [lCached for lCached in dState['dirs'].values() if lCached[1]]
+        if not lFilled:
+            dSummaries[iIndex] = (0, 0, 0)
+            continue
+        dSummaries[iIndex] = (
+            sum(lCached[1] for lCached in lFilled),
+            min(lCached[2] for lCached in lFilled),
+            max(lCached[3] for lCached in lFilled)
+        )
+    return dSummaries
+
+def checkSFTP(sUsername, sHostname, lPaths, bRecursive, iPersist=lib.sshcommand.iDefaultPersist, fTimeout=None):
+    """
+    Performs check like check, but lists the folders over SFTP instead of
+    running find in a remote shell, for hosts that only allow SFTP
+    Gets:
+      sUsername: SSH username
+      sHostname: Hostname of remote machine
+      lPaths:    Paths to folders, all listed in one SFTP session
+      bRecursive: True if folder should be checked recursively
+      iPersist:  seconds the SSH connection is kept for the next check of
+                 the host, 0 to close it
+      fTimeout:  seconds the listing may take, None for no limit
+
+    Returns:
+      {index in lPaths: (number of files, oldest and youngest seconds since
+      epoch of last change)}
+    """
+    ssh = lib.sshcommand.SSHCommand(iPersist=iPersist)
+    with lib.sftpclient.SFTPClient('{}@{}'.format(sUsername, sHostname), ssh, fTimeout) as sftp:
+        return sftp.summarize(lPaths, bRecursive)
+
+def getResult(iDelta, iWarn, iCrit, sMode):
+    """
+    Judges the age of one folder
     Gets:
       iDelta: biggest/smallest Timedelta in days
       iWarn : days before WARNING
       iCrit : days before CRITICAL
       sMode : (oldest|youngest)
     Returns:
-      prints result to stdout
+      (result text, exit code)
     """
-    iExitcode = 3
     if iDelta >= iCrit:
-        sResult = 'CRITICAL check_last_changed_ssh.py the {} file was modified {} days ago'.format(sMode, iDelta)
-        iExitcode = 2
+        return 'CRITICAL check_last_changed_ssh.py the {} file was modified {} days ago'.format(sMode, iDelta), 2
     elif iDelta >= iWarn:
-        sResult = 'WARNING check_last_changed_ssh.py the {} file was modified {} days ago'.format(sMode, iDelta)
-        iExitcode = 1
+        return 'WARNING check_last_changed_ssh.py the {} file was modified {} days ago'.format(sMode, iDelta), 1
     elif iDelta < iWarn:
-        sResult = 'OK check_last_changed_ssh.py the {} file was modified {} days ago'.format(sMode, iDelta)
-        iExitcode = 0
-    else:
-        sResult = 'UNKNOWN'
-        iExitcode = 3
-    
-    print(sResult)
-    exit(iExitcode)    
-    
+        return 'OK check_last_changed_ssh.py the {} file was modified {} days ago'.format(sMode, iDelta), 0
+    return 'UNKNOWN', 3
+
+def printResult(iDelta, iWarn, iCrit, sMode, iFiles=None):
+    """
+    Prints check results, terminates program.
+    Gets:
+      iDelta: biggest/smallest Timedelta in days
+      iWarn : days before WARNING
+      iCrit : days before CRITICAL
+      sMode : (oldest|youngest)
+      iFiles: number of files checked, added to the perfdata
+    Returns:
+      prints result to stdout
+    """
+    sResult, iExitcode = getResult(iDelta, iWarn, iCrit, sMode)
+
+    perfdata = lib.perfdata.PerfdataWriter()
+    perfdata.add('{}_file_age_days'.format(sMode), iDelta, '', iWarn, iCrit, 0)
+    if iFiles is not None:
+        perfdata.add('files', iFiles)
+    print(perfdata.formatOutput(sResult))
+    exit(iExitcode)
+
+def getTargets(args):
+    """
+    Reads the folders to check from -P and -T
+    Gets:
+      args: parsed arguments
+    Returns:
+      list of {path, mode, warn, crit, service}
+    """
+    lTargets = []
+    if args.path:
+        lTargets.append({'path': args.path, 'mode': args.mode, 'warn': args.warn, 'crit': args.crit, 'service': args.path})
+    for sTarget in args.target:
+        # modes and thresholds contain no =, paths might
+        sPath, sSep, sSettings = sTarget.rpartition('=')
+        if not sSep:
+            sPath, sSettings = sTarget, ''
+        lSettings = (sSettings.split(':', 3) + ['', '', '', ''])[:4]
+        if not sPath or lSettings[0] not in ('', 'oldest', 'youngest'):
+            raise ValueError('-T has to be PATH=MODE:WARN:CRIT:SERVICE, MODE oldest or youngest, got {}'.format(sTarget))
+        lTargets.append({
+            'path': sPath,
+            'mode': lSettings[0] or args.mode,
+            'warn': int(lSettings[1]) if lSettings[1] else args.warn,
+            'crit': int(lSettings[2]) if lSettings[2] else args.crit,
+            'service': lSettings[3] or sPath
+        })
+    return lTargets
+
+def judgeTargets(lTargets, dSummaries):
+    """
+    Judges every folder
+    Gets:
+      lTargets:   list of {path, mode, warn, crit, service}
+      dSummaries: {index: (number of files, oldest, youngest)} of check
+    Returns:
+      list of (target, result text, exit code, perfdata), perfdata a list of
+      arguments of PerfdataWriter.add
+    """
+    lResults = []
+    for iIndex, dTarget in enumerate(lTargets):
+        if iIndex not in dSummaries:
+            lResults.append((dTarget, 'UNKNOWN check_last_changed_ssh.py {} was not scanned'.format(dTarget['path']), 3, []))
+            continue
+        iDelta, iFiles = parse(dSummaries[iIndex], dTarget['mode'])
+        if iDelta is None:
+            lResults.append((dTarget, 'UNKNOWN check_last_changed_ssh.py no files found in {}'.format(dTarget['path']), 3, []))
+            continue
+        sResult, iExitcode = getResult(iDelta, dTarget['warn'], dTarget['crit'], dTarget['mode'])
+        lPerfdata = [
+            ('{}_file_age_days'.format(dTarget['mode']), iDelta, '', dTarget['warn'], dTarget['crit'], 0),
+            ('files', iFiles)
+        ]
+        lResults.append((dTarget, sResult, iExitcode, lPerfdata))
+    return lResults
+
+def printResults(lResults):
+    """
+    Prints one line per folder below a summary, terminates program.
+    Gets:
+      lResults: list of (target, result text, exit code, perfdata)
+    Returns:
+      prints result to stdout
+    """
+    iExitcode = min((iCode for dTarget, sResult, iCode, lPerfdata in lResults), key=lStatePriority.index)
+    dCounts = {}
+    perfdata = lib.perfdata.PerfdataWriter()
+    lLines = []
+    for dTarget, sResult, iCode, lPerfdata in lResults:
+        dCounts[iCode] = dCounts.get(iCode, 0) + 1
+        lLines.append('{}: {}'.format(dTarget['path'], sResult.replace(' check_last_changed_ssh.py', '', 1)))
+        for tPerfdata in lPerfdata:
+            perfdata.add('{}_{}'.format(dTarget['path'], tPerfdata[0]), *tPerfdata[1:])
+    sSummary = '{} check_last_changed_ssh.py {} folders, {}'.format(
+        dStateNames[iExitcode], len(lResults),
+        ', '.join('{} {}'.format(dCounts[iCode], dStateNames[iCode]) for iCode in lStatePriority if iCode in dCounts)
+    )
+    print(perfdata.formatOutput(sSummary + '\n' + '\n'.join(lLines)))
+    exit(iExitcode)
+
+def submitResults(lResults, args):
+    """
+    Submits every folder as passive check result, terminates program.
+    Gets:
+      lResults: list of (target, result text, exit code, perfdata)
+      args:     parsed arguments
+    Returns:
+      prints result of the submission to stdout
+    """
+    sHost = args.icinga_host or args.hostname
+    lPassive = []
+    for dTarget, sResult, iCode, lPerfdata in lResults:
+        perfdata = lib.perfdata.PerfdataWriter()
+        for tPerfdata in lPerfdata:
+            perfdata.add(*tPerfdata)
+        lPassive.append({
+            'host': sHost,
+            'service': dTarget['service'],
+            'exitStatus': iCode,
+            'output': sResult,
+            'perfdata': str(perfdata)
+        })
+    api = lib.icingaapi.IcingaAPI(args.api_url, args.api_user, args.api_password, args.api_ca, not args.api_insecure)
+    lErrors = api.processCheckResults(lPassive)
+    lFailed = [
+        '{}: {}'.format(dResult['service'], sError)
+        for dResult, sError in zip(lPassive, lErrors) if sError
+    ]
+    if lFailed:
+        print('CRITICAL check_last_changed_ssh.py {} of {} results could not be submitted\n{}'.format(
+            len(lFailed), len(lPassive), '\n'.join(lFailed)
+        ))
+        exit(2)
+    print('OK check_last_changed_ssh.py {} results submitted for {}'.format(len(lPassive), sHost))
+    exit(0)
+
 def main():
     iDefaultWarn = 7
     iDefaultCrit = 14
     parser = argparse.ArgumentParser(description='Checks last change dates')
     parser.add_argument('-u', '--username', type=str, required=True, help="ssh username")
     parser.add_argument('-H', '--hostname', type=str, required=True, help="hostname")
-    parser.add_argument('-P', '--path', type=str, required=True, help="path to check")
+    parser.add_argument('-P', '--path', type=str, help="path to check")
+    parser.add_argument('-T', '--target', type=str, default=[], action='append', help="PATH=MODE:WARN:CRIT:SERVICE, another folder to check in the same SSH session, empty settings are taken from -m, -w and -c, SERVICE is used with --passive and defaults to PATH. Can be given multiple times")
     parser.add_argument('-w', '--warn', type=int, default=iDefaultWarn, help="WARNING when file older then n days, default {}".format(iDefaultWarn))
     parser.add_argument('-c', '--crit', type=int, default=iDefaultCrit, help="CRITICAL when file older then n days, default {}".format(iDefaultCrit))
     parser.add_argument('-m', '--mode', type=str, default='youngest', help="judge oldest or youngest date (oldest|youngest)")
     parser.add_argument('-r', '--recursive', type=str, default='true', help="recursively check folders")
     parser.add_argument('-b', '--bsd', type=str, default='false', help="check if using BSD")
+    parser.add_argument('--persist', type=int, default=lib.sshcommand.iDefaultPersist, help="seconds the ssh connection is kept open for the next check of the host, 0 to close it, default {}".format(lib.sshcommand.iDefaultPersist))
+    parser.add_argument('-t', '--timeout', type=float, help="seconds the remote command may take, UNKNOWN if it takes longer, default no limit")
+    parser.add_argument('--backend', type=str, default='shell', choices=['shell', 'sftp'], help="shell runs find on the remote machine, sftp lists the folders over SFTP for hosts without a shell. Default shell")
+    parser.add_argument('-i', '--incremental', action='store_true', help="only scan directories whose mtime changed since the last run, recursive only")
+    parser.add_argument('--rescan', type=int, default=iDefaultRescan, help="incremental only. Seconds between full scans, which find files changed in place. Default {}".format(iDefaultRescan))
+    parser.add_argument('--passive', action='store_true', help="submit every folder as passive check result to the icinga 2 API instead of printing it")
+    parser.add_argument('--icinga-host', type=str, help="passive only. Icinga host object the results belong to. Default: --hostname")
+    parser.add_argument('--api-url', type=str, default='https://localhost:5665', help="passive only. Url of the icinga 2 API. Default https://localhost:5665")
+    parser.add_argument('--api-user', type=str, help="passive only. icinga 2 API user")
+    parser.add_argument('--api-password', type=str, default=os.environ.get('ICINGA2_API_PASSWORD'), help="passive only. Password of the icinga 2 API user. Default: environment variable ICINGA2_API_PASSWORD")
+    parser.add_argument('--api-ca', type=str, help="passive only. CA certificate of the icinga 2 API. Default: system certificates")
+    parser.add_argument('--api-insecure', action='store_true', help="passive only. Do not verify the certificate of the icinga 2 API")
     args = parser.parse_args()
-    
+
+    try:
+        lTargets = getTargets(args)
+    except ValueError as e:
+        print('UNKNOWN check_last_changed_ssh.py {}'.format(e))
+        exit(3)
+    if not lTargets:
+        parser.error('-P or -T is required')
+    if args.incremental and args.backend == 'sftp':
+        parser.error('--incremental needs --backend shell')
+    if args.incremental and args.recursive != 'true':
+        parser.error('--incremental needs --recursive true')
+    if args.passive and (not args.api_user or not args.api_password):
+        parser.error('--passive needs --api-user and --api-password or ICINGA2_API_PASSWORD')
     bRecursive = True if args.recursive == 'true' else False
     bBSD = True if args.bsd == 'true' else False
-    lDates = check(sUsername=args.username, sHostname=args.hostname, sPath=args.path, bRecursive=bRecursive, bBSD=bBSD)
-    assert type(lDates) is list, 'lDates has to be of type list'
-    for i, sDate in enumerate(lDates):
-        assert type(sDate) is str, 'Dates in lDates have to be of type string'
-        if sDate == '':
-            lDates.pop(i)
-    iDelta = parse(lDates=lDates, sMode=args.mode)
+    try:
+        if args.backend == 'sftp':
+            dSummaries = checkSFTP(sUsername=args.username, sHostname=args.hostname, lPaths=[dTarget['path'] for dTarget in lTargets], bRecursive=bRecursive, iPersist=args.persist, fTimeout=args.timeout)
+        elif args.incremental:
+            # find prints directories without the trailing slash
+            dSummaries = checkIncremental(sUsername=args.username, sHostname=args.hostname, lPaths=[dTarget['path'].rstrip('/') or '/' for dTarget in lTargets], bBSD=bBSD, iPersist=args.persist, fTimeout=args.timeout, iRescan=args.rescan)
+        else:
+            dSummaries = check(sUsername=args.username, sHostname=args.hostname, lPaths=[dTarget['path'] for dTarget in lTargets], bRecursive=bRecursive, bBSD=bBSD, iPersist=args.persist, fTimeout=args.timeout)
+    except CalledProcessError as e:
+        print('UNKNOWN check_last_changed_ssh.py ssh to {} failed with exit code {}'.format(args.hostname, e.returncode))
+        exit(3)
+    except lib.sftpclient.SFTPError as e:
+        print('UNKNOWN check_last_changed_ssh.py sftp to {} failed: {}'.format(args.hostname, e))
+        exit(3)
+    except TimeoutExpired:
+        print('UNKNOWN check_last_changed_ssh.py {} did not answer within {} s'.format(args.hostname, args.timeout))
+        exit(3)
+    lResults = judgeTargets(lTargets, dSummaries)
+    if args.passive:
+        submitResults(lResults, args)
+    if len(lResults) > 1 or args.target:
+        printResults(lResults)
+
+    dTarget, sResult, iExitcode, lPerfdata = lResults[0]
+    if iExitcode == 3:
+        print(sResult)
+        exit(3)
+    iDelta, iFiles = parse(dSummaries[0], dTarget['mode'])
     assert type(iDelta) is int, 'iDelta hast to be of type int'
-    printResult(iDelta=iDelta, iWarn=args.warn, iCrit=args.crit, sMode=args.mode)
-    
+    printResult(iDelta=iDelta, iWarn=dTarget['warn'], iCrit=dTarget['crit'], sMode=dTarget['mode'], iFiles=iFiles)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,252 @@
+"""
+Lists remote directories over SFTP, without a remote shell.
+
+The client speaks version 3 of the SFTP protocol, which every SFTP server
+supports, over the sftp subsystem of an ssh process. It shares the
+multiplexed connection of lib/sshcommand.py, so it costs a session, not a
+login. READDIR returns names and attributes for many entries of a
+directory per request, so the server neither forks nor runs stat for the
+client, and the client keeps up to iMaxRequests requests for different
+directories in flight instead of waiting for every answer.
+
+    with SFTPClient('backup@nas1') as sftp:
+        dSummaries = sftp.summarize(['/backup/www', '/backup/db'], True)
+        # dSummaries = {0: (files, oldest mtime, youngest mtime), 1: ...}
+"""
+
+import os
+import selectors
+import stat
+import struct
+import time
+from subprocess import PIPE, Popen, TimeoutExpired
+
+import lib.sshcommand
+
+iVersion = 3
+# packet types
+iInit         = 1
+iVersionReply = 2
+iClose        = 4
+iOpendir      = 11
+iReaddir      = 12
+iStatus       = 101
+iHandle       = 102
+iName         = 104
+# attribute flags
+iAttrSize        = 0x00000001
+iAttrUidGid      = 0x00000002
+iAttrPermissions = 0x00000004
+iAttrAcModTime   = 0x00000008
+iAttrExtended    = 0x80000000
+
+# requests in flight at once, each open directory holds a handle on the
+# server while its READDIR is pending
+iMaxRequests = 64
+# bytes read from the pipe at once
+iReadSize = 65536
+# servers send far smaller packets, a bigger length is a broken stream
+iMaxPacket = 1 << 24
+
+class SFTPError(Exception):
+    """the sftp subsystem failed or answered something unexpected"""
+
+def unpackFrom(sFormat, bData, iOffset=0):
+    """Takes: sFormat = struct format
+              bData   = packet payload
+              iOffset = position of the values
+    Returns: tuple of the values, raises SFTPError if the payload is too
+    short for them"""
+    try:
+        return struct.unpack_from(sFormat, bData, iOffset)
+    except struct.error:
+        raise SFTPError('truncated packet')
+
+def packString(bData):
+    """Takes: bData = bytes
+    Returns: bData as SFTP string, prefixed with its length"""
+    return struct.pack('>I', len(bData)) + bData
+
+def unpackString(bData, iOffset):
+    """Takes: bData   = packet payload
+              iOffset = position of the string
+    Returns: (string as bytes, position after the string)"""
+    iLength, = unpackFrom('>I', bData, iOffset)
+    iOffset += 4
+    if iOffset + iLength > len(bData):
+        raise SFTPError('string exceeds packet')
+    return bData[iOffset:iOffset + iLength], iOffset + iLength
+
+def unpackAttrs(bData, iOffset):
+    """Takes: bData   = packet payload
+              iOffset = position of the attributes
+    Returns: (mode, mtime, position after the attributes), mode and mtime
+    None if the server did not send them"""
+    iFlags, = unpackFrom('>I', bData, iOffset)
+    iOffset += 4
+    iMode = None
+    iMtime = None
+    if iFlags & iAttrSize:
+        iOffset += 8
+    if iFlags & iAttrUidGid:
+        iOffset += 8
+    if iFlags & iAttrPermissions:
+        iMode, = unpackFrom('>I', bData, iOffset)
+        iOffset += 4
+    if iFlags & iAttrAcModTime:
+        iAtime, iMtime = unpackFrom('>II', bData, iOffset)
+        iOffset += 8
+    if iFlags & iAttrExtended:
+        iCount, = unpackFrom('>I', bData, iOffset)
+        iOffset += 4
+        for i in range(iCount * 2):
+            bValue, iOffset = unpackString(bData, iOffset)
+    return iMode, iMtime, iOffset
+
+class SFTPClient:
+    """SFTP session over an ssh process"""
+
+    def __init__(self, sLogin, ssh=None, fTimeout=None):
+        """Starts the sftp subsystem and negotiates the version
+        Takes: sLogin   = user@host
+               ssh      = lib.sshcommand.SSHCommand whose connection is
+                          used, default one with the default persist time
+               fTimeout = seconds the whole session may take, None for no
+                          limit"""
+        self.ssh = ssh or lib.sshcommand.SSHCommand()
+        self.lArgs = ['ssh'] + self.ssh.getOptions() + ['-s', sLogin, 'sftp']
+        self.fTimeout = fTimeout
+        self.fDeadline = None if fTimeout is None else time.monotonic() + fTimeout
+        self.iNextId = 0
+        self.bBuffer = bytearray()
+        self.process = Popen(self.lArgs, stdin=PIPE, stdout=PIPE)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.process.stdout, selectors.EVENT_READ)
+        try:
+            self.send(iInit, struct.pack('>I', iVersion))
+            iType, bPayload = self.readPacket()
+            if iType != iVersionReply:
+                raise SFTPError('server answered INIT with packet type {}'.format(iType))
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Ends the subsystem and the ssh process"""
+        self.selector.close()
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(1)
+        except TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+
+    def send(self, iType, bPayload):
+        """Takes: iType    = packet type
+                  bPayload = packet content after the type"""
+        try:
+            self.process.stdin.write(struct.pack('>IB', len(bPayload) + 1, iType) + bPayload)
+        except OSError as e:
+            raise SFTPError('sftp subsystem closed the connection: {}'.format(e))
+
+    def request(self, iType, bPayload):
+        """Sends a request with a new id
+        Takes: iType    = packet type
+               bPayload = request content after the id
+        Returns: id of the request"""
+        iId = self.iNextId
+        self.iNextId = (self.iNextId + 1) & 0xffffffff
+        self.send(iType, struct.pack('>I', iId) + bPayload)
+        return iId
+
+    def fill(self, iLength):
+        """Reads from the pipe until the buffer holds iLength bytes"""
+        while len(self.bBuffer) < iLength:
+            fWait = None if self.fDeadline is None else self.fDeadline - time.monotonic()
+            if fWait is not None and (fWait <= 0 or not self.selector.select(fWait)):
+                raise TimeoutExpired(self.lArgs, self.fTimeout)
+            bChunk = os.read(self.process.stdout.fileno(), iReadSize)
+            if not bChunk:
+                raise SFTPError('sftp subsystem closed the connection')
+            self.bBuffer += bChunk
+
+    def readPacket(self):
+        """Returns: (packet type, payload after the type) of the next
+        packet of the server"""
+        try:
+            self.process.stdin.flush()
+        except OSError as e:
+            raise SFTPError('sftp subsystem closed the connection: {}'.format(e))
+        self.fill(4)
+        iLength, = unpackFrom('>I', self.bBuffer)
+        if not 1 <= iLength <= iMaxPacket:
+            raise SFTPError('invalid packet length {}'.format(iLength))
+        self.fill(4 + iLength)
+        iType = self.bBuffer[4]
+        bPayload = bytes(self.bBuffer[5:4 + iLength])
+        del self.bBuffer[:4 + iLength]
+        return iType, bPayload
+
+    def summarize(self, lPaths, bRecursive, iRequests=iMaxRequests):
+        """Counts the regular files below folders and finds their oldest and
+        youngest mtime, like find -type f. Symbolic links are not followed,
+        directories that can not be opened are skipped.
+        Takes: lPaths     = paths of the folders
+               bRecursive = False to only look at the files in the folders
+               iRequests  = requests in flight at once
+        Returns: {index in lPaths: (files, oldest mtime, youngest mtime)},
+        mtimes 0 if there are no files"""
+        lSummaries = [[0, 0, 0] for sPath in lPaths]
+        # directories to open, taken from the end, so the walk goes depth
+        # first and the list stays short
+        lDirs = [(iIndex, os.fsencode(sPath)) for iIndex, sPath in reversed(list(enumerate(lPaths)))]
+        # request id: (request type, folder index, directory, handle)
+        dPending = {}
+        while lDirs or dPending:
+            while lDirs and len(dPending) < iRequests:
+                iIndex, bPath = lDirs.pop()
+                dPending[self.request(iOpendir, packString(bPath))] = (iOpendir, iIndex, bPath, None)
+            iType, bPayload = self.readPacket()
+            iId, = unpackFrom('>I', bPayload)
+            if iId not in dPending:
+                raise SFTPError('answer to unknown request {}'.format(iId))
+            iRequest, iIndex, bPath, bHandle = dPending.pop(iId)
+            if iType == iHandle:
+                bHandle, iOffset = unpackString(bPayload, 4)
+                dPending[self.request(iReaddir, packString(bHandle))] = (iReaddir, iIndex, bPath, bHandle)
+            elif iType == iName and iRequest == iReaddir:
+                lSummary = lSummaries[iIndex]
+                iCount, = unpackFrom('>I', bPayload, 4)
+                iOffset = 8
+                for i in range(iCount):
+                    bFilename, iOffset = unpackString(bPayload, iOffset)
+                    bLongname, iOffset = unpackString(bPayload, iOffset)
+                    iMode, iMtime, iOffset = unpackAttrs(bPayload, iOffset)
+                    if iMode is None or bFilename in (b'.', b'..'):
+                        continue
+                    if stat.S_ISREG(iMode) and iMtime is not None:
+                        if lSummary[0] == 0:
+                            lSummary[1] = lSummary[2] = iMtime
+                        lSummary[0] += 1
+                        lSummary[1] = min(lSummary[1], iMtime)
+                        lSummary[2] = max(lSummary[2], iMtime)
+                    elif stat.S_ISDIR(iMode) and bRecursive:
+                        lDirs.append((iIndex, bPath.rstrip(b'/') + b'/' + bFilename))
+                dPending[self.request(iReaddir, packString(bHandle))] = (iReaddir, iIndex, bPath, bHandle)
+            elif iType == iStatus:
+                # end of a directory, or a directory that can not be read
+                if iRequest == iReaddir:
+                    dPending[self.request(iClose, packString(bHandle))] = (iClose, iIndex, bPath, None)
+            else:
+                raise SFTPError('unexpected packet type {} for request type {}'.format(iType, iRequest))
+        return dict((iIndex, tuple(lSummary)) for iIndex, lSummary in enumerate(lSummaries))
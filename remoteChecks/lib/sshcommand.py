@@ -1,36 +1,217 @@
-from subprocess import check_output
+"""
+Runs commands on remote hosts with the ssh client.
+
+Every ssh process used to open its own connection, a TCP handshake, a key
+exchange and an authentication for each check, which is most of the
+runtime of a check that runs one short command. SSHCommand lets ssh
+multiplex its sessions instead: the first command to a host starts a
+master connection in the background that stays up iPersist seconds after
+its last session, and later commands to the same host, port and user run
+as sessions over its socket in <state dir>/ssh. The socket is named by the
+hash ssh makes of the connection (%C), so every check finds the master of
+its host without knowing about the others. The directory has to belong to
+the user of the check with mode 0700, otherwise every command opens its
+own connection.
+
+A master that died, for example with a reboot of the monitoring host,
+leaves its socket behind. cleanup() removes sockets nobody listens on any
+more and runs once per SSHCommand before the first command. Masters whose
+connection hangs are ended by ssh itself after iAliveInterval *
+iAliveCount seconds without an answer of the server.
+
+    ssh = SSHCommand()
+    lLines = ssh.execute(['backup@nas1', 'ls /backup'])
+
+stream() yields the output line by line while the command runs instead,
+so the memory of a check does not grow with the output of the remote
+command, and ends the command if it does not finish in time.
+
+    for sLine in ssh.stream(['backup@nas1', 'find /backup'], fTimeout=50):
+        ...
+"""
+
+import os
+import selectors
+import shutil
+import socket
+import stat
+import threading
+import time
+from subprocess import check_output, CalledProcessError, DEVNULL, PIPE, Popen, TimeoutExpired
+
+import lib.statefile
+
+# seconds a master stays up after its last session, 0 disables multiplexing
+iDefaultPersist = 600
+# seconds between keepalives of a master and keepalives that may go
+# unanswered before it gives up
+iAliveInterval = 10
+iAliveCount = 3
+# sockets need to fit sun_path, which is 104 bytes on BSD
+iMaxSocketPath = 100
+# bytes read from the pipe at once by stream
+iReadSize = 65536
 
 class SSHCommand:
     """checks if ssh exists, executes ssh commands and returns result as list"""
-    
-    def __init__(self):
-        """Asserts that the ssh command exists"""
-        assert ssh_check(self), 'SSH does not exist on this system'
+
+    def __init__(self, iPersist=iDefaultPersist, sControlDir=None):
+        """Asserts that the ssh command exists
+        Takes: iPersist    = seconds a master connection stays up after its
+                             last session, 0 opens a connection per command
+               sControlDir = directory of the master sockets, default
+                             <state dir>/ssh"""
+        assert self.ssh_check(), 'SSH does not exist on this system'
+        self.iPersist = iPersist
+        self.sControlDir = sControlDir or os.path.join(lib.statefile.getStateDir(), 'ssh')
+        self.bCleaned = False
 
     def ssh_check(self):
-        def is_executable(self, sPath):
-            """Takes: sPath = /path/to/files
-            Returns: True if file exists and is executable, else false"""
-            return os.path.isfile(SPath) and os.access(sPath, os.X_OK)
-        
-        sFPath, sFName = os.Path.split('ssh')
-        if sFsPath:
-            if is_executable('ssh'):
-                return True
-        else:
-            for sPath in os.environ["sPath"].split(os.sPathsep):
-                sPath = sPath.strip('"')
-                exe_file = os.sPath.join(sPath, 'ssh')
-                if is_executable(exe_file):
-                    return True
-        return False
+        """Returns: True if ssh is an executable in PATH"""
+        return shutil.which('ssh') is not None
+
+    def isPrivate(self):
+        """Returns: True if the socket directory is a directory of this user
+        that nobody else can enter, so no other user can plant a socket that
+        ssh would send its sessions to"""
+        try:
+            dirStat = os.lstat(self.sControlDir)
+        except OSError:
+            return False
+        return stat.S_ISDIR(dirStat.st_mode) and dirStat.st_uid == os.getuid() and stat.S_IMODE(dirStat.st_mode) == 0o700
+
+    def getOptions(self):
+        """Returns: ssh options that multiplex the connection, empty if
+        multiplexing is off or the socket directory can not be used"""
+        if self.iPersist <= 0:
+            return []
+        # ssh expands %C to 40 hex digits
+        if len(os.path.join(self.sControlDir, 'x' * 40)) > iMaxSocketPath:
+            return []
+        try:
+            os.makedirs(self.sControlDir, mode=0o700, exist_ok=True)
+        except OSError:
+            return []
+        if not self.isPrivate():
+            return []
+        if not self.bCleaned:
+            self.cleanup()
+            self.bCleaned = True
+        return [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={}'.format(os.path.join(self.sControlDir, '%C')),
+            '-o', 'ControlPersist={}'.format(self.iPersist),
+            '-o', 'ServerAliveInterval={}'.format(iAliveInterval),
+            '-o', 'ServerAliveCountMax={}'.format(iAliveCount),
+        ]
+
+    def isAlive(self, sPath):
+        """Takes: sPath = path of a master socket
+        Returns: True if a master listens on the socket"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(sPath)
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+    def cleanup(self):
+        """Removes sockets of masters that are gone
+        Returns: list of the removed socket paths"""
+        lRemoved = []
+        try:
+            lNames = os.listdir(self.sControlDir)
+        except OSError:
+            return lRemoved
+        for sName in lNames:
+            # a master binds to <socket>.<random> and links the final name
+            # once it listens, sockets that are still being set up have a dot
+            if '.' in sName:
+                continue
+            sPath = os.path.join(self.sControlDir, sName)
+            try:
+                if not stat.S_ISSOCK(os.lstat(sPath).st_mode):
+                    continue
+                if not self.isAlive(sPath):
+                    os.unlink(sPath)
+                    lRemoved.append(sPath)
+            except OSError:
+                pass
+        return lRemoved
 
     def execute(self, lCommand):
-        """Takes: lCommand = ['ls', 'l', 'a', '/a/path']
+        """Takes: lCommand = ['user@host', 'ls', '-l', '-a', '/a/path']
         Returns:  Output of command, as list."""
         assert type(lCommand) is list, 'lCommand must be a list'
-        for sElement in lCommand: 
+        for sElement in lCommand:
             assert type(sElement) is str, 'elements of lCommand must be string'
-        
-        sOutput = check_output(['ssh'] + lCommand)
+
+        sOutput = check_output(['ssh'] + self.getOptions() + lCommand)
         return sOutput.decode('utf-8').split('\n')
+
+    def writeInput(self, fInput, lInput):
+        """Writes lines to the input of a command and closes it, runs in its
+        own thread so the command never waits for its output to be read
+        Takes: fInput = stdin pipe of the command
+               lInput = iterable of lines without line endings"""
+        try:
+            for sLine in lInput:
+                fInput.write(sLine.encode('utf-8') + b'\n')
+        except OSError:
+            # the command ended before it read everything
+            pass
+        finally:
+            try:
+                fInput.close()
+            except OSError:
+                pass
+
+    def stream(self, lCommand, fTimeout=None, lInput=None):
+        """Runs a command and yields its output while it arrives. Only one
+        line and one read of the pipe are kept in memory. If the caller
+        stops early, the command is ended.
+        Takes: lCommand = ['user@host', 'find', '/a/path']
+               fTimeout = seconds the command may run, None for no limit
+               lInput   = iterable of lines the command gets as input, None
+                          for no input
+        Yields: lines of the output, without line endings
+        Raises: TimeoutExpired if the command did not finish in time,
+        CalledProcessError if it failed"""
+        assert type(lCommand) is list, 'lCommand must be a list'
+        for sElement in lCommand:
+            assert type(sElement) is str, 'elements of lCommand must be string'
+
+        lArgs = ['ssh'] + self.getOptions() + lCommand
+        fDeadline = None if fTimeout is None else time.monotonic() + fTimeout
+        process = Popen(lArgs, stdin=DEVNULL if lInput is None else PIPE, stdout=PIPE)
+        if lInput is not None:
+            threading.Thread(target=self.writeInput, args=(process.stdin, lInput), daemon=True).start()
+        selector = selectors.DefaultSelector()
+        selector.register(process.stdout, selectors.EVENT_READ)
+        try:
+            bPending = b''
+            while True:
+                fWait = None if fDeadline is None else fDeadline - time.monotonic()
+                if fWait is not None and (fWait <= 0 or not selector.select(fWait)):
+                    raise TimeoutExpired(lArgs, fTimeout)
+                bChunk = os.read(process.stdout.fileno(), iReadSize)
+                if not bChunk:
+                    break
+                lLines = (bPending + bChunk).split(b'\n')
+                bPending = lLines.pop()
+                for bLine in lLines:
+                    yield bLine.decode('utf-8', 'replace')
+            if bPending:
+                yield bPending.decode('utf-8', 'replace')
+            fWait = None if fDeadline is None else max(0, fDeadline - time.monotonic())
+            iReturncode = process.wait(fWait)
+            if iReturncode != 0:
+                raise CalledProcessError(iReturncode, lArgs)
+        finally:
+            selector.close()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
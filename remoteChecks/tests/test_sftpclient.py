@@ -0,0 +1,170 @@
+"""
+Tests of lib/sftpclient.py against a minimal SFTP version 3 server on the
+pipes of a fake ssh, which serves the local file system.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# lib/ of remoteChecks and of the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+import lib.sftpclient
+import lib.sshcommand
+
+# answers INIT, OPENDIR, READDIR and CLOSE, READDIR with SFTPD_CHUNK entries
+# at most. SFTPD_BREAK=truncate cuts the NAME packets short,
+# SFTPD_BREAK=type sends them with an unknown packet type.
+sFakeServer = r'''
+import os, struct, sys
+inp, out = sys.stdin.buffer, sys.stdout.buffer
+iChunk = int(os.environ.get('SFTPD_CHUNK', '100'))
+sBreak = os.environ.get('SFTPD_BREAK', '')
+dHandles = {}
+iHandles = 0
+
+def read(iLength):
+    bData = inp.read(iLength)
+    if len(bData) < iLength:
+        sys.exit(0)
+    return bData
+
+def string(bData):
+    return struct.pack('>I', len(bData)) + bData
+
+def send(iType, bPayload):
+    out.write(struct.pack('>IB', len(bPayload) + 1, iType) + bPayload)
+    out.flush()
+
+def status(iId, iCode):
+    send(101, struct.pack('>II', iId, iCode) + string(b'') + string(b''))
+
+while True:
+    iLength, = struct.unpack('>I', read(4))
+    bPacket = read(iLength)
+    iType, bPayload = bPacket[0], bPacket[1:]
+    if iType == 1:
+        send(2, struct.pack('>I', 3))
+        continue
+    iId, = struct.unpack_from('>I', bPayload)
+    iArg, = struct.unpack_from('>I', bPayload, 4)
+    bArg = bPayload[8:8 + iArg]
+    if iType == 11:
+        try:
+            lEntries = sorted(os.listdir(bArg)) + [b'.', b'..']
+        except OSError:
+            status(iId, 2)
+            continue
+        iHandles += 1
+        bHandle = str(iHandles).encode()
+        dHandles[bHandle] = (bArg, lEntries)
+        send(102, struct.pack('>I', iId) + string(bHandle))
+    elif iType == 12:
+        bDir, lEntries = dHandles[bArg]
+        if not lEntries:
+            status(iId, 1)
+            continue
+        dHandles[bArg] = (bDir, lEntries[iChunk:])
+        bBody = b''
+        for bName in lEntries[:iChunk]:
+            st = os.lstat(os.path.join(bDir, bName))
+            bBody += string(bName) + string(b'longname') + struct.pack('>IQIIIII', 0xf, st.st_size, st.st_uid, st.st_gid, st.st_mode, int(st.st_atime), int(st.st_mtime))
+        bPacket = struct.pack('>II', iId, len(lEntries[:iChunk])) + bBody
+        if sBreak == 'truncate':
+            send(104, bPacket[:-6])
+        elif sBreak == 'type':
+            send(42, bPacket)
+        else:
+            send(104, bPacket)
+    elif iType == 4:
+        dHandles.pop(bArg, None)
+        status(iId, 0)
+    else:
+        status(iId, 8)
+'''
+
+class TestSummarize(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.sDir = self.tmp.name
+        sBin = os.path.join(self.sDir, 'bin')
+        os.mkdir(sBin)
+        with open(os.path.join(sBin, 'sftpd.py'), 'w') as f:
+            f.write(sFakeServer)
+        sSSH = os.path.join(sBin, 'ssh')
+        with open(sSSH, 'w') as f:
+            f.write('#!/bin/sh\nexec {} {}\n'.format(sys.executable, os.path.join(sBin, 'sftpd.py')))
+        os.chmod(sSSH, 0o755)
+        patcher = mock.patch.dict(os.environ, {'PATH': sBin + os.pathsep + os.environ.get('PATH', '')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sTree = os.path.join(self.sDir, 'tree')
+
+    def makeFile(self, sPath, iMtime):
+        sPath = os.path.join(self.sTree, sPath)
+        os.makedirs(os.path.dirname(sPath), exist_ok=True)
+        open(sPath, 'w').close()
+        os.utime(sPath, (iMtime, iMtime))
+        return sPath
+
+    def summarize(self, lPaths, bRecursive, **kwargs):
+        with lib.sftpclient.SFTPClient('user@host', lib.sshcommand.SSHCommand(iPersist=0), fTimeout=10) as sftp:
+            return sftp.summarize([os.path.join(self.sTree, sPath) for sPath in lPaths], bRecursive, **kwargs)
+
+    def makeTree(self):
+        self.makeFile('a/1', 1000)
+        self.makeFile('a/2', 3000)
+        self.makeFile('a/sub/3', 500)
+        self.makeFile('a/sub/deeper/4', 9000)
+        self.makeFile('b/5', 2000)
+        os.mkdir(os.path.join(self.sTree, 'empty'))
+        # neither the link nor its target below the link count
+        os.symlink(os.path.join(self.sTree, 'b'), os.path.join(self.sTree, 'a', 'link'))
+
+    def test_recursive(self):
+        self.makeTree()
+        self.assertEqual(self.summarize(['a', 'b', 'empty'], True), {0: (4, 500, 9000), 1: (1, 2000, 2000), 2: (0, 0, 0)})
+
+    def test_not_recursive(self):
+        self.makeTree()
+        self.assertEqual(self.summarize(['a', 'a/sub'], False), {0: (2, 1000, 3000), 1: (1, 500, 500)})
+
+    def test_missing_folder_is_skipped(self):
+        self.makeTree()
+        self.assertEqual(self.summarize(['missing', 'b'], True), {0: (0, 0, 0), 1: (1, 2000, 2000)})
+
+    def test_many_entries_and_requests(self):
+        for i in range(30):
+            for j in range(7):
+                self.makeFile('d{}/f{}'.format(i, j), 1000 + i * 10 + j)
+        with mock.patch.dict(os.environ, {'SFTPD_CHUNK': '3'}):
+            dParallel = self.summarize([''], True)
+            dSerial = self.summarize([''], True, iRequests=1)
+        self.assertEqual(dParallel, {0: (210, 1000, 1296)})
+        self.assertEqual(dSerial, dParallel)
+
+    def test_truncated_packet(self):
+        self.makeTree()
+        with mock.patch.dict(os.environ, {'SFTPD_BREAK': 'truncate'}):
+            with self.assertRaises(lib.sftpclient.SFTPError):
+                self.summarize(['a'], True)
+
+    def test_unexpected_packet_type(self):
+        self.makeTree()
+        with mock.patch.dict(os.environ, {'SFTPD_BREAK': 'type'}):
+            with self.assertRaises(lib.sftpclient.SFTPError):
+                self.summarize(['a'], True)
+
+    def test_subsystem_missing(self):
+        with open(os.path.join(self.sDir, 'bin', 'ssh'), 'w') as f:
+            f.write('#!/bin/sh\nexit 255\n')
+        with self.assertRaises(lib.sftpclient.SFTPError):
+            self.summarize(['a'], True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+"""
+Tests of lib/sshcommand.py that need no ssh server: the socket directory
+checks, the options, the cleanup of sockets of dead masters and stream.
+ssh itself is replaced by a script in a temporary PATH.
+"""
+
+import os
+import socket
+import stat
+import sys
+import tempfile
+import time
+import unittest
+from subprocess import CalledProcessError, TimeoutExpired
+from unittest import mock
+
+# lib/ of remoteChecks and of the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+import lib.sshcommand
+
+# runs the remote command locally, options are never given because the
+# tests that stream use iPersist=0
+sFakeSSH = '#!/bin/sh\nshift\nexec sh -c "$*"\n'
+
+class SSHTestCase(unittest.TestCase):
+    """temporary directory and a fake ssh first in PATH"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        # sockets need to fit sun_path, so the directory has to stay short
+        self.sDir = self.tmp.name
+        sBin = os.path.join(self.sDir, 'bin')
+        os.mkdir(sBin)
+        sSSH = os.path.join(sBin, 'ssh')
+        with open(sSSH, 'w') as f:
+            f.write(sFakeSSH)
+        os.chmod(sSSH, 0o755)
+        patcher = mock.patch.dict(os.environ, {'PATH': sBin + os.pathsep + os.environ.get('PATH', '')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def makeControlDir(self, iMode=0o700):
+        sControlDir = os.path.join(self.sDir, 'ssh')
+        os.mkdir(sControlDir)
+        os.chmod(sControlDir, iMode)
+        return sControlDir
+
+class TestSocketDirectory(SSHTestCase):
+
+    def test_private_directory(self):
+        ssh = lib.sshcommand.SSHCommand(sControlDir=self.makeControlDir())
+        self.assertTrue(ssh.isPrivate())
+
+    def test_directory_open_to_others(self):
+        ssh = lib.sshcommand.SSHCommand(sControlDir=self.makeControlDir(0o755))
+        self.assertFalse(ssh.isPrivate())
+        self.assertEqual(ssh.getOptions(), [])
+
+    def test_symlink_to_private_directory(self):
+        sLink = os.path.join(self.sDir, 'link')
+        os.symlink(self.makeControlDir(), sLink)
+        ssh = lib.sshcommand.SSHCommand(sControlDir=sLink)
+        self.assertFalse(ssh.isPrivate())
+        self.assertEqual(ssh.getOptions(), [])
+
+    def test_directory_of_another_user(self):
+        if os.getuid() != 0:
+            self.skipTest('only root can give a directory away')
+        sControlDir = self.makeControlDir()
+        os.chown(sControlDir, 65534, -1)
+        ssh = lib.sshcommand.SSHCommand(sControlDir=sControlDir)
+        self.assertFalse(ssh.isPrivate())
+        self.assertEqual(ssh.getOptions(), [])
+
+    def test_missing_directory(self):
+        ssh = lib.sshcommand.SSHCommand(sControlDir=os.path.join(self.sDir, 'missing'))
+        self.assertFalse(ssh.isPrivate())
+
+class TestOptions(SSHTestCase):
+
+    def test_created_directory_is_used(self):
+        sControlDir = os.path.join(self.sDir, 'ssh')
+        lOptions = lib.sshcommand.SSHCommand(iPersist=60, sControlDir=sControlDir).getOptions()
+        self.assertIn('ControlPath={}'.format(os.path.join(sControlDir, '%C')), lOptions)
+        self.assertIn('ControlPersist=60', lOptions)
+        self.assertEqual(stat.S_IMODE(os.lstat(sControlDir).st_mode), 0o700)
+
+    def test_persist_0_does_not_multiplex(self):
+        self.assertEqual(lib.sshcommand.SSHCommand(iPersist=0, sControlDir=self.makeControlDir()).getOptions(), [])
+
+    def test_path_too_long_for_sockets(self):
+        sControlDir = os.path.join(self.sDir, 'x' * lib.sshcommand.iMaxSocketPath)
+        self.assertEqual(lib.sshcommand.SSHCommand(sControlDir=sControlDir).getOptions(), [])
+        self.assertFalse(os.path.exists(sControlDir))
+
+class TestCleanup(SSHTestCase):
+
+    def bind(self, sPath):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.bind(sPath)
+        return sock
+
+    def test_removes_only_dead_sockets(self):
+        sControlDir = self.makeControlDir()
+        sAlive = os.path.join(sControlDir, 'a' * 40)
+        sDead = os.path.join(sControlDir, 'b' * 40)
+        sSetup = os.path.join(sControlDir, 'c' * 40 + '.XXXXXXXX')
+        sFile = os.path.join(sControlDir, 'd' * 40)
+        self.bind(sAlive).listen(1)
+        self.bind(sDead).close()
+        self.bind(sSetup).close()
+        open(sFile, 'w').close()
+
+        ssh = lib.sshcommand.SSHCommand(sControlDir=sControlDir)
+        self.assertEqual(ssh.cleanup(), [sDead])
+        self.assertEqual(sorted(os.listdir(sControlDir)), sorted(os.path.basename(sPath) for sPath in [sAlive, sSetup, sFile]))
+
+    def test_runs_once_before_the_first_command(self):
+        sControlDir = self.makeControlDir()
+        ssh = lib.sshcommand.SSHCommand(sControlDir=sControlDir)
+        with mock.patch.object(ssh, 'cleanup', return_value=[]) as cleanup:
+            ssh.getOptions()
+            ssh.getOptions()
+        self.assertEqual(cleanup.call_count, 1)
+
+    def test_missing_directory(self):
+        ssh = lib.sshcommand.SSHCommand(sControlDir=os.path.join(self.sDir, 'missing'))
+        self.assertEqual(ssh.cleanup(), [])
+
+class TestStream(SSHTestCase):
+
+    def stream(self, sCommand, **kwargs):
+        return lib.sshcommand.SSHCommand(iPersist=0).stream(['user@host', sCommand], **kwargs)
+
+    def assertGone(self, sPidFile):
+        """the remote command, which wrote its pid to sPidFile, was ended
+        and reaped"""
+        with open(sPidFile) as f:
+            iPid = int(f.read())
+        with self.assertRaises(ProcessLookupError):
+            os.kill(iPid, 0)
+
+    def test_lines(self):
+        lLines = list(self.stream('printf "a\\nb b\\n\\nlast"'))
+        self.assertEqual(lLines, ['a', 'b b', '', 'last'])
+
+    def test_output_larger_than_one_read(self):
+        iLines = 3 * lib.sshcommand.iReadSize // 10
+        lLines = list(self.stream('seq 100000001 {}'.format(100000000 + iLines)))
+        self.assertEqual(len(lLines), iLines)
+        self.assertEqual(lLines[-1], str(100000000 + iLines))
+
+    def test_input(self):
+        lLines = list(self.stream('cat', lInput=('line {}'.format(i) for i in range(10000))))
+        self.assertEqual(lLines, ['line {}'.format(i) for i in range(10000)])
+
+    def test_failed_command(self):
+        with self.assertRaises(CalledProcessError) as context:
+            list(self.stream('echo partial; exit 3'))
+        self.assertEqual(context.exception.returncode, 3)
+
+    def test_timeout_ends_the_command(self):
+        sPidFile = os.path.join(self.sDir, 'pid')
+        fStart = time.monotonic()
+        with self.assertRaises(TimeoutExpired):
+            list(self.stream('echo $$ > {}; echo started; exec sleep 30'.format(sPidFile), fTimeout=0.5))
+        self.assertLess(time.monotonic() - fStart, 5)
+        self.assertGone(sPidFile)
+
+    def test_timeout_without_output(self):
+        fStart = time.monotonic()
+        with self.assertRaises(TimeoutExpired):
+            list(self.stream('exec sleep 30', fTimeout=0.3))
+        self.assertLess(time.monotonic() - fStart, 5)
+
+    def test_caller_stops_early(self):
+        sPidFile = os.path.join(self.sDir, 'pid')
+        lines = self.stream('echo $$ > {}; echo first; exec sleep 30'.format(sPidFile))
+        self.assertEqual(next(lines), 'first')
+        fStart = time.monotonic()
+        lines.close()
+        self.assertLess(time.monotonic() - fStart, 5)
+        self.assertGone(sPidFile)
+
+if __name__ == '__main__':
+    unittest.main()
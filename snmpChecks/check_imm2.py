@@ -2,14 +2,23 @@
 # check_imm2.py - IMM2
 # for nagios style monitoring systems
 #
-# this checks via SNMP v3
+# this checks via SNMP v3, spoken in-process by lib/snmpv3.py. Engine and
+# localized keys of every host are cached in /var/tmp/icinga2checks
 #
 # copyright C-Store 2016
 # Author Mattis Haase
 import argparse
 from sys import exit
-from subprocess import check_output
 from collections import OrderedDict
+import os
+import sys
+
+# shared modules live in lib/ at the top of the repository
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import lib.oidtree
+import lib.perfdata
+import lib.responsecache
+import lib.snmpv3
 
 # define all oids
 tree= {
@@ -74,6 +83,13 @@ tree= {
     }
 }
 
+# OidTree of every module, see getOidTree
+oidTrees = {}
+
+# modules whose leaves are single instances, fetched with one GET. The
+# leaves of all other modules are table columns, fetched with GETBULK
+instanceModules = ['hwhealth']
+
 # gets: property in format synology.system.temperature
 # returns: oid, for example: .1.3.6.1.4.1.6574.1.2.0
 def getOID(property):
@@ -81,49 +97,62 @@ def getOID(property):
     leaves = property.split('.')
     return tree[leaves[0]][leaves[1]]
 
-def performCheck(oid, user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo):
-    if level == "authPriv":
-        output = check_output(['snmpwalk', '-v', '3', '-l', 'authPriv', '-u', user, '-a', authAlgo, '-A', authPasswd, '-x', privAlgo, '-X', privPasswd, ip, oid, '-t', '10'])
-    elif level == 'authNoPriv':
-        output = check_output(['snmpwalk', '-v', '3', '-l', 'authNoPriv', '-u', user, '-a', authAlgo, '-A', authPasswd, ip, oid, '-t', '10'])
-    elif level == 'noAuthNoPriv':
-        output = check_output(['snmpwalk', '-v', '3', '-l', 'noAuthNoPriv', '-u', user, ip, oid, '-t', '10'])
-    return output.decode('utf-8').replace('"', '').split('\n')
+# gets: property in format ibm.disks
+# returns: (instance oids, column oids) of all leaves configured in tree
+def getRequestPlan(property):
+    leaves = property.split('.')
+    oids = [getOID(property) + '.' + element for element in tree[leaves[1]].values()]
+    if leaves[1] in instanceModules:
+        return oids, []
+    return [], oids
+
+# gets: property in format ibm.disks, SNMPv3 credentials, host, security
+#       level, port and the ResponseCache of the host, None to not cache
+# returns: list of (oid tuple, typed value) of the configured leaves only,
+#          in the order a walk of the subtree would return them
+def performCheck(property, user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port=161, cache=None):
+    return performChecks([property], user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port, cache)[property]
+
+# gets: list of properties in format ibm.disks, SNMPv3 credentials, host,
+#       security level, port, the ResponseCache of the host, None to not
+#       cache, and the time.monotonic() the session has to end by, None for
+#       no limit
+# returns: dict of property: varbinds like performCheck, all that are not
+#          cached fetched in one session
+def performChecks(properties, user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port=161, cache=None, deadline=None):
+    if cache is not None:
+        return cache.fetch(properties, lambda missing: performChecks(
+            missing, user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port, deadline=deadline
+        ))
+    with lib.snmpv3.Session(ip, user, level, authAlgo, authPasswd, privAlgo, privPasswd, iPort=port, fTimeout=10.0, iRetries=1, fDeadline=deadline) as session:
+        return session.fetchGroups(OrderedDict((property, getRequestPlan(property)) for property in properties))
 
-# gets: output of snmpwalk
+# gets: property in format ibm.disks
+# returns: OidTree of the leaves of the module, built once per module
+def getOidTree(property):
+    if property not in oidTrees:
+        leaves = property.split('.')
+        oidTrees[property] = lib.oidtree.OidTree(getOID(property), tree[leaves[1]])
+    return oidTrees[property]
+
+# gets: varbinds of performCheck
 #       property in format: ibm.disks
-# returns: dict of format {systemStatus:1,temperature:40,...}
+# returns: dict of format {hwhealth.hwStatus:255,...}, table columns as
+#          {disks.disk_Status.11:Online,...} with the full row index, column
+#          after column
 def mapOutput(output, property):
     leaves = property.split('.')
-    # return list of format ('ibm', 'disks')
+    scalars, rows = getOidTree(property).parse(output)
     d = OrderedDict()
-    for line in output:
-        if ':' in line:
-            # line of format iso.3.6.1.4.1.2.3.51.3.1.13.1.3.1.20.1 = STRING: "Drive"
-            line = line.replace(' ', '').split('=')
-            # return list of format ('iso.3.6.1.4.1.2.3.51.3.1.13.1.3.1.20.1', 'STRING:"Drive"')
-            line[0] = line[0].replace('iso', '1')
-            line[1] = line[1].split(':')[1]
-            # return list of format ('1.3.6.1.4.1.2.3.51.3.1.13.1.3.1.20.1', '"Drive"')
-            for key, element in tree[leaves[1]].items():
-                # for element in disks oid = element
-                oid = tree[leaves[0]][leaves[1]] + '.' + element
-                # oid = tree[ibm][disks].element
-                newKey = ''
-                flag = False
-                #if its oid.number then there are multiple properties
-                #(like multiple disks). so newkey = disk.status.id
-                if oid + '.' in line[0]:
-                    newKey = leaves[1] + '.' + key + '.' + line[0][-1:]
-                    flag = True
-                #if its just oid then there is only one property
-                #so newkey = disk.status
-                elif oid in line[0]:
-                    newKey = leaves[1] + '.' + key
-                    flag = True
-                if flag == True:
-                    d[newKey] = line[1]
-                    flag = False
+    # the checks were written against snmpwalk output with all spaces
+    # and quotes removed, values are still compared that way
+    for key, value in scalars.items():
+        d[leaves[1] + '.' + key] = lib.snmpv3.toText(value).replace(' ', '').replace('"', '')
+    for key in tree[leaves[1]]:
+        for index, row in rows.items():
+            if key in row:
+                newKey = leaves[1] + '.' + key + '.' + lib.oidtree.formatIndex(index)
+                d[newKey] = lib.snmpv3.toText(row[key]).replace(' ', '').replace('"', '')
     return d
 
 def checkFans(output):
@@ -133,7 +162,7 @@ def checkFans(output):
     mappedOutput = mapOutput(output, 'ibm.fans')
     criticalFans = 0
     failedFans = []
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         if 'fanStatus' in property:
             # count offline fans
             if value == '"Critical"':
@@ -148,7 +177,7 @@ def checkFans(output):
                 mappedOutput[property] = mappedOutput[property][0:2]
             else:
                 mappedOutput[property] = mappedOutput[property]
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         propertyList = property.split('.')
         if len(propertyList) == 3:
             newname = 'fan{}.pct'.format(propertyList[2])
@@ -171,19 +200,19 @@ def checkTemperatures(output):
     names = {}
     criticalTemps = []
 
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         # store the names and remove them
         if 'name' in property:
             # get the name of the sensor and remove the 'Temp'
             names[property.split('.')[2]] = value[:-4]
             mappedOutput.pop(property, None)
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         leaves = property.split('.')
         if len(leaves) == 3:
             # = [temperatures, tempStatus, 2]
             newName = '{}.{}'.format(names[leaves[2]], leaves[1])
             mappedOutput[newName] = mappedOutput.pop(property)
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         # count critical temperaturs
         if 'status' in property:
             if value == 'Critical':
@@ -204,20 +233,20 @@ def checkVoltages(output):
     nonPerfdata = ''
     mappedOutput = mapOutput(output, 'ibm.voltages')
     names = {}
-    criticalTemps = []
-    for property, value in mappedOutput.items():
+    criticalVoltages = []
+    for property, value in list(mappedOutput.items()):
         # store the names and remove them
         if 'name' in property:
             # get the name of the sensor and remove the 'Temp'
             names[property.split('.')[2]] = value
             mappedOutput.pop(property, None)
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         leaves = property.split('.')
         if 'voltages' in leaves:
             # = [temperatures, tempStatus, 2]
             newName = '{}.{}'.format(names[leaves[2]], leaves[1])
             mappedOutput[newName] = mappedOutput.pop(property)
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         # count critical temperaturs
         if 'status' in property:
             if value == 'Critical':
@@ -235,7 +264,7 @@ def checkVoltages(output):
 def checkSysinfos(output):
     status = 'OK'
     mappedOutput = mapOutput(output, 'ibm.sysinfos')
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         propertyList = property.split('.')
         if len(propertyList) == 3:
             status += '\n{}={}'.format(propertyList[1], mappedOutput.pop(property))
@@ -245,7 +274,7 @@ def checkHwhealth(output):
     status = ''
     mappedOutput = mapOutput(output, 'ibm.hwhealth')
     hwStatus = 0
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         if 'hwStatus' in property:
             hwStatus = value
             mappedOutput.pop(property, None)
@@ -267,14 +296,14 @@ def checkDisks(output):
     mappedOutput = mapOutput(output, 'ibm.disks')
     numberDegraded = 0
     degradedVolumes = []
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         if 'Name' in property:
             propertyList = property.split('.')
             if len(propertyList) == 3:
                 type = propertyList[1][:-4]
                 names[type][propertyList[2]] = value
             mappedOutput.pop(property, None)
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         if 'controller' in property:
             type = 'controller'
         elif 'disk_' in property:
@@ -292,7 +321,7 @@ def checkDisks(output):
                     mappedOutput[newName] = mappedOutput.pop(property)[:-1]
                 else:
                     mappedOutput[newName] = mappedOutput.pop(property)
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         if 'volumeStatus' in property:
             if value == 'Degraded':
                 numberDegraded += 1
@@ -305,17 +334,56 @@ def checkDisks(output):
     status += nonPerfdata
     return [status, mappedOutput]
 
-def buildOutput(status, mappedOutput, command):
-    outputString = status
-    properties = ''
-    perfdata = ''
-    for property, value in mappedOutput.items():
-        properties += ' ' + property + '=' + str(value)
-        if type(value) == int:
-            perfdata += ' ' + property + '=' + str(value)
-    if properties:
-        outputString += ' |' + properties
-    return outputString
+# commands that can be run together by runChecks
+checks = OrderedDict([
+    ('fans', checkFans),
+    ('temperatures', checkTemperatures),
+    ('voltages', checkVoltages),
+    ('sysinfos', checkSysinfos),
+    ('disks', checkDisks),
+    ('hwhealth', checkHwhealth)
+])
+
+def buildOutput(status, mappedOutput, command, cache=None):
+    # values that are not numbers are skipped, icinga would reject them
+    perfdata = lib.perfdata.PerfdataWriter()
+    for property, value in list(mappedOutput.items()):
+        perfdata.add(property, value)
+    if cache is not None and cache.db is not None:
+        hits, misses = cache.getStats()
+        perfdata.add('cache_hits', hits, 'c')
+        perfdata.add('cache_misses', misses, 'c')
+        if cache.fAge is not None:
+            perfdata.add('cache_age', round(cache.fAge, 1), 's')
+    if not perfdata:
+        return status
+    return perfdata.formatOutput(status, ' | ')
+
+# gets: output of buildOutput
+# returns: exit code icinga expects for it
+def getExitCode(outputString):
+    if 'OK' in outputString: return 0
+    elif 'WARNING' in outputString: return 1
+    elif 'CRITICAL' in outputString: return 2
+    return 3
+
+# gets: list of commands, SNMPv3 credentials, host, security level, port,
+#       the ResponseCache of the host and the time.monotonic() the SNMP
+#       session has to end by, None for no limit
+# returns: list of (command, output, exit code), the data of all commands
+#          fetched in one SNMP session
+def runChecks(commands, user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port=161, cache=None, deadline=None):
+    outputs = performChecks(['ibm.' + command for command in commands], user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port, cache, deadline)
+    results = []
+    for command in commands:
+        try:
+            status, mappedOutput = checks[command](outputs['ibm.' + command])
+            outputString = buildOutput(status, mappedOutput, command, cache)
+        except (KeyError, ValueError, ZeroDivisionError) as e:
+            # one module the IMM does not answer must not hide the others
+            outputString = 'UNKNOWN check_imm2.py {} - no data for {}'.format(command, e)
+        results.append((command, outputString, getExitCode(outputString)))
+    return results
 
 def main():
     status    = 'unknown'
@@ -330,6 +398,8 @@ def main():
     parser.add_argument('-l', '--level', type=str, help="set security level (noAuthNoPriv|authNoPriv|authPriv)")
     parser.add_argument('-C', '--command', type=str, help="Check to be executed (fans|temperatures|voltages|sysinfos|disks|hwhealth)")
     parser.add_argument('-H', '--host', type=str, help="Hostname or IP address")
+    parser.add_argument('-P', '--port', type=int, default=161, help="SNMP port, default 161")
+    parser.add_argument('-T', '--cache-ttl', type=int, default=0, help="seconds an answer of the IMM is reused by all checks of the host, default 0, do not cache")
 
     args = parser.parse_args()
 
@@ -341,37 +411,36 @@ def main():
     privAlgo   = args.privAlgo
     privPasswd = args.privPasswd
     level      = args.level
+    port       = args.port
+    cache      = lib.responsecache.ResponseCache(
+        ip, port, user, args.cache_ttl, fLockWait=20.0, lSecrets=[level, authAlgo, authPasswd, privAlgo, privPasswd]
+    )
 
-    if command == 'fans':
-        oid = getOID('ibm.fans')
-        output = performCheck(oid, user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo)
-        status, mappedOutput = checkFans(output)
-    elif command == 'temperatures':
-        oid = getOID('ibm.temperatures')
-        output = performCheck(oid, user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo)
-        status, mappedOutput = checkTemperatures(output)
-    elif command == 'voltages':
-        oid = getOID('ibm.voltages')
-        output = performCheck(oid, user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo)
-        status, mappedOutput = checkVoltages(output)
-    elif command == 'sysinfos':
-        oid = getOID('ibm.sysinfos')
-        output = performCheck(oid, user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo)
-        status, mappedOutput = checkSysinfos(output)
-    elif command == 'disks':
-        oid = getOID('ibm.disks')
-        output = performCheck(oid, user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo)
-        status, mappedOutput = checkDisks(output)
-    elif command == 'hwhealth':
-        oid = getOID('ibm.hwhealth')
-        output = performCheck(oid, user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo)
-        status, mappedOutput = checkHwhealth(output)
-    outputString = buildOutput(status, mappedOutput, command)
+    try:
+        if command == 'fans':
+            output = performCheck('ibm.fans', user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port, cache)
+            status, mappedOutput = checkFans(output)
+        elif command == 'temperatures':
+            output = performCheck('ibm.temperatures', user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port, cache)
+            status, mappedOutput = checkTemperatures(output)
+        elif command == 'voltages':
+            output = performCheck('ibm.voltages', user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port, cache)
+            status, mappedOutput = checkVoltages(output)
+        elif command == 'sysinfos':
+            output = performCheck('ibm.sysinfos', user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port, cache)
+            status, mappedOutput = checkSysinfos(output)
+        elif command == 'disks':
+            output = performCheck('ibm.disks', user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port, cache)
+            status, mappedOutput = checkDisks(output)
+        elif command == 'hwhealth':
+            output = performCheck('ibm.hwhealth', user, authPasswd, privPasswd, ip, level, authAlgo, privAlgo, port, cache)
+            status, mappedOutput = checkHwhealth(output)
+    except lib.snmpv3.SNMPError as e:
+        print('UNKNOWN check_imm2.py {} - {}'.format(command, e))
+        exit(3)
+    outputString = buildOutput(status, mappedOutput, command, cache)
     print(outputString)
-    if 'OK' in outputString: exit(0)
-    elif 'WARNING' in outputString: exit(1)
-    elif 'CRITICAL' in outputString: exit(2)
-    elif 'UNKNOWN' in outputString: exit(3)
+    exit(getExitCode(outputString))
 
 if __name__ == "__main__":
     main()
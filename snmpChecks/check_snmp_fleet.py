@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+# check_snmp_fleet.py - polls all IMM2 and Synology devices of an inventory
+# in one process and submits the results as passive check results
+#
+# copyright C-Store 2016
+# Author Mattis Haase
+#
+# usage: check_snmp_fleet.py -i inventory.json --api-user passive
+#
+# Every device is polled with the modules of check_imm2.py and
+# check_synology_snmp.py, all commands of a device in one SNMP session, and
+# evaluated by their check functions. asyncio runs the devices side by side
+# under a global concurrency cap and a deadline per device; the blocking
+# sessions themselves run in a thread pool of the size of the cap. Results
+# are submitted to the icinga 2 API in batches while the remaining devices
+# are still polled.
+#
+# inventory, every key of a host can also be set in defaults of its type:
+# {
+#     "defaults": {
+#         "imm2": {"user": "monitor", "level": "authPriv", "authAlgo": "SHA",
+#                  "authPasswd": "secret", "privAlgo": "AES", "privPasswd": "secret"},
+#         "synology": {"user": "monitor", "passwd": "secret"}
+#     },
+#     "hosts": [
+#         {"type": "imm2", "host": "imm-r1-01", "hostname": "server-r1-01",
+#          "commands": ["fans", "temperatures"], "services": {"fans": "imm-fans"}},
+#         {"type": "synology", "host": "nas1", "thresholds": {"storage": [80, 90]}}
+#     ]
+# }
+# host is the address that is polled, hostname the icinga host object
+# (default host), commands default to all commands of the type and services
+# map commands to icinga services (default the command).
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from sys import exit
+import json
+import os
+import resource
+import sys
+import time
+
+# shared modules live in lib/ at the top of the repository
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import lib.icingaapi
+import lib.perfdata
+import lib.snmpv3
+import check_imm2
+import check_synology_snmp
+
+# type: module with the checks of the type
+deviceTypes = {
+    'imm2': check_imm2,
+    'synology': check_synology_snmp
+}
+
+# gets: path of the inventory file
+# returns: list of device dicts, the defaults of their type applied
+def readInventory(path):
+    with open(path) as f:
+        inventory = json.load(f)
+    devices = []
+    for host in inventory.get('hosts', []):
+        if host.get('type') not in deviceTypes:
+            raise ValueError('{} has unknown type {}, known are {}'.format(
+                host.get('host'), host.get('type'), ', '.join(sorted(deviceTypes))
+            ))
+        device = dict(inventory.get('defaults', {}).get(host['type'], {}))
+        device.update(host)
+        if not device.get('host'):
+            raise ValueError('every entry of hosts needs a host')
+        device.setdefault('port', 161)
+        device.setdefault('hostname', device['host'])
+        device.setdefault('commands', list(deviceTypes[device['type']].checks))
+        unknown = [command for command in device['commands'] if command not in deviceTypes[device['type']].checks]
+        if unknown:
+            raise ValueError('{} has unknown commands {}'.format(device['host'], ', '.join(unknown)))
+        devices.append(device)
+    return devices
+
+# gets: device dict, seconds the device may take
+# returns: list of (command, output, exit code). Blocks until the device
+#          answered or the SNMP session gave up at the deadline, runs in the
+#          thread pool
+def pollDevice(device, timeout):
+    deadline = time.monotonic() + timeout
+    if device['type'] == 'imm2':
+        return check_imm2.runChecks(
+            device['commands'], device.get('user'), device.get('authPasswd'), device.get('privPasswd'),
+            device['host'], device.get('level', 'authPriv'), device.get('authAlgo'), device.get('privAlgo'),
+            device['port'], deadline=deadline
+        )
+    thresholds = dict((command, tuple(levels)) for command, levels in device.get('thresholds', {}).items())
+    return check_synology_snmp.runChecks(
+        device['commands'], device.get('user'), device.get('passwd'), device['host'], device['port'], thresholds,
+        deadline=deadline
+    )
+
+# gets: device dict, list of (command, output, exit code)
+# returns: list of passive check results for lib.icingaapi
+def formatResults(device, results):
+    services = device.get('services', {})
+    formatted = []
+    for command, outputString, exitCode in results:
+        text, sep, perfdata = outputString.partition('|')
+        formatted.append({
+            'host': device['hostname'],
+            'service': services.get(command, command),
+            'exitStatus': exitCode,
+            'output': text.strip(),
+            'perfdata': perfdata.strip()
+        })
+    return formatted
+
+# gets: device dict, reason the device could not be polled
+# returns: UNKNOWN result for every command of the device
+def failedResults(device, reason):
+    script = os.path.basename(deviceTypes[device['type']].__file__)
+    return [
+        (command, 'UNKNOWN {} {} - {}'.format(script, command, reason), 3)
+        for command in device['commands']
+    ]
+
+# gets: list of devices, maximum of devices polled at once, seconds a device
+#       may take, function that submits a list of results and returns a list
+#       of errors, results per submission
+# returns: dict with counters of the run
+async def pollFleet(devices, concurrency, timeout, submit, batchSize):
+    loop = asyncio.get_running_loop()
+    pollers = ThreadPoolExecutor(max_workers=concurrency)
+    # one submission at a time, in the order the batches filled
+    submitter = ThreadPoolExecutor(max_workers=1)
+    slots = asyncio.Semaphore(concurrency)
+    stats = {'devices': len(devices), 'failed': 0, 'results': 0, 'errors': []}
+
+    def release(future):
+        # a thread can not be interrupted, a device that missed its deadline
+        # keeps its slot until its session gave up, which it does at the
+        # same deadline
+        slots.release()
+        if not future.cancelled():
+            future.exception()
+
+    async def poll(device):
+        await slots.acquire()
+        future = loop.run_in_executor(pollers, pollDevice, device, timeout)
+        future.add_done_callback(release)
+        try:
+            results = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            results = failedResults(device, 'no answer within {} s'.format(timeout))
+            stats['failed'] += 1
+        except lib.snmpv3.SNMPError as e:
+            results = failedResults(device, e)
+            stats['failed'] += 1
+        except Exception as e:
+            # one broken device must not cost the results of all others
+            results = failedResults(device, 'poll failed: {!r}'.format(e))
+            stats['failed'] += 1
+        return formatResults(device, results)
+
+    submissions = []
+    pending = []
+    for done in asyncio.as_completed([poll(device) for device in devices]):
+        pending += await done
+        if len(pending) >= batchSize:
+            submissions.append(loop.run_in_executor(submitter, submit, pending))
+            pending = []
+    if pending:
+        submissions.append(loop.run_in_executor(submitter, submit, pending))
+    for errors in await asyncio.gather(*submissions):
+        stats['results'] += len(errors)
+        stats['errors'] += [error for error in errors if error]
+    # the run only ends when no session is left in the pool
+    pollers.shutdown()
+    submitter.shutdown()
+    return stats
+
+# gets: list of results
+# returns: list of None, results are printed instead of submitted
+def printResults(results):
+    for result in results:
+        print('{host} {service} {exitStatus} {output} | {perfdata}'.format(**result).replace('\n', ' '))
+    return [None] * len(results)
+
+def main():
+    parser = argparse.ArgumentParser(description='Polls all IMM2 and Synology devices of an inventory in one process.')
+    parser.add_argument('-i', '--inventory', type=str, required=True, help="JSON inventory of the devices, see the head of this file")
+    parser.add_argument('-n', '--concurrency', type=int, default=64, help="devices polled at the same time, default 64")
+    parser.add_argument('-t', '--timeout', type=float, default=60.0, help="seconds a device may take for all its commands, default 60")
+    parser.add_argument('-b', '--batch-size', type=int, default=500, help="results submitted to the icinga 2 API at once, default 500")
+    parser.add_argument('--dry-run', action='store_true', help="print the results instead of submitting them")
+    parser.add_argument('--api-url', type=str, default='https://localhost:5665', help="Url of the icinga 2 API. Default https://localhost:5665")
+    parser.add_argument('--api-user', type=str, help="icinga 2 API user")
+    parser.add_argument('--api-password', type=str, default=os.environ.get('ICINGA2_API_PASSWORD'), help="Password of the icinga 2 API user. Default: environment variable ICINGA2_API_PASSWORD")
+    parser.add_argument('--api-ca', type=str, help="CA certificate of the icinga 2 API. Default: system certificates")
+    parser.add_argument('--api-insecure', action='store_true', help="Do not verify the certificate of the icinga 2 API")
+    args = parser.parse_args()
+    if not args.dry_run and (not args.api_user or not args.api_password):
+        parser.error('--api-user and --api-password or ICINGA2_API_PASSWORD are required without --dry-run')
+
+    try:
+        devices = readInventory(args.inventory)
+    except (OSError, ValueError) as e:
+        print('UNKNOWN check_snmp_fleet.py - could not read inventory: {}'.format(e))
+        exit(3)
+
+    if args.dry_run:
+        submit = printResults
+    else:
+        api = lib.icingaapi.IcingaAPI(args.api_url, args.api_user, args.api_password, args.api_ca, not args.api_insecure)
+        submit = api.processCheckResults
+
+    start = time.monotonic()
+    stats = asyncio.run(pollFleet(devices, max(1, args.concurrency), args.timeout, submit, max(1, args.batch_size)))
+    duration = time.monotonic() - start
+
+    perfdata = lib.perfdata.PerfdataWriter()
+    perfdata.add('devices', stats['devices'])
+    perfdata.add('devices_failed', stats['failed'])
+    perfdata.add('results', stats['results'])
+    perfdata.add('results_failed', len(stats['errors']))
+    perfdata.add('duration', round(duration, 3), 's')
+    perfdata.add('devices_per_second', round(stats['devices'] / duration, 1) if duration else 0)
+    perfdata.add('max_rss', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, 'B')
+
+    output = '{} devices polled in {:.1f} s, {} did not answer, {} results {}'.format(
+        stats['devices'], duration, stats['failed'], stats['results'], 'printed' if args.dry_run else 'submitted'
+    )
+    if stats['errors']:
+        output = 'CRITICAL check_snmp_fleet.py - {}, {} could not be submitted\n{}'.format(
+            output, len(stats['errors']), '\n'.join(sorted(set(stats['errors']))[:10])
+        )
+        exitCode = 2
+    else:
+        output = 'OK check_snmp_fleet.py - ' + output
+        exitCode = 0
+    print(perfdata.formatOutput(output))
+    exit(exitCode)
+
+if __name__ == "__main__":
+    main()
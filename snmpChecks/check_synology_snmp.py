@@ -8,14 +8,28 @@
 # available commands:     system - returns system information, OK if system online, else critical. warn and crit can be set for temperature
 #                        disk - returns disk information, warn and crit can be set for number of failed or crashed disks, else ok
 #                        raid - returns raid information, will always warn on degraded, crit on crashed
+#                        all - checks every module in one SNMP session and submits each result as
+#                              passive check result to the icinga 2 API, see --threshold and --service
 #
 # output: OK/WARNING/CRITICAL check_synology_snmp -
+#
+# SNMP is spoken in-process by lib/snmpv3.py, engine and localized keys of
+# every host are cached in /var/tmp/icinga2checks
 
 from sys import argv
 from sys import exit
 import argparse
-from subprocess import check_output
 from collections import OrderedDict
+import os
+import sys
+
+# shared modules live in lib/ at the top of the repository
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import lib.icingaapi
+import lib.oidtree
+import lib.perfdata
+import lib.responsecache
+import lib.snmpv3
 
 tree= {
     'synology':{
@@ -72,6 +86,13 @@ tree= {
     }
 }
 
+# modules whose leaves are single instances, fetched with one GET. The
+# leaves of all other modules are table columns, fetched with GETBULK
+instanceModules = ['system', 'load', 'memory']
+
+# OidTree of every module, see getOidTree
+oidTrees = {}
+
 returnCodes = {
     'raidStatus':{
         '1':'Normal',
@@ -110,42 +131,67 @@ def getOID(property):
     leaves = property.split('.')
     return tree[leaves[0]][leaves[1]]
 
-def performCheck(oid, user, passwd, ip):
-    output = check_output(['snmpwalk', '-v', '3', '-l', 'authNoPriv', '-u', user, '-A', passwd, ip, oid])
-    return output.decode('utf-8').split('\n')
+# gets: property in format synology.system
+# returns: (instance oids, column oids) of all leaves configured in tree
+def getRequestPlan(property):
+    leaves = property.split('.')
+    oids = [getOID(property) + '.' + element for element in tree[leaves[1]].values()]
+    if leaves[1] in instanceModules:
+        return oids, []
+    return [], oids
+
+# gets: property in format synology.system, SNMPv3 authNoPriv credentials,
+#       host, port and the ResponseCache of the host, None to not cache
+# returns: list of (oid tuple, typed value) of the configured leaves only,
+#          in the order a walk of the subtree would return them
+def performCheck(property, user, passwd, ip, port=161, cache=None):
+    return performChecks([property], user, passwd, ip, port, cache)[property]
+
+# gets: list of properties in format synology.system, SNMPv3 authNoPriv
+#       credentials, host, port, the ResponseCache of the host, None to not
+#       cache, and the time.monotonic() the session has to end by, None for
+#       no limit
+# returns: dict of property: varbinds like performCheck, all that are not
+#          cached fetched in one session with one GET and one column walk
+def performChecks(properties, user, passwd, ip, port=161, cache=None, deadline=None):
+    if cache is not None:
+        return cache.fetch(properties, lambda missing: performChecks(missing, user, passwd, ip, port, deadline=deadline))
+    with lib.snmpv3.Session(ip, user, 'authNoPriv', 'MD5', passwd, iPort=port, fTimeout=5.0, iRetries=1, fDeadline=deadline) as session:
+        return session.fetchGroups(OrderedDict((property, getRequestPlan(property)) for property in properties))
+
+# gets: property in format synology.system
+# returns: OidTree of the leaves of the module, built once per module
+def getOidTree(property):
+    if property not in oidTrees:
+        leaves = property.split('.')
+        oidTrees[property] = lib.oidtree.OidTree(getOID(property), tree[leaves[1]])
+    return oidTrees[property]
 
-# gets: output of snmpwalk
+# gets: varbinds of performCheck
 #       property in format: synology.system
-# returns: dict of format {systemStatus:1,temperature:40,...}
+# returns: dict of format {system.systemStatus:1,system.temperature:40,...},
+#          table columns as {disk.diskStatus.11:Normal,...} with the full row
+#          index, column after column
 def mapOutput(output, property):
     leaves = property.split('.')
+    scalars, rows = getOidTree(property).parse(output)
+    values = [(leaves[1] + '.' + key, key, value) for key, value in scalars.items()]
+    for key in tree[leaves[1]]:
+        for index, row in rows.items():
+            if key in row:
+                newKey = leaves[1] + '.' + key + '.' + lib.oidtree.formatIndex(index)
+                values.append((newKey, key, row[key]))
     d = OrderedDict()
-    for line in output:
-        if line != '' and line != '""':
-            line = line.replace(' ', '').split('=')
-            if line[1] != '' and line[1] != '""':
-                line[0] = line[0].replace('iso', '.1')
-                line[1] = line[1].split(':')[1]
-                for key, element in tree[leaves[1]].items():
-                    oid = tree[leaves[0]][leaves[1]] + '.' + element
-                    newKey = ''
-                    flag = False
-                    #if its oid. then there are multiple properties
-                    #(like multiple disks). so newkey = disk.status.id
-                    if oid + '.' in line[0]:
-                        newKey = leaves[1] + '.' + key + '.' + line[0][-1:]
-                        flag = True
-                    #if its just oid then there is only one property
-                    #so newkey = disk.status
-                    elif oid in line[0]:
-                        newKey = leaves[1] + '.' + key
-                        flag = True
-                    if flag == True:
-                        if key in returnCodes:
-                            d[newKey] = returnCodes[key][line[1]]
-                        else:
-                            d[newKey] = line[1]
-                        flag = False
+    for newKey, key, value in values:
+        # the checks were written against snmpwalk output with all spaces
+        # removed, values are still compared that way
+        text = lib.snmpv3.toText(value).replace(' ', '')
+        if text == '' or text == '""':
+            continue
+        if key in returnCodes:
+            d[newKey] = returnCodes[key][text]
+        else:
+            d[newKey] = text
     return d
 
 # gets: mappedOutput
@@ -155,13 +201,13 @@ def mapOutput(output, property):
 #       format: disk0.size = 1234
 def rename(mappedOutput):
     names = {}
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         # store the names and remove them
         if 'name' in property:
             # get the name of the sensor and remove the 'Temp'
             names[property.split('.')[2]] = value.replace('"','')
             mappedOutput.pop(property, None)
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         leaves = property.split('.')
         if len(leaves) == 3:
             # = [temperatures, tempStatus, 2]
@@ -187,7 +233,7 @@ def checkSystem(oid, output, user, passwd, ip, warn, crit):
     else:
         status = 'UNKNOWN'
         
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         if not 'temperature' in property:
             if value != '1':
                 if value == '0': value = 'FAILURE'
@@ -207,7 +253,7 @@ def checkRaid(oid, output, user, passwd, ip, warn, crit):
     status = ''
     mappedOutput = mapOutput(output, 'synology.raid')
 
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         if 'raidStatus' in property:
             if value == 'Degraded':
                 status = 'WARNING'
@@ -218,7 +264,7 @@ def checkRaid(oid, output, user, passwd, ip, warn, crit):
             else:
                 status = 'UNKNOWN'
     status +=' check_synology_snmp.py raid'
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         if not 'Status' in property and value != 'Normal':
             status += '\n{} is {}'.format(property, value)
         mappedOutput.pop(property, None)
@@ -236,7 +282,7 @@ def checkDisk(oid, output, user, passwd, ip, warn, crit):
     crashedDisks = 0
     damagedDisks = 0
 
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         if 'diskStatus' in property:
             if value == 'SystemPartitionFailed':
                 damagedDisks += 1
@@ -260,13 +306,13 @@ def checkDisk(oid, output, user, passwd, ip, warn, crit):
     else:
         status = 'UNKNOWN'
     
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         if 'Status' in property:
             l = property.split('.')
             property = '{}.{}'.format(dNames[l[2]], l[1])
             status += '\n\n{} is {}'.format(property, value)
             mappedOutput.pop(property, None)
-    for property, value in mappedOutput.items():
+    for property, value in list(mappedOutput.items()):
         if not 'Temp' in property:
             # replace 'disk.' with name and get rid of ID
             l = property.split('.')
@@ -370,12 +416,111 @@ def checkStorage(oid, output, user, passwd, ip, warn, crit):
 
     return [status, dValues]
 
-def buildOutput(status, mappedOutput, command):
-    properties = ''
-    for property, value in mappedOutput.items():
-        properties += ' ' + property + '=' + str(value)
-    outputString = '{}|{}'.format(status, properties)
-    return outputString
+# commands run by all, in the order their results are submitted
+checks = OrderedDict([
+    ('system', checkSystem),
+    ('disk', checkDisk),
+    ('raid', checkRaid),
+    ('storage', checkStorage),
+    ('load', checkLoad),
+    ('memory', checkMemory)
+])
+
+def buildOutput(status, mappedOutput, command, cache=None):
+    # values that are not numbers are skipped, icinga would reject them
+    perfdata = lib.perfdata.PerfdataWriter()
+    for property, value in list(mappedOutput.items()):
+        perfdata.add(property, value)
+    if cache is not None and cache.db is not None:
+        hits, misses = cache.getStats()
+        perfdata.add('cache_hits', hits, 'c')
+        perfdata.add('cache_misses', misses, 'c')
+        if cache.fAge is not None:
+            perfdata.add('cache_age', round(cache.fAge, 1), 's')
+    return perfdata.formatOutput(status, '| ')
+
+# gets: output of buildOutput
+# returns: exit code icinga expects for it
+def getExitCode(outputString):
+    if 'OK' in outputString: return 0
+    elif 'WARNING' in outputString: return 1
+    elif 'CRITICAL' in outputString: return 2
+    return 3
+
+# gets: list of commands, SNMPv3 authNoPriv credentials, host, port, dict of
+#       command: (warn, crit), None for the defaults of the check, the
+#       ResponseCache of the host and the time.monotonic() the SNMP session
+#       has to end by, None for no limit
+# returns: list of (command, output, exit code), the data of all commands
+#          fetched in one SNMP session
+def runChecks(commands, user, passwd, ip, port=161, thresholds={}, cache=None, deadline=None):
+    outputs = performChecks(['synology.' + command for command in commands], user, passwd, ip, port, cache, deadline)
+    results = []
+    for command in commands:
+        warn, crit = thresholds.get(command, (None, None))
+        try:
+            status, mappedOutput = checks[command](getOID('synology.' + command), outputs['synology.' + command], user, passwd, ip, warn, crit)
+            outputString = buildOutput(status, mappedOutput, command, cache)
+        except (KeyError, ValueError, ZeroDivisionError) as e:
+            # one module the NAS does not answer must not hide the others
+            outputString = 'UNKNOWN check_synology_snmp.py {} - no data for {}'.format(command, e)
+        results.append((command, outputString, getExitCode(outputString)))
+    return results
+
+# gets: parsed arguments
+# returns: dict of command: (warn, crit), from --threshold, else the
+#          defaults of the check
+def getThresholds(args):
+    thresholds = {command: (None, None) for command in checks}
+    for threshold in args.threshold:
+        command, sep, levels = threshold.partition('=')
+        warn, sep, crit = levels.partition(':')
+        if command not in thresholds or not warn.isdigit() or not crit.isdigit():
+            raise ValueError('--threshold has to be command=warn:crit, not {}'.format(threshold))
+        thresholds[command] = (int(warn), int(crit))
+    return thresholds
+
+# gets: parsed arguments
+# returns: dict of command: icinga service, from --service, else the command
+def getServices(args):
+    services = {command: command for command in checks}
+    for service in args.service:
+        command, sep, name = service.partition('=')
+        if command not in services or not name:
+            raise ValueError('--service has to be command=service, not {}'.format(service))
+        services[command] = name
+    return services
+
+# gets: parsed arguments, ResponseCache of the host
+# returns: (output, exit code) of the run itself. All modules are fetched
+#          in one SNMP session, evaluated by their check and submitted as
+#          passive results to the icinga 2 API
+def checkAll(args, cache=None):
+    services = getServices(args)
+    results = []
+    for command, outputString, exitCode in runChecks(
+        list(checks), args.username, args.passwd, args.host, args.port, getThresholds(args), cache
+    ):
+        text, sep, perfdata = outputString.partition('| ')
+        results.append({
+            'host': args.hostname or args.host,
+            'service': services[command],
+            'exitStatus': exitCode,
+            'output': text.strip(),
+            'perfdata': perfdata
+        })
+
+    api = lib.icingaapi.IcingaAPI(args.api_url, args.api_user, args.api_password, args.api_ca, not args.api_insecure)
+    errors = api.processCheckResults(results)
+    failed = [
+        '{}: {}'.format(result['service'], error)
+        for result, error in zip(results, errors) if error
+    ]
+    if failed:
+        return 'CRITICAL check_synology_snmp.py all - {} of {} results could not be submitted\n{}'.format(
+            len(failed), len(results), '\n'.join(failed)
+        ), 2
+    return 'OK check_synology_snmp.py all - {} results submitted for {}'.format(len(results), args.hostname or args.host), 0
 
 def main():
     status    = 'unknown'
@@ -384,10 +529,20 @@ def main():
     parser = argparse.ArgumentParser(description='Synology RackStation SNMP based check.')
     parser.add_argument('-u', '--username', type=str, help="SNMPv3 username")
     parser.add_argument('-p', '--passwd', type=str, help="SNMPv3 auth password.")
-    parser.add_argument('-C', '--command', type=str, help="Check to be executed. Can be system, disk, raid, memory, load or storage.")
+    parser.add_argument('-C', '--command', type=str, help="Check to be executed. Can be system, disk, raid, memory, load, storage or all. all checks every module in one SNMP session and submits the results as passive check results to the icinga 2 API.")
     parser.add_argument('-H', '--host', type=str, help="Hostname or IP address")
+    parser.add_argument('-P', '--port', type=int, default=161, help="SNMP port, default 161")
     parser.add_argument('-w', '--warn', type=int, help="warnlevel")
     parser.add_argument('-c', '--crit', type=int, help="critlevel")
+    parser.add_argument('-T', '--cache-ttl', type=int, default=0, help="seconds an answer of the NAS is reused by all checks of the host, default 0, do not cache")
+    parser.add_argument('--hostname', type=str, help="all only. Icinga host object the results belong to. Default: --host")
+    parser.add_argument('--service', type=str, default=[], action='append', help="all only. command=service, icinga service a command is submitted as. Default: the command. Can be given multiple times")
+    parser.add_argument('--threshold', type=str, default=[], action='append', help="all only. command=warn:crit, thresholds of a command. Default: the defaults of the command. Can be given multiple times")
+    parser.add_argument('--api-url', type=str, default='https://localhost:5665', help="all only. Url of the icinga 2 API. Default https://localhost:5665")
+    parser.add_argument('--api-user', type=str, help="all only. icinga 2 API user")
+    parser.add_argument('--api-password', type=str, default=os.environ.get('ICINGA2_API_PASSWORD'), help="all only. Password of the icinga 2 API user. Default: environment variable ICINGA2_API_PASSWORD")
+    parser.add_argument('--api-ca', type=str, help="all only. CA certificate of the icinga 2 API. Default: system certificates")
+    parser.add_argument('--api-insecure', action='store_true', help="all only. Do not verify the certificate of the icinga 2 API")
     args = parser.parse_args()
 
     user    = args.username
@@ -396,37 +551,50 @@ def main():
     ip        = args.host
     warn    = args.warn
     crit    = args.crit
+    port    = args.port
+    cache   = lib.responsecache.ResponseCache(ip, port, user, args.cache_ttl, lSecrets=[passwd])
     
-    if command == 'system':
-        oid = getOID('synology.system')
-        output = performCheck(oid, user, passwd, ip)
-        status, mappedOutput = checkSystem(oid, output, user, passwd, ip, warn, crit)
-    elif command == 'disk':
-        oid = getOID('synology.disk')
-        output = performCheck(oid, user, passwd, ip)
-        status, mappedOutput = checkDisk(oid, output, user, passwd, ip, warn, crit)
-    elif command == 'raid':
-        oid = getOID('synology.raid')
-        output = performCheck(oid, user, passwd, ip)
-        status, mappedOutput = checkRaid(oid, output, user, passwd, ip, warn, crit)
-    elif command == 'memory':
-        oid = getOID('synology.memory')
-        output = performCheck(oid, user, passwd, ip)
-        status, mappedOutput = checkMemory(oid, output, user, passwd, ip, warn, crit)
-    elif command == 'load':
-        oid = getOID('synology.load')
-        output = performCheck(oid, user, passwd, ip)
-        status, mappedOutput = checkLoad(oid, output, user, passwd, ip, warn, crit)
-    elif command == 'storage':
-        oid = getOID('synology.storage')
-        output = performCheck(oid, user, passwd, ip)
-        status, mappedOutput = checkStorage(oid, output, user, passwd, ip, warn, crit)
-    outputString = buildOutput(status, mappedOutput, command)
+    if command == 'all':
+        try:
+            outputString, exitCode = checkAll(args, cache)
+        except ValueError as e:
+            outputString, exitCode = 'UNKNOWN check_synology_snmp.py all - {}'.format(e), 3
+        except lib.snmpv3.SNMPError as e:
+            outputString, exitCode = 'UNKNOWN check_synology_snmp.py all - {}'.format(e), 3
+        print(outputString)
+        exit(exitCode)
+
+    try:
+        if command == 'system':
+            oid = getOID('synology.system')
+            output = performCheck('synology.system', user, passwd, ip, port, cache)
+            status, mappedOutput = checkSystem(oid, output, user, passwd, ip, warn, crit)
+        elif command == 'disk':
+            oid = getOID('synology.disk')
+            output = performCheck('synology.disk', user, passwd, ip, port, cache)
+            status, mappedOutput = checkDisk(oid, output, user, passwd, ip, warn, crit)
+        elif command == 'raid':
+            oid = getOID('synology.raid')
+            output = performCheck('synology.raid', user, passwd, ip, port, cache)
+            status, mappedOutput = checkRaid(oid, output, user, passwd, ip, warn, crit)
+        elif command == 'memory':
+            oid = getOID('synology.memory')
+            output = performCheck('synology.memory', user, passwd, ip, port, cache)
+            status, mappedOutput = checkMemory(oid, output, user, passwd, ip, warn, crit)
+        elif command == 'load':
+            oid = getOID('synology.load')
+            output = performCheck('synology.load', user, passwd, ip, port, cache)
+            status, mappedOutput = checkLoad(oid, output, user, passwd, ip, warn, crit)
+        elif command == 'storage':
+            oid = getOID('synology.storage')
+            output = performCheck('synology.storage', user, passwd, ip, port, cache)
+            status, mappedOutput = checkStorage(oid, output, user, passwd, ip, warn, crit)
+    except lib.snmpv3.SNMPError as e:
+        print('UNKNOWN check_synology_snmp.py {} - {}'.format(command, e))
+        exit(3)
+    outputString = buildOutput(status, mappedOutput, command, cache)
     print(outputString)
-    if 'OK' in outputString: exit(0)
-    elif 'WARNING' in outputString: exit(1)
-    elif 'CRITICAL' in outputString: exit(2)
-    elif 'UNKNOWN' in outputString: exit(3)
+    exit(getExitCode(outputString))
 
 if __name__ == "__main__":
    main()
@@ -0,0 +1,81 @@
+"""
+Maps varbinds to the names the SNMP checks give their OIDs.
+
+The OIDs of one module are put into a trie of OID arcs once, so a varbind
+is matched by following its own arcs instead of comparing it with every
+configured OID. Whatever is left of the varbind OID after the matching
+leaf is the row index of a table. It is kept as a tuple, so row 1 and row
+11 of a table stay apart.
+
+    tree = OidTree('1.3.6.1.4.1.6574.2', {'diskModel': '1.1.3', 'diskTemp': '1.1.6'})
+    dScalars, dRows = tree.parse(session.walk('1.3.6.1.4.1.6574.2'))
+    # dRows = {(0,): {'diskModel': b'WD40EFRX', 'diskTemp': 35}, (1,): ...}
+"""
+
+from collections import OrderedDict
+
+import lib.snmpv3
+
+class OidTree:
+    """trie of the OIDs of one module"""
+
+    def __init__(self, sBase, dLeaves):
+        """Takes: sBase   = OID all leaves are below, '' if they are absolute
+                  dLeaves = dict of name: OID relative to sBase, in the
+                            order rows should list them"""
+        self.tBase = lib.snmpv3.parseOid(sBase)
+        self.lNames = list(dLeaves)
+        # every node is a dict of arc: node, the name of the leaf that ends
+        # at a node is stored under None
+        self.dRoot = {}
+        for sName, sLeaf in dLeaves.items():
+            dNode = self.dRoot
+            for iArc in lib.snmpv3.parseOid(sLeaf):
+                dNode = dNode.setdefault(iArc, {})
+            dNode[None] = sName
+
+    def lookup(self, tOid):
+        """Takes: tOid = OID of a varbind as tuple
+        Returns: (name, row index tuple) of the longest configured leaf the
+        OID is below, () as index for the leaf itself. (None, None) if the
+        OID does not belong to any leaf"""
+        iBase = len(self.tBase)
+        if tOid[:iBase] != self.tBase:
+            return None, None
+        sName = None
+        iEnd = None
+        dNode = self.dRoot
+        for i in range(iBase, len(tOid)):
+            dNode = dNode.get(tOid[i])
+            if dNode is None:
+                break
+            if None in dNode:
+                sName = dNode[None]
+                iEnd = i + 1
+        if sName is None:
+            return None, None
+        return sName, tuple(tOid[iEnd:])
+
+    def parse(self, lVarbinds):
+        """Takes: lVarbinds = list of (OID tuple, typed value)
+        Returns: (dScalars, dRows). dScalars is a dict of name: value for
+        leaves that were answered themselves, dRows an OrderedDict of row
+        index tuple: OrderedDict of name: value, rows in the order they
+        were first seen. Varbinds of no leaf are ignored"""
+        dScalars = OrderedDict()
+        dRows = OrderedDict()
+        for tOid, value in lVarbinds:
+            sName, tIndex = self.lookup(tOid)
+            if sName is None:
+                continue
+            if tIndex:
+                dRows.setdefault(tIndex, OrderedDict())[sName] = value
+            else:
+                dScalars[sName] = value
+        return dScalars, dRows
+
+def formatIndex(tIndex):
+    """Takes: tIndex = row index tuple
+    Returns: index as one key component, arcs joined with '_' so names that
+    are split at '.' keep their number of parts"""
+    return '_'.join(str(iArc) for iArc in tIndex)
@@ -0,0 +1,189 @@
+"""
+Cache of SNMP answers shared by all checks of a host.
+
+Several services usually poll the same device within seconds, and the
+agents of BMCs and NAS are slow enough that these polls add up. The
+varbinds of every subtree a check fetched are kept in one SQLite database
+in the state directory of lib/statefile.py, per host, port, user and
+subtree. The user also holds a hash of the security settings and pass
+phrases, so a check with wrong credentials is never answered from data
+fetched with the right ones, and only the owner can read the database. A
+check that finds an answer younger than its TTL reads it from there
+instead of asking the device.
+
+Varbinds are stored BER encoded, so their types survive the cache. Hits
+and misses are counted per host in the same database and can be shown as
+perfdata.
+
+    cache = ResponseCache('nas1', 161, 'monitor', 60, lSecrets=['authNoPriv', 'MD5', 'secret'])
+    dOutputs = cache.fetch(['synology.disk', 'synology.raid'], fetchFromDevice)
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+import lib.snmpv3
+import lib.statefile
+
+sDatabaseName = 'snmpcache.sqlite'
+# answers older than this are removed, whatever TTL the checks use
+iMaxAge = 86400
+
+class ResponseCache:
+    """SNMP answers of one host"""
+
+    def __init__(self, sHost, iPort, sUser, iTtl, fLockWait=10.0, lSecrets=()):
+        """Takes: sHost     = host name or IP address of the agent
+                  iPort     = UDP port of the agent
+                  sUser     = security name, agents may show users different
+                              views
+                  iTtl      = seconds an answer is used, 0 disables the cache
+                  fLockWait = seconds to wait for a check of the same host
+                              that is already fetching
+                  lSecrets  = security level, protocols and pass phrases
+                              the answers are fetched with"""
+        sSecrets = '\0'.join(sSecret or '' for sSecret in lSecrets)
+        self.sHost     = sHost
+        self.iPort     = iPort
+        self.sUser     = '{}:{}'.format(sUser or '', hashlib.sha256(sSecrets.encode('utf-8')).hexdigest())
+        self.iTtl      = iTtl
+        self.fLockWait = fLockWait
+        self.sLockName = 'snmpcache_{}_{}'.format(''.join(c if c.isalnum() or c in '.-' else '_' for c in sHost), iPort)
+        self.iHits     = 0
+        self.iMisses   = 0
+        self.fAge      = None
+        self.db        = None
+        if self.iTtl > 0:
+            self.db = self.connect()
+
+    def connect(self):
+        """Returns: sqlite3 connection, None if the database can not be
+        opened, the checks then run uncached"""
+        sPath = os.path.join(lib.statefile.getStateDir(), sDatabaseName)
+        try:
+            os.makedirs(os.path.dirname(sPath), exist_ok=True)
+            # like lib.statefile, only the user of the checks may read the
+            # answers. SQLite creates the WAL with the mode of the database
+            iFd = os.open(sPath, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+            try:
+                if os.fstat(iFd).st_mode & 0o077:
+                    os.fchmod(iFd, 0o600)
+            finally:
+                os.close(iFd)
+            db = sqlite3.connect(sPath, timeout=self.fLockWait, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS responses (host TEXT, port INTEGER, user TEXT, subtree TEXT,'
+                ' time REAL, varbinds BLOB, PRIMARY KEY (host, port, user, subtree))'
+            )
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS stats (host TEXT, port INTEGER, hits INTEGER, misses INTEGER,'
+                ' PRIMARY KEY (host, port))'
+            )
+            return db
+        except (OSError, sqlite3.Error):
+            return None
+
+    def count(self, bHit):
+        """adds a hit or a miss to the counters of this invocation and of
+        the host"""
+        if bHit:
+            self.iHits += 1
+        else:
+            self.iMisses += 1
+        try:
+            self.db.execute('INSERT OR IGNORE INTO stats VALUES (?, ?, 0, 0)', (self.sHost, self.iPort))
+            self.db.execute(
+                'UPDATE stats SET hits = hits + ?, misses = misses + ? WHERE host = ? AND port = ?',
+                (int(bHit), int(not bHit), self.sHost, self.iPort)
+            )
+        except sqlite3.Error:
+            pass
+
+    def get(self, sSubtree, bCount=True):
+        """Takes: sSubtree = name of the subtree, e.g. synology.disk
+                  bCount   = False to not count the lookup
+        Returns: list of (OID tuple, typed value), None if there is no answer
+        younger than the TTL"""
+        if self.db is None:
+            return None
+        try:
+            row = self.db.execute(
+                'SELECT time, varbinds FROM responses WHERE host = ? AND port = ? AND user = ? AND subtree = ?',
+                (self.sHost, self.iPort, self.sUser, sSubtree)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        fAge = time.time() - row[0] if row else None
+        if fAge is None or not 0 <= fAge < self.iTtl:
+            if bCount:
+                self.count(False)
+            return None
+        try:
+            lVarbinds = lib.snmpv3.decodeVarbinds(row[1])
+        except (lib.snmpv3.SNMPError, ValueError):
+            if bCount:
+                self.count(False)
+            return None
+        if bCount:
+            self.count(True)
+        self.fAge = fAge if self.fAge is None else max(self.fAge, fAge)
+        return lVarbinds
+
+    def put(self, sSubtree, lVarbinds):
+        """Takes: sSubtree  = name of the subtree
+                  lVarbinds = list of (OID tuple, typed value) just fetched"""
+        if self.db is None:
+            return
+        fNow = time.time()
+        try:
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (self.sHost, self.iPort, self.sUser, sSubtree, fNow, lib.snmpv3.encodeVarbinds(lVarbinds))
+            )
+            self.db.execute('DELETE FROM responses WHERE time < ?', (fNow - iMaxAge,))
+        except sqlite3.Error:
+            pass
+
+    def fetch(self, lSubtrees, fetchMissing):
+        """Answers subtrees from the cache and fetches the others. Checks of
+        the same host that miss at the same time wait for each other, so
+        the device is only asked once.
+        Takes: lSubtrees    = names of the subtrees
+               fetchMissing = function that takes a list of subtree names and
+                              returns a dict of name: varbinds from the device
+        Returns: dict of name: list of (OID tuple, typed value)"""
+        if self.db is None:
+            return fetchMissing(lSubtrees)
+        dOutputs = dict((sSubtree, self.get(sSubtree, False)) for sSubtree in lSubtrees)
+        if None not in dOutputs.values():
+            for sSubtree in lSubtrees:
+                self.count(True)
+            return dOutputs
+        # the lock is not taken in time if a fetch hangs, the device is
+        # then asked again rather than failing the check
+        with lib.statefile.lockState(self.sLockName, self.fLockWait):
+            dOutputs = dict((sSubtree, self.get(sSubtree)) for sSubtree in lSubtrees)
+            lMissing = [sSubtree for sSubtree in lSubtrees if dOutputs[sSubtree] is None]
+            if lMissing:
+                for sSubtree, lVarbinds in fetchMissing(lMissing).items():
+                    self.put(sSubtree, lVarbinds)
+                    dOutputs[sSubtree] = lVarbinds
+        return dOutputs
+
+    def getStats(self):
+        """Returns: (hits, misses) of the host since the cache exists"""
+        try:
+            row = self.db.execute(
+                'SELECT hits, misses FROM stats WHERE host = ? AND port = ?', (self.sHost, self.iPort)
+            ).fetchone()
+        except (sqlite3.Error, AttributeError):
+            return 0, 0
+        return row if row else (0, 0)
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
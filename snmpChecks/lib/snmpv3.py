@@ -0,0 +1,919 @@
+"""
+Minimal SNMPv3 client used by the SNMP checks instead of forking snmpwalk.
+
+Speaks SNMPv3 with the user based security model (RFC 3414) over UDP and
+supports noAuthNoPriv, authNoPriv (MD5, SHA and the SHA-2 variants of
+RFC 7860) and authPriv (DES and AES-128, RFC 3826). Encryption needs the
+cryptography package, which is only imported when privacy is used.
+
+Discovering the engine of an agent and localizing the keys are the
+expensive parts of SNMPv3: deriving a key hashes 1 MB per password. Both are
+cached per host in the state directory of lib/statefile.py, so a check only
+does them again when the agent was replaced or rebooted.
+
+Values are returned typed: INTEGER as int, OCTET STRING as bytes, OBJECT
+IDENTIFIER as tuple, the application types as the int or str subclasses
+below and the exceptions as NoSuchObject, NoSuchInstance and EndOfMibView.
+
+    session = Session('nas1', 'monitor', 'authNoPriv', 'MD5', 'secret')
+    for oid, value in session.walk('1.3.6.1.4.1.6574.1'):
+        print(formatOid(oid), toText(value))
+"""
+
+from collections import OrderedDict
+import hashlib
+import hmac
+import json
+import random
+import socket
+import struct
+import time
+
+import lib.statefile
+
+# BER tags
+iTagInteger     = 0x02
+iTagOctetString = 0x04
+iTagNull        = 0x05
+iTagOid         = 0x06
+iTagSequence    = 0x30
+iTagIpAddress   = 0x40
+iTagCounter32   = 0x41
+iTagGauge32     = 0x42
+iTagTimeTicks   = 0x43
+iTagOpaque      = 0x44
+iTagCounter64   = 0x46
+iTagNoSuchObject   = 0x80
+iTagNoSuchInstance = 0x81
+iTagEndOfMibView   = 0x82
+iTagGet      = 0xa0
+iTagGetNext  = 0xa1
+iTagResponse = 0xa2
+iTagGetBulk  = 0xa5
+iTagReport   = 0xa8
+
+iFlagAuth       = 0x01
+iFlagPriv       = 0x02
+iFlagReportable = 0x04
+
+iMaxMessageSize = 65507
+# varbinds asked for with one GET or GETBULK, small enough for the slow
+# agents of BMCs and NAS, large enough to fetch most tables at once
+iMaxVarbinds = 60
+# seconds an engine time is trusted without a message from the agent, it
+# drifts and agents reject messages more than 150 s off
+iEngineCacheTtl = 86400
+# localized keys kept per host, older ones are dropped when passwords change
+iMaxCachedKeys = 8
+
+# protocol: (hash, length of the authentication parameters)
+dAuthProtocols = {
+    'MD5'   : (hashlib.md5, 12),
+    'SHA'   : (hashlib.sha1, 12),
+    'SHA224': (hashlib.sha224, 16),
+    'SHA256': (hashlib.sha256, 24),
+    'SHA384': (hashlib.sha384, 32),
+    'SHA512': (hashlib.sha512, 48)
+}
+lPrivProtocols = ['DES', 'AES']
+lLevels = ['noAuthNoPriv', 'authNoPriv', 'authPriv']
+
+# reports of the agent, usmStats*
+dReports = {
+    (1, 3, 6, 1, 6, 3, 15, 1, 1, 1, 0): 'unsupported security level',
+    (1, 3, 6, 1, 6, 3, 15, 1, 1, 2, 0): 'not in time window',
+    (1, 3, 6, 1, 6, 3, 15, 1, 1, 3, 0): 'unknown user name',
+    (1, 3, 6, 1, 6, 3, 15, 1, 1, 4, 0): 'unknown engine ID',
+    (1, 3, 6, 1, 6, 3, 15, 1, 1, 5, 0): 'wrong digest, check the authentication password',
+    (1, 3, 6, 1, 6, 3, 15, 1, 1, 6, 0): 'decryption error, check the privacy password'
+}
+tNotInTimeWindow = (1, 3, 6, 1, 6, 3, 15, 1, 1, 2, 0)
+tUnknownEngineId = (1, 3, 6, 1, 6, 3, 15, 1, 1, 4, 0)
+# reports that mean a cached engine is outdated, the agent was replaced or
+# reinstalled
+lEngineReports = [
+    tUnknownEngineId,
+    (1, 3, 6, 1, 6, 3, 15, 1, 1, 3, 0),
+    (1, 3, 6, 1, 6, 3, 15, 1, 1, 5, 0)
+]
+
+lErrorStatus = [
+    'noError', 'tooBig', 'noSuchName', 'badValue', 'readOnly', 'genErr',
+    'noAccess', 'wrongType', 'wrongLength', 'wrongEncoding', 'wrongValue',
+    'noCreation', 'inconsistentValue', 'resourceUnavailable', 'commitFailed',
+    'undoFailed', 'authorizationError', 'notWritable', 'inconsistentName'
+]
+
+class SNMPError(Exception):
+    """the agent answered with an error, or not at all"""
+
+class SNMPTimeout(SNMPError):
+    """the agent did not answer"""
+
+class SNMPTooBig(SNMPError):
+    """the answer would not fit into one message"""
+
+class Counter32(int):
+    pass
+
+class Gauge32(int):
+    pass
+
+class TimeTicks(int):
+    pass
+
+class Counter64(int):
+    pass
+
+class IpAddress(str):
+    pass
+
+class Opaque(bytes):
+    pass
+
+class _Exception:
+    """value of a varbind the agent has no value for"""
+
+    def __init__(self, sName):
+        self.sName = sName
+
+    def __repr__(self):
+        return self.sName
+
+    def __bool__(self):
+        return False
+
+NoSuchObject   = _Exception('noSuchObject')
+NoSuchInstance = _Exception('noSuchInstance')
+EndOfMibView   = _Exception('endOfMibView')
+
+def parseOid(oid):
+    """Takes: oid = OID as '1.3.6.1', '.1.3.6.1' or tuple
+    Returns: OID as tuple of ints"""
+    if isinstance(oid, tuple):
+        return oid
+    return tuple(int(sArc) for sArc in oid.strip('.').split('.') if sArc)
+
+def formatOid(tOid):
+    """Takes: tOid = OID as tuple
+    Returns: OID as dotted string without leading dot"""
+    return '.'.join(str(iArc) for iArc in tOid)
+
+def toText(value):
+    """Takes: value = typed value of a varbind
+    Returns: value as text, like snmpwalk prints it without the type"""
+    if isinstance(value, bytes):
+        try:
+            sText = value.decode('utf-8')
+        except UnicodeDecodeError:
+            return ' '.join('{:02X}'.format(iByte) for iByte in value)
+        # C strings of some agents end with NUL
+        return sText.rstrip('\x00')
+    if isinstance(value, tuple):
+        return formatOid(value)
+    if value is None:
+        return ''
+    return str(value)
+
+# BER encoding
+
+def encodeLength(iLength):
+    """Returns: BER length octets"""
+    if iLength < 0x80:
+        return bytes([iLength])
+    bLength = iLength.to_bytes((iLength.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(bLength)]) + bLength
+
+def encodeTlv(iTag, bValue):
+    """Returns: tag, length and value"""
+    return bytes([iTag]) + encodeLength(len(bValue)) + bValue
+
+def encodeInteger(iValue, iTag=iTagInteger):
+    """Returns: BER integer, two's complement with as few octets as possible"""
+    iLength = max(1, (iValue + (iValue < 0)).bit_length() // 8 + 1)
+    return encodeTlv(iTag, iValue.to_bytes(iLength, 'big', signed=True))
+
+def encodeUnsigned(iValue, iTag):
+    """Returns: BER encoding of an unsigned application type"""
+    iLength = iValue.bit_length() // 8 + 1
+    return encodeTlv(iTag, iValue.to_bytes(iLength, 'big'))
+
+def encodeOid(tOid):
+    """Returns: BER object identifier"""
+    lArcs = list(tOid) if len(tOid) >= 2 else [1, 3]
+    bValue = bytearray()
+    for iArc in [lArcs[0] * 40 + lArcs[1]] + lArcs[2:]:
+        bArc = bytearray([iArc & 0x7f])
+        iArc >>= 7
+        while iArc:
+            bArc.insert(0, 0x80 | (iArc & 0x7f))
+            iArc >>= 7
+        bValue += bArc
+    return encodeTlv(iTagOid, bytes(bValue))
+
+def encodeValue(value):
+    """Returns: BER encoding of a typed value, None is encoded as NULL"""
+    if value is None:
+        return encodeTlv(iTagNull, b'')
+    if isinstance(value, _Exception):
+        return encodeTlv({'noSuchObject': iTagNoSuchObject, 'noSuchInstance': iTagNoSuchInstance}.get(value.sName, iTagEndOfMibView), b'')
+    if isinstance(value, Counter32):
+        return encodeUnsigned(value, iTagCounter32)
+    if isinstance(value, Gauge32):
+        return encodeUnsigned(value, iTagGauge32)
+    if isinstance(value, TimeTicks):
+        return encodeUnsigned(value, iTagTimeTicks)
+    if isinstance(value, Counter64):
+        return encodeUnsigned(value, iTagCounter64)
+    if isinstance(value, IpAddress):
+        return encodeTlv(iTagIpAddress, socket.inet_aton(value))
+    if isinstance(value, Opaque):
+        return encodeTlv(iTagOpaque, value)
+    if isinstance(value, int):
+        return encodeInteger(value)
+    if isinstance(value, tuple):
+        return encodeOid(value)
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return encodeTlv(iTagOctetString, value)
+
+def encodePdu(iTag, iRequestId, lVarbinds, iErrorStatus=0, iErrorIndex=0):
+    """Takes: iTag      = PDU type
+              lVarbinds = list of (OID tuple, typed value)
+              iErrorStatus, iErrorIndex = non-repeaters and max-repetitions
+              for GETBULK
+    Returns: BER encoded PDU"""
+    return encodeTlv(
+        iTag,
+        encodeInteger(iRequestId) + encodeInteger(iErrorStatus) + encodeInteger(iErrorIndex)
+        + encodeVarbinds(lVarbinds)
+    )
+
+def encodeVarbinds(lVarbinds):
+    """Takes: lVarbinds = list of (OID tuple, typed value)
+    Returns: BER encoded varbind list, the types of the values are kept"""
+    return encodeTlv(iTagSequence, b''.join(
+        encodeTlv(iTagSequence, encodeOid(tOid) + encodeValue(value))
+        for tOid, value in lVarbinds
+    ))
+
+# BER decoding
+
+def decodeTlv(bData, iPos):
+    """Takes: bData = BER encoded data
+              iPos  = position of a tag
+    Returns: (tag, start of the value, end of the value)"""
+    try:
+        iTag = bData[iPos]
+        iLength = bData[iPos + 1]
+        iPos += 2
+        if iLength & 0x80:
+            iOctets = iLength & 0x7f
+            iLength = int.from_bytes(bData[iPos:iPos + iOctets], 'big')
+            iPos += iOctets
+    except IndexError:
+        raise SNMPError('truncated message')
+    if iPos + iLength > len(bData):
+        raise SNMPError('truncated message')
+    return iTag, iPos, iPos + iLength
+
+def decodeOid(bValue):
+    """Returns: OID as tuple"""
+    lArcs = []
+    iArc = 0
+    for iByte in bValue:
+        iArc = (iArc << 7) | (iByte & 0x7f)
+        if not iByte & 0x80:
+            lArcs.append(iArc)
+            iArc = 0
+    if not lArcs:
+        return ()
+    iFirst = lArcs[0]
+    if iFirst < 80:
+        return (iFirst // 40, iFirst % 40) + tuple(lArcs[1:])
+    return (2, iFirst - 80) + tuple(lArcs[1:])
+
+def decodeValue(iTag, bValue):
+    """Returns: typed value of a BER element"""
+    if iTag == iTagInteger:
+        return int.from_bytes(bValue, 'big', signed=True)
+    if iTag == iTagOctetString:
+        return bytes(bValue)
+    if iTag == iTagNull:
+        return None
+    if iTag == iTagOid:
+        return decodeOid(bValue)
+    if iTag == iTagIpAddress:
+        return IpAddress('.'.join(str(iByte) for iByte in bValue))
+    if iTag == iTagCounter32:
+        return Counter32(int.from_bytes(bValue, 'big'))
+    if iTag == iTagGauge32:
+        return Gauge32(int.from_bytes(bValue, 'big'))
+    if iTag == iTagTimeTicks:
+        return TimeTicks(int.from_bytes(bValue, 'big'))
+    if iTag == iTagCounter64:
+        return Counter64(int.from_bytes(bValue, 'big'))
+    if iTag == iTagOpaque:
+        return Opaque(bValue)
+    if iTag == iTagNoSuchObject:
+        return NoSuchObject
+    if iTag == iTagNoSuchInstance:
+        return NoSuchInstance
+    if iTag == iTagEndOfMibView:
+        return EndOfMibView
+    return bytes(bValue)
+
+def decodeSequence(bData, iStart, iEnd):
+    """Returns: list of (tag, start, end) of the elements of a sequence"""
+    lElements = []
+    while iStart < iEnd:
+        iTag, iValueStart, iValueEnd = decodeTlv(bData, iStart)
+        lElements.append((iTag, iValueStart, iValueEnd))
+        iStart = iValueEnd
+    return lElements
+
+def decodePdu(bData):
+    """Takes: bData = BER encoded PDU
+    Returns: (tag, request id, error status, error index, list of varbinds)"""
+    iTag, iStart, iEnd = decodeTlv(bData, 0)
+    lFields = decodeSequence(bData, iStart, iEnd)
+    if len(lFields) != 4:
+        raise SNMPError('malformed PDU')
+    iRequestId, iErrorStatus, iErrorIndex = [decodeValue(*[t[0], bData[t[1]:t[2]]]) for t in lFields[:3]]
+    return iTag, iRequestId, iErrorStatus, iErrorIndex, decodeVarbinds(bData, lFields[3][1], lFields[3][2])
+
+def decodeVarbinds(bData, iStart=None, iEnd=None):
+    """Takes: bData        = BER encoded data
+              iStart, iEnd = value of the varbind list, None if bData is the
+                             whole encoded list
+    Returns: list of (OID tuple, typed value)"""
+    if iStart is None:
+        iTag, iStart, iEnd = decodeTlv(bData, 0)
+    lVarbinds = []
+    for iVarbindTag, iVarbindStart, iVarbindEnd in decodeSequence(bData, iStart, iEnd):
+        lVarbind = decodeSequence(bData, iVarbindStart, iVarbindEnd)
+        if len(lVarbind) != 2:
+            raise SNMPError('malformed varbind')
+        (iOidTag, iOidStart, iOidEnd), (iValueTag, iValueStart, iValueEnd) = lVarbind
+        lVarbinds.append((decodeOid(bData[iOidStart:iOidEnd]), decodeValue(iValueTag, bData[iValueStart:iValueEnd])))
+    return lVarbinds
+
+# keys, authentication and privacy
+
+def passwordToKey(sPassword, sAuthProtocol):
+    """RFC 3414 A.2, hashes 1 MB of the repeated password.
+    Takes: sPassword     = pass phrase
+           sAuthProtocol = key of dAuthProtocols
+    Returns: Ku, the key of the user"""
+    bPassword = sPassword.encode('utf-8')
+    if not bPassword:
+        raise SNMPError('empty pass phrase')
+    bBlock = (bPassword * (64 // len(bPassword) + 2))
+    hash = dAuthProtocols[sAuthProtocol][0]()
+    iLength = len(bPassword)
+    # the repeated password in 64 byte blocks, each starting at i % length
+    lBlocks = [bBlock[i:i + 64] for i in range(iLength)]
+    for iBlock in range(1048576 // 64):
+        hash.update(lBlocks[(iBlock * 64) % iLength])
+    return hash.digest()
+
+def localizeKey(bKey, bEngineId, sAuthProtocol):
+    """Returns: Kul, the key of the user localized to one engine"""
+    return dAuthProtocols[sAuthProtocol][0](bKey + bEngineId + bKey).digest()
+
+def getCipher(sPrivProtocol, bKey, bIv):
+    """Returns: cryptography Cipher, imported only when privacy is used"""
+    try:
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    except ImportError:
+        raise SNMPError('the python package cryptography is needed for authPriv')
+    if sPrivProtocol == 'AES':
+        try:
+            from cryptography.hazmat.decrepit.ciphers.modes import CFB
+        except ImportError:
+            CFB = modes.CFB
+        return Cipher(algorithms.AES(bKey[:16]), CFB(bIv))
+    try:
+        from cryptography.hazmat.decrepit.ciphers.algorithms import TripleDES
+    except ImportError:
+        TripleDES = algorithms.TripleDES
+    # triple DES with three times the same key is DES
+    return Cipher(TripleDES(bKey[:8] * 3), modes.CBC(bIv))
+
+def encrypt(sPrivProtocol, bKey, iBoots, iTime, iSalt, bData):
+    """Takes: bKey  = localized privacy key
+              iSalt = counter that is never reused with the same key
+    Returns: (encrypted data, privacy parameters)"""
+    if sPrivProtocol == 'AES':
+        bSalt = struct.pack('>Q', iSalt & 0xffffffffffffffff)
+        bIv = struct.pack('>II', iBoots, iTime) + bSalt
+    else:
+        bSalt = struct.pack('>II', iBoots, iSalt & 0xffffffff)
+        bIv = bytes(a ^ b for a, b in zip(bKey[8:16], bSalt))
+        bData += b'\x00' * (-len(bData) % 8)
+    encryptor = getCipher(sPrivProtocol, bKey, bIv).encryptor()
+    return encryptor.update(bData) + encryptor.finalize(), bSalt
+
+def decrypt(sPrivProtocol, bKey, iBoots, iTime, bSalt, bData):
+    """Returns: decrypted data, DES padding is left to the BER decoder"""
+    if len(bSalt) != 8:
+        raise SNMPError('malformed privacy parameters')
+    if sPrivProtocol == 'AES':
+        bIv = struct.pack('>II', iBoots, iTime) + bSalt
+    else:
+        if len(bData) % 8:
+            raise SNMPError('malformed encrypted PDU')
+        bIv = bytes(a ^ b for a, b in zip(bKey[8:16], bSalt))
+    decryptor = getCipher(sPrivProtocol, bKey, bIv).decryptor()
+    return decryptor.update(bData) + decryptor.finalize()
+
+class Session:
+    """SNMPv3 session with one agent"""
+
+    def __init__(self, sHost, sUser, sLevel='authNoPriv', sAuthProtocol='MD5', sAuthPassword=None,
+                 sPrivProtocol='DES', sPrivPassword=None, iPort=161, fTimeout=10.0, iRetries=1, bCache=True,
+                 fDeadline=None):
+        """Takes: sHost         = host name or IP address of the agent
+                  sUser         = security name
+                  sLevel        = noAuthNoPriv, authNoPriv or authPriv
+                  sAuthProtocol = MD5, SHA, SHA224, SHA256, SHA384 or SHA512
+                  sAuthPassword = authentication pass phrase
+                  sPrivProtocol = DES or AES
+                  sPrivPassword = privacy pass phrase
+                  iPort         = UDP port of the agent
+                  fTimeout      = seconds to wait for an answer
+                  iRetries      = times a request is sent again without an answer
+                  bCache        = False to not keep engine and keys on disk
+                  fDeadline     = time.monotonic() after which no request
+                                  waits any longer, None for no limit"""
+        if sLevel not in lLevels:
+            raise SNMPError('unknown security level {}'.format(sLevel))
+        self.sLevel = sLevel
+        self.bAuth  = sLevel != 'noAuthNoPriv'
+        self.bPriv  = sLevel == 'authPriv'
+        self.sAuthProtocol = (sAuthProtocol or 'MD5').upper().replace('-', '')
+        self.sPrivProtocol = (sPrivProtocol or 'DES').upper()
+        if self.bAuth and self.sAuthProtocol not in dAuthProtocols:
+            raise SNMPError('unknown authentication protocol {}'.format(sAuthProtocol))
+        if self.bPriv and self.sPrivProtocol[:3] not in lPrivProtocols:
+            raise SNMPError('unknown privacy protocol {}'.format(sPrivProtocol))
+        self.sPrivProtocol = self.sPrivProtocol[:3]
+        if self.bAuth and not sAuthPassword:
+            raise SNMPError('{} needs an authentication pass phrase'.format(sLevel))
+        if self.bPriv and not sPrivPassword:
+            raise SNMPError('authPriv needs a privacy pass phrase')
+
+        self.sHost         = sHost
+        self.iPort         = iPort
+        self.bUser         = (sUser or '').encode('utf-8')
+        self.sAuthPassword = sAuthPassword
+        self.sPrivPassword = sPrivPassword
+        self.fTimeout      = fTimeout
+        self.iRetries      = iRetries
+        self.fDeadline     = fDeadline
+        self.bCache        = bCache
+        self.sStateName    = 'snmpv3_{}_{}'.format(''.join(c if c.isalnum() or c in '.-' else '_' for c in sHost), iPort)
+
+        self.bEngineId   = None
+        self.iBoots      = 0
+        self.iTime       = 0
+        self.fTimeSynced = 0.0
+        self.bAuthKey    = None
+        self.bPrivKey    = None
+        self.dKeys       = {}
+        self.bDiscovered = False
+        self.iRequestId  = random.randrange(1, 2 ** 31 - 1)
+        self.iSalt       = random.randrange(0, 2 ** 63)
+        self.iRequests   = 0
+        self.sock        = None
+        self.address     = None
+
+        if self.bCache:
+            self.loadEngine()
+
+    # engine and key cache
+
+    def getKeyName(self, sKind, sProtocol, sPassword):
+        """Returns: name of a localized key in the cache, changes with the
+        password, protocol and engine"""
+        return hashlib.sha256('\0'.join([
+            sKind, sProtocol, sPassword, self.bUser.decode('utf-8'), self.bEngineId.hex()
+        ]).encode('utf-8')).hexdigest()[:32]
+
+    def loadEngine(self):
+        """reads engine ID, boots, time and localized keys from the cache"""
+        bData = lib.statefile.readState(self.sStateName)
+        if bData is None:
+            return
+        try:
+            dState = json.loads(bData.decode('utf-8'))
+            if time.time() - dState['timestamp'] > iEngineCacheTtl:
+                return
+            self.bEngineId = bytes.fromhex(dState['engineId'])
+            self.iBoots = int(dState['boots'])
+            self.iTime = int(dState['time'])
+            self.fTimeSynced = time.monotonic() - (time.time() - float(dState['timestamp']))
+            self.dKeys = dict((sName, bytes.fromhex(sKey)) for sName, sKey in dState.get('keys', {}).items())
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.bEngineId = None
+            self.dKeys = {}
+
+    def saveEngine(self):
+        """writes engine ID, boots, time and localized keys to the cache"""
+        if not self.bCache or self.bEngineId is None:
+            return
+        lib.statefile.writeState(self.sStateName, json.dumps({
+            'engineId' : self.bEngineId.hex(),
+            'boots'    : self.iBoots,
+            'time'     : self.getEngineTime(),
+            'timestamp': time.time(),
+            'keys'     : dict((sName, bKey.hex()) for sName, bKey in list(self.dKeys.items())[-iMaxCachedKeys:])
+        }).encode('utf-8'))
+
+    def getKey(self, sKind, sProtocol, sPassword):
+        """Returns: key localized to the engine, from the cache if possible"""
+        sName = self.getKeyName(sKind, sProtocol, sPassword)
+        if sName not in self.dKeys:
+            self.dKeys[sName] = localizeKey(passwordToKey(sPassword, sProtocol), self.bEngineId, sProtocol)
+        return self.dKeys[sName]
+
+    def setEngine(self, bEngineId, iBoots, iTime):
+        """takes over the engine of the agent, keys of another engine are
+        dropped"""
+        if bEngineId != self.bEngineId:
+            self.dKeys = {}
+            self.bAuthKey = None
+            self.bPrivKey = None
+        self.bEngineId = bEngineId
+        self.iBoots = iBoots
+        self.iTime = iTime
+        self.fTimeSynced = time.monotonic()
+
+    def getEngineTime(self):
+        """Returns: estimated current time of the engine"""
+        return max(0, self.iTime + int(time.monotonic() - self.fTimeSynced))
+
+    def prepareKeys(self):
+        """localizes the keys, if they are not in the cache"""
+        iKeys = len(self.dKeys)
+        if self.bAuth and self.bAuthKey is None:
+            self.bAuthKey = self.getKey('auth', self.sAuthProtocol, self.sAuthPassword)
+        if self.bPriv and self.bPrivKey is None:
+            # the privacy key is derived with the authentication hash
+            self.bPrivKey = self.getKey('priv:' + self.sPrivProtocol, self.sAuthProtocol, self.sPrivPassword)
+        if len(self.dKeys) != iKeys:
+            self.saveEngine()
+
+    # transport
+
+    def connect(self):
+        """opens the UDP socket"""
+        if self.sock is not None:
+            return
+        try:
+            lAddresses = socket.getaddrinfo(self.sHost, self.iPort, 0, socket.SOCK_DGRAM)
+        except socket.gaierror as e:
+            raise SNMPError('could not resolve {}: {}'.format(self.sHost, e))
+        iFamily, iType, iProto, sCanonName, self.address = lAddresses[0]
+        self.sock = socket.socket(iFamily, socket.SOCK_DGRAM)
+
+    def close(self):
+        """closes the socket and saves the engine time"""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.iRequests:
+            self.saveEngine()
+            self.iRequests = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # messages
+
+    def encodeMessage(self, iMessageId, bPdu, bAuth, bPriv, bReportable=True):
+        """Takes: iMessageId = msgID
+                  bPdu       = BER encoded PDU
+                  bAuth      = authenticate the message
+                  bPriv      = encrypt the PDU
+        Returns: complete message"""
+        iFlags = (iFlagAuth if bAuth else 0) | (iFlagPriv if bPriv else 0) | (iFlagReportable if bReportable else 0)
+        bEngineId = self.bEngineId or b''
+        iBoots = self.iBoots if bAuth else 0
+        iTime = self.getEngineTime() if bAuth else 0
+        bScopedPdu = encodeTlv(iTagSequence, encodeTlv(iTagOctetString, bEngineId) + encodeTlv(iTagOctetString, b'') + bPdu)
+
+        bPrivParameters = b''
+        if bPriv:
+            self.iSalt += 1
+            bEncrypted, bPrivParameters = encrypt(self.sPrivProtocol, self.bPrivKey, iBoots, iTime, self.iSalt, bScopedPdu)
+            bData = encodeTlv(iTagOctetString, bEncrypted)
+        else:
+            bData = bScopedPdu
+
+        iAuthLength = dAuthProtocols[self.sAuthProtocol][1] if bAuth else 0
+        bBeforeAuth = (
+            encodeTlv(iTagOctetString, bEngineId) + encodeInteger(iBoots) + encodeInteger(iTime)
+            + encodeTlv(iTagOctetString, self.bUser if bAuth or self.bEngineId else b'')
+        )
+        bAuthParameters = encodeTlv(iTagOctetString, b'\x00' * iAuthLength)
+        bSecurity = encodeTlv(iTagSequence, bBeforeAuth + bAuthParameters + encodeTlv(iTagOctetString, bPrivParameters))
+        bSecurityParameters = encodeTlv(iTagOctetString, bSecurity)
+        bHeader = encodeInteger(3) + encodeTlv(iTagSequence,
+            encodeInteger(iMessageId) + encodeInteger(iMaxMessageSize)
+            + encodeTlv(iTagOctetString, bytes([iFlags])) + encodeInteger(3)
+        )
+        bMessage = encodeTlv(iTagSequence, bHeader + bSecurityParameters + bData)
+        if not bAuth:
+            return bMessage
+
+        # the digest is calculated over the message with zeroed parameters
+        iOffset = (
+            (len(bMessage) - len(bHeader + bSecurityParameters + bData)) + len(bHeader)
+            + (len(bSecurityParameters) - len(bSecurity))
+            + (len(bSecurity) - len(bBeforeAuth + bAuthParameters) - len(encodeTlv(iTagOctetString, bPrivParameters)))
+            + len(bBeforeAuth) + (len(bAuthParameters) - iAuthLength)
+        )
+        bDigest = hmac.new(self.bAuthKey, bMessage, dAuthProtocols[self.sAuthProtocol][0]).digest()[:iAuthLength]
+        return bMessage[:iOffset] + bDigest + bMessage[iOffset + iAuthLength:]
+
+    def decodeMessage(self, bMessage):
+        """Verifies and decrypts a message of the agent.
+        Returns: (msgID, flags, (engine ID, boots, time), BER encoded PDU)"""
+        iTag, iStart, iEnd = decodeTlv(bMessage, 0)
+        lParts = decodeSequence(bMessage, iStart, iEnd)
+        if iTag != iTagSequence or len(lParts) != 4 or decodeValue(iTagInteger, bMessage[lParts[0][1]:lParts[0][2]]) != 3:
+            raise SNMPError('not an SNMPv3 message')
+        lHeader = decodeSequence(bMessage, lParts[1][1], lParts[1][2])
+        if len(lHeader) != 4:
+            raise SNMPError('malformed message header')
+        iMessageId = decodeValue(iTagInteger, bMessage[lHeader[0][1]:lHeader[0][2]])
+        iFlags = bMessage[lHeader[2][1]] if lHeader[2][2] > lHeader[2][1] else 0
+
+        iSecurityTag, iSecurityStart, iSecurityEnd = decodeTlv(bMessage, lParts[2][1])
+        lSecurity = decodeSequence(bMessage, iSecurityStart, iSecurityEnd)
+        if len(lSecurity) != 6:
+            raise SNMPError('malformed security parameters')
+        bEngineId, iBoots, iTime, bUser, bAuthParameters, bPrivParameters = [
+            decodeValue(iFieldTag, bMessage[iFieldStart:iFieldEnd]) for iFieldTag, iFieldStart, iFieldEnd in lSecurity
+        ]
+
+        if iFlags & iFlagAuth:
+            if self.bAuthKey is None or bEngineId != self.bEngineId:
+                raise SNMPError('authenticated message of an unknown engine')
+            iAuthStart, iAuthEnd = lSecurity[4][1], lSecurity[4][2]
+            bZeroed = bMessage[:iAuthStart] + b'\x00' * (iAuthEnd - iAuthStart) + bMessage[iAuthEnd:]
+            bDigest = hmac.new(self.bAuthKey, bZeroed, dAuthProtocols[self.sAuthProtocol][0]).digest()[:len(bAuthParameters)]
+            if not bAuthParameters or not hmac.compare_digest(bDigest, bAuthParameters):
+                raise SNMPError('message of the agent failed authentication')
+
+        if iFlags & iFlagPriv:
+            if not iFlags & iFlagAuth or self.bPrivKey is None:
+                raise SNMPError('encrypted message of an unknown engine')
+            bEncrypted = bMessage[lParts[3][1]:lParts[3][2]]
+            bScopedPdu = decrypt(self.sPrivProtocol, self.bPrivKey, iBoots, iTime, bPrivParameters, bEncrypted)
+        else:
+            # elements are contiguous, the scoped PDU starts where the
+            # security parameters end
+            bScopedPdu = bMessage[lParts[2][2]:lParts[3][2]]
+
+        iScopedTag, iScopedStart, iScopedEnd = decodeTlv(bScopedPdu, 0)
+        lScoped = decodeSequence(bScopedPdu, iScopedStart, iScopedEnd)
+        if len(lScoped) != 3:
+            raise SNMPError('malformed scoped PDU')
+        return iMessageId, iFlags, (bEngineId, iBoots, iTime), bScopedPdu[lScoped[1][2]:lScoped[2][2]]
+
+    def exchange(self, iPduTag, lVarbinds, iErrorStatus=0, iErrorIndex=0, bAuth=None, bPriv=None):
+        """Sends one request and waits for its answer. Datagrams that can
+        not be decoded or lack the security of the request are skipped.
+        Agents send most reports unauthenticated, RFC 3414 3.2, so an
+        unauthenticated report to an authenticated request is only
+        returned if no authenticated answer arrives in time.
+        Returns: (tag, error status, error index, varbinds, engine, flags)
+        of the answer"""
+        self.connect()
+        bAuth = self.bAuth if bAuth is None else bAuth
+        bPriv = self.bPriv if bPriv is None else bPriv
+        self.iRequestId = self.iRequestId % (2 ** 31 - 1) + 1
+        iRequestId = self.iRequestId
+        bMessage = self.encodeMessage(
+            iRequestId,
+            encodePdu(iPduTag, iRequestId, lVarbinds, iErrorStatus, iErrorIndex),
+            bAuth,
+            bPriv
+        )
+        self.iRequests += 1
+
+        tReport = None
+        for iTry in range(self.iRetries + 1):
+            if self.fDeadline is not None and time.monotonic() >= self.fDeadline:
+                break
+            self.sock.sendto(bMessage, self.address)
+            fDeadline = time.monotonic() + self.fTimeout
+            if self.fDeadline is not None:
+                fDeadline = min(fDeadline, self.fDeadline)
+            while True:
+                fLeft = fDeadline - time.monotonic()
+                if fLeft <= 0:
+                    break
+                self.sock.settimeout(fLeft)
+                try:
+                    bAnswer, address = self.sock.recvfrom(iMaxMessageSize)
+                except socket.timeout:
+                    break
+                except OSError as e:
+                    raise SNMPError('could not reach {}: {}'.format(self.sHost, e))
+                try:
+                    iMessageId, iFlags, tEngine, bPdu = self.decodeMessage(bAnswer)
+                    iTag, iAnswerId, iStatus, iIndex, lAnswer = decodePdu(bPdu)
+                except (SNMPError, ValueError, TypeError, IndexError, struct.error):
+                    # answers to earlier requests, or garbage
+                    continue
+                if iMessageId != iRequestId:
+                    continue
+                if bAuth and not iFlags & iFlagAuth:
+                    if iTag == iTagReport:
+                        tReport = (iTag, iStatus, iIndex, lAnswer, tEngine, iFlags)
+                    continue
+                # reports are never encrypted
+                if bPriv and iTag != iTagReport and not iFlags & iFlagPriv:
+                    continue
+                return iTag, iStatus, iIndex, lAnswer, tEngine, iFlags
+            if tReport:
+                return tReport
+        raise SNMPTimeout('no answer from {}:{} after {} s'.format(self.sHost, self.iPort, self.fTimeout * (self.iRetries + 1)))
+
+    def discover(self):
+        """finds the engine ID, boots and time of the agent"""
+        iTag, iStatus, iIndex, lVarbinds, tEngine, iFlags = self.exchange(iTagGet, [], bAuth=False, bPriv=False)
+        bEngineId, iBoots, iTime = tEngine
+        if not bEngineId:
+            raise SNMPError('{} did not report its engine ID'.format(self.sHost))
+        self.setEngine(bEngineId, iBoots, iTime)
+        self.bDiscovered = True
+        if self.bAuth:
+            self.prepareKeys()
+            # agents only report the time authenticated, RFC 3414 4
+            if not iBoots and not iTime:
+                self.request(iTagGet, [], bRetry=False)
+        self.saveEngine()
+
+    def request(self, iPduTag, lVarbinds, iErrorStatus=0, iErrorIndex=0, bRetry=True):
+        """Sends a request, discovering the engine and synchronising the
+        time when needed.
+        Returns: varbinds of the response"""
+        if self.bEngineId is None:
+            self.discover()
+        if self.bAuth:
+            self.prepareKeys()
+        iTag, iStatus, iIndex, lAnswer, tEngine, iFlags = self.exchange(iPduTag, lVarbinds, iErrorStatus, iErrorIndex)
+
+        if iTag == iTagReport:
+            tReport = lAnswer[0][0] if lAnswer else None
+            if bRetry and tReport == tNotInTimeWindow and iFlags & iFlagAuth:
+                self.setEngine(*tEngine)
+                self.saveEngine()
+                return self.request(iPduTag, lVarbinds, iErrorStatus, iErrorIndex, bRetry=False)
+            if bRetry and (tReport == tUnknownEngineId or (tReport in lEngineReports and not self.bDiscovered)):
+                self.bEngineId = None
+                self.discover()
+                return self.request(iPduTag, lVarbinds, iErrorStatus, iErrorIndex, bRetry=False)
+            if tReport == tNotInTimeWindow and not lVarbinds:
+                # the answer to the time synchronisation of discover
+                self.setEngine(*tEngine)
+                return []
+            raise SNMPError('{} reported {}'.format(self.sHost, dReports.get(tReport, formatOid(tReport or ()))))
+        if iTag != iTagResponse:
+            raise SNMPError('unexpected PDU type {:#x}'.format(iTag))
+        if iStatus == 1:
+            raise SNMPTooBig('{} answered tooBig'.format(self.sHost))
+        if iStatus:
+            sStatus = lErrorStatus[iStatus] if iStatus < len(lErrorStatus) else str(iStatus)
+            raise SNMPError('{} answered {} at varbind {}'.format(self.sHost, sStatus, iIndex))
+
+        # the agent is the authoritative engine, its time is the reference
+        if iFlags & iFlagAuth:
+            self.iBoots, self.iTime = tEngine[1], tEngine[2]
+            self.fTimeSynced = time.monotonic()
+        return lAnswer
+
+    # operations
+
+    def get(self, lOids):
+        """Takes: lOids = list of OIDs
+        Returns: list of (OID tuple, typed value)"""
+        return self.request(iTagGet, [(parseOid(oid), None) for oid in lOids])
+
+    def getNext(self, lOids):
+        """Returns: list of (OID tuple, typed value) following the OIDs"""
+        return self.request(iTagGetNext, [(parseOid(oid), None) for oid in lOids])
+
+    def getBulk(self, lOids, iNonRepeaters=0, iMaxRepetitions=25):
+        """Takes: lOids           = list of OIDs
+                  iNonRepeaters   = number of OIDs at the start of lOids
+                                    that are only fetched once
+                  iMaxRepetitions = successors fetched for the other OIDs
+        Returns: list of (OID tuple, typed value), the repetitions of all
+        OIDs interleaved as the agent sent them"""
+        return self.request(iTagGetBulk, [(parseOid(oid), None) for oid in lOids], iNonRepeaters, iMaxRepetitions)
+
+    def walk(self, oid, iMaxRepetitions=25):
+        """Takes: oid = root of the subtree
+        Returns: list of (OID tuple, typed value) of the whole subtree"""
+        tRoot = parseOid(oid)
+        tNext = tRoot
+        lVarbinds = []
+        while True:
+            lAnswer = self.getBulk([tNext], 0, iMaxRepetitions)
+            if not lAnswer:
+                return lVarbinds
+            for tOid, value in lAnswer:
+                if value is EndOfMibView or tOid[:len(tRoot)] != tRoot or tOid <= tNext:
+                    return lVarbinds
+                lVarbinds.append((tOid, value))
+                tNext = tOid
+
+    def walkColumns(self, lColumns, iMaxRepetitions=None):
+        """Walks table columns side by side, every GETBULK asks for the next
+        rows of all columns that are not finished yet.
+        Takes: lColumns        = list of column OIDs
+               iMaxRepetitions = rows per GETBULK, None to fit iMaxVarbinds
+        Returns: list of (OID tuple, typed value), column after column"""
+        lRoots = [parseOid(column) for column in lColumns]
+        dNext = OrderedDict((tRoot, tRoot) for tRoot in lRoots)
+        dRows = dict((tRoot, []) for tRoot in lRoots)
+        while dNext:
+            lActive = list(dNext)
+            iRepetitions = iMaxRepetitions or max(1, min(50, iMaxVarbinds // len(lActive)))
+            try:
+                lAnswer = self.getBulk([dNext[tRoot] for tRoot in lActive], 0, iRepetitions)
+            except SNMPTooBig:
+                if iRepetitions == 1:
+                    raise
+                iMaxRepetitions = max(1, iRepetitions // 2)
+                continue
+            if not lAnswer:
+                break
+            # the answer holds row after row, one varbind per column
+            setDone = set()
+            bProgress = False
+            for i, (tOid, value) in enumerate(lAnswer):
+                tRoot = lActive[i % len(lActive)]
+                if tRoot in setDone:
+                    continue
+                if value is EndOfMibView or tOid[:len(tRoot)] != tRoot or tOid <= dNext[tRoot]:
+                    setDone.add(tRoot)
+                    continue
+                dRows[tRoot].append((tOid, value))
+                dNext[tRoot] = tOid
+                bProgress = True
+            for tRoot in setDone:
+                dNext.pop(tRoot)
+            if not bProgress:
+                break
+        return [tVarbind for tRoot in lRoots for tVarbind in dRows[tRoot]]
+
+    def fetch(self, lScalars, lColumns):
+        """Fetches scalars with GET and table columns with GETBULK, the
+        smallest set of requests for a known list of OIDs.
+        Takes: lScalars = list of instance OIDs, e.g. sysDescr.0
+               lColumns = list of column OIDs
+        Returns: list of (OID tuple, typed value) sorted by OID, like a walk
+        would return them. Instances the agent does not have are left out."""
+        lVarbinds = []
+        lScalars = [parseOid(oid) for oid in lScalars]
+        for i in range(0, len(lScalars), iMaxVarbinds):
+            lVarbinds += [
+                (tOid, value) for tOid, value in self.get(lScalars[i:i + iMaxVarbinds])
+                if not isinstance(value, _Exception)
+            ]
+        if lColumns:
+            lVarbinds += self.walkColumns(lColumns)
+        return sorted(lVarbinds, key=lambda tVarbind: tVarbind[0])
+
+    def fetchGroups(self, dGroups):
+        """Fetches the OIDs of several groups, e.g. the modules of a check,
+        with the requests of a single fetch.
+        Takes: dGroups = dict of name: (instance OIDs, column OIDs)
+        Returns: OrderedDict of name: list of (OID tuple, typed value) in
+        the order of dGroups"""
+        dOwners = {}
+        lScalars = []
+        lColumns = []
+        for sName, (lGroupScalars, lGroupColumns) in dGroups.items():
+            for oid in list(lGroupScalars) + list(lGroupColumns):
+                dOwners[parseOid(oid)] = sName
+            lScalars += lGroupScalars
+            lColumns += lGroupColumns
+        dOutputs = OrderedDict((sName, []) for sName in dGroups)
+        for tOid, value in self.fetch(lScalars, lColumns):
+            # instances are answered with their own OID, rows below their
+            # column
+            for iLength in range(len(tOid), 0, -1):
+                if tOid[:iLength] in dOwners:
+                    dOutputs[dOwners[tOid[:iLength]]].append((tOid, value))
+                    break
+        return dOutputs